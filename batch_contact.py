@@ -0,0 +1,113 @@
+"""
+Contact sheet of a batch: one downscaled, labelled thumbnail per figure
+
+ContactSheet.add(fig, label) shrinks a finished figure into the next cell
+of a fixed grid; a full page is written to the output folder straight away
+(ifigure_contact_<time>_p001.jpeg, _p002, ...) and a new one started, so
+only one page and one thumbnail are ever held, whatever the batch size.
+add() is thread-safe, the headless workers call it as their figures finish.
+"""
+
+from ij import ImagePlus
+from ij.process import ColorProcessor, ImageProcessor
+from java.awt import Color, Font
+import os
+import threading
+import time
+
+from ifigure_writer import save_figure
+
+GAP = 8
+FONT_SIZE = 12
+LABEL_HEIGHT = FONT_SIZE + 8
+BACKGROUND = 0x202020
+
+
+class ContactSheet(object):
+    """Paged grid of figure thumbnails, written page by page (tag: appended to the page names)"""
+
+    def __init__(self, output_dir, columns=6, rows=8, thumb_width=320, jpeg_quality=85, tag=None):
+        self.base = os.path.join(output_dir, "ifigure_contact_{}".format(time.strftime("%Y%m%d_%H%M%S")))
+        if tag:
+            self.base += "_" + tag
+        self.columns = columns
+        self.rows = rows
+        self.thumb_width = thumb_width
+        # figures are about twice as wide as high
+        self.thumb_height = thumb_width // 2
+        self.jpeg_quality = jpeg_quality
+        self.lock = threading.Lock()
+        self.page = None
+        self.page_number = 0
+        self.count = 0
+        self.dirty = False
+        self.paths = []
+
+    def _new_page(self):
+        w = GAP + self.columns * (self.thumb_width + GAP)
+        h = GAP + self.rows * (self.thumb_height + LABEL_HEIGHT + GAP)
+        page = ColorProcessor(w, h)
+        page.setColor(BACKGROUND)
+        page.fill()
+        page.setFont(Font("SansSerif", Font.PLAIN, FONT_SIZE))
+        page.setAntialiasedText(True)
+        page.setColor(Color.white)
+        self.page_number += 1
+        self.count = 0
+        return page
+
+    def _thumbnail(self, fig):
+        """Figure scaled to fit the cell (averaging, no upscaling)"""
+        ip = fig.getProcessor().convertToRGB()
+        scale = min(1.0, float(self.thumb_width) / ip.getWidth(), float(self.thumb_height) / ip.getHeight())
+        w = max(1, int(ip.getWidth() * scale))
+        h = max(1, int(ip.getHeight() * scale))
+        ip.setInterpolationMethod(ImageProcessor.BILINEAR)
+        return ip.resize(w, h, True)
+
+    def _fit_label(self, label):
+        """Label cut from the left ("...sample_01/cell_3.czi") to the cell width"""
+        if self.page.getStringWidth(label) <= self.thumb_width:
+            return label
+        while len(label) > 1 and self.page.getStringWidth("..." + label) > self.thumb_width:
+            label = label[1:]
+        return "..." + label
+
+    def add(self, fig, label):
+        """Add the thumbnail of fig (ImagePlus, left open) with its label"""
+        thumb = self._thumbnail(fig)
+        with self.lock:
+            if self.page is None:
+                self.page = self._new_page()
+            col = self.count % self.columns
+            row = self.count // self.columns
+            x = GAP + col * (self.thumb_width + GAP)
+            y = GAP + row * (self.thumb_height + LABEL_HEIGHT + GAP)
+            self.page.insert(thumb, x + (self.thumb_width - thumb.getWidth()) // 2,
+                             y + (self.thumb_height - thumb.getHeight()) // 2)
+            self.page.drawString(self._fit_label(label), x, y + self.thumb_height + LABEL_HEIGHT - 4)
+            self.count += 1
+            self.dirty = True
+            if self.count == self.columns * self.rows:
+                self._write()
+                self.page = None
+
+    def _write(self):
+        base = "{}_p{:03d}".format(self.base, self.page_number)
+        path = save_figure(ImagePlus("Contact sheet", self.page), base, ["jpeg"], self.jpeg_quality)[0]
+        if path not in self.paths:
+            self.paths.append(path)
+        self.dirty = False
+
+    def flush(self):
+        """Write the current, partly filled page (rewritten once it fills up)"""
+        with self.lock:
+            if self.page is not None and self.dirty:
+                self._write()
+
+    def close(self):
+        """Write the last page, returns the paths of all pages"""
+        self.flush()
+        with self.lock:
+            self.page = None
+        return self.paths
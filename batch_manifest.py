@@ -0,0 +1,301 @@
+"""
+Parameter manifest for headless (non-interactive) runs of batch_process.py
+
+A manifest is either a JSON file:
+
+    {
+        "input_dir": "/data/airyscan/2025-12-15",
+        "output_dir": "/data/airyscan/2025-12-15/figures",
+        "extensions": ["czi"],
+        "recursive": false,
+        "watch": false,
+        "contact_sheet": false,
+        "workers": 8,
+        "memory_fraction": 0.75,
+        "resume": true,
+        "retry_failed": false,
+        "fingerprint": "stat",
+        "defaults": {"blur_sigma": 0.0, "panel_labels": ["Cyan", "Far red", "Red", "Merged"]},
+        "rules": [{"pattern": "*_control_*", "blur_sigma": 1.0}],
+        "files": {"sample_01.czi": {"zslice": 12, "z_start": 5, "z_end": 20}}
+    }
+
+or a CSV table with a "file" column (exact file name or wildcard pattern) and
+one column per parameter (blur_sigma, zslice, z_start, z_end, label_ch1,
+label_ch2, label_ch3, label_merged, roi, layout, projections, normalize,
+normalize_low, normalize_high, tile_budget_mb, formats, jpeg_quality, series, autofocus,
+focus_channel, focus_metric). Empty cells are ignored. A CSV
+manifest uses its own folder as input folder and "<input>/figures" as output;
+the files processed are those with the extensions of its entries and patterns
+(every supported format when a pattern leaves the extension open, e.g.
+"sample_*").
+
+"projections" lists the Z projection rows of the combined figure, any of
+max, mean, sum, sd and median (JSON list or "max|mean" in CSV); all but the
+median are computed in the same pass over the stack.
+
+"normalize" stretches the top row channels from the "normalize_low" to the
+"normalize_high" percentile (default 0 and 100, i.e. min and max).
+
+"autofocus" replaces "zslice" by the sharpest z-plane of "focus_channel"
+(default 1) within the ROI, scored by "focus_metric": "laplacian" (variance
+of the Laplacian, default) or "normvar" (normalized variance). The chosen
+slice and its score go to the run report (focus_z, focus_score).
+
+"tile_budget_mb" (0 = off) switches to the tiled mode of ifigure_tiled.py
+when the planes the figure needs would take more than that many MB, for
+tile-scan mosaics (combined layout only, needs Bio-Formats).
+
+"formats" lists the output files written from one render: any of jpeg,
+png (lossless) and tiff (Deflate-compressed), e.g. ["png", "jpeg"] or
+"png|jpeg" in CSV; "jpeg_quality" is 0-100 (default 85).
+
+"series" picks the series (scenes, positions) of multi-series CZI/ND2 files
+that get a figure: "all" (default) or their numbers, e.g. [1, 3] or "1|3"
+in CSV (1-based, as in the Bio-Formats importer). Every series is read on
+its own with the same parameters; figure names get an _sNN_<name> suffix.
+
+"contact_sheet" also writes a QC overview of the whole batch: a thumbnail of
+every figure with its file name, "contact_columns" x "contact_rows" per page
+(default 6 x 8), "contact_width" pixels wide (default 320). See
+batch_contact.py.
+
+Parameters for a file are resolved as: defaults -> matching wildcard rules
+(in file order) -> exact per-file entry. Files are named by their path
+relative to the input folder ("2025-12-15/sample_01/cell_3.czi"); rules and
+entries match either that path or the bare file name.
+
+"recursive" also processes the subfolders of the input folder (the output
+folder is skipped), writing the figures to the same subfolders of the output
+folder. "watch" keeps running and processes new files as soon as they are
+completely written (size and mtime unchanged for "watch_settle" seconds,
+rescans every "watch_interval" seconds), for figures during a running
+acquisition; it stops after "watch_idle" minutes without new files (0 =
+until the run is stopped). See batch_scan.py.
+
+"queue_dir" turns headless runs into workers of a queue shared by several
+machines (a folder on the NAS, relative paths are inside the output folder):
+every file is claimed by one worker, claims without heartbeat for
+"queue_stale" seconds (default 120) are taken back, after "queue_attempts"
+lost claims (default 3) the file counts as failed. Queue and progress are
+handled with batch_queue.py (enqueue, status, requeue).
+
+"leak_check" runs one GC after every file and reports, as leaked_mb in the
+run report, the pixels of that file's images still reachable afterwards
+(peak_mb, the most image memory a file had allocated at once, is always
+reported; see ifigure_workspace.py). For hunting heap growth, it costs a
+full GC per file.
+
+"workers" is the number of files processed at once (default: one per core,
+see batch_workers.py), "memory_fraction" the share of the ImageJ heap that
+running jobs may use together.
+
+With "resume" (default on) files already processed with the same parameters
+are skipped (see batch_state.py); "retry_failed" processes only the files
+that failed last time; "fingerprint" is "stat" (size + mtime) or "sha1".
+"""
+
+import csv
+import fnmatch
+import json
+import os
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+from ifigure_params import DEFAULT_PARAMS as FIGURE_PARAMS, DEFAULT_LABELS
+
+LABEL_COLUMNS = ["label_ch1", "label_ch2", "label_ch3", "label_merged"]
+
+# the figure defaults plus those of a batch job
+DEFAULT_PARAMS = dict(FIGURE_PARAMS,
+                      roi=None,          # [x, y, width, height] or None for whole image
+                      tile_budget_mb=0,
+                      formats=["jpeg"],
+                      jpeg_quality=85,
+                      series="all")      # "all" or a list of 1-based series numbers
+
+SUPPORTED_EXTENSIONS = ["czi", "tif", "tiff", "lsm", "nd2"]
+
+
+def _has_wildcard(pattern):
+    return any(c in pattern for c in "*?[")
+
+
+def _parse_roi(value):
+    """Accept [x, y, w, h] or "x,y,w,h" and return a list of 4 ints"""
+    if value is None or value == "":
+        return None
+    if isinstance(value, string_types):
+        value = [v for v in value.replace(";", ",").split(",") if v.strip()]
+    if len(value) != 4:
+        raise ValueError("ROI must have 4 values (x, y, width, height): {}".format(value))
+    return [int(float(v)) for v in value]
+
+
+def normalize_params(raw):
+    """Convert raw manifest values (strings from CSV, JSON types) to pipeline params"""
+    params = {}
+    for key, value in raw.items():
+        key = key.strip()
+        if value is None or (isinstance(value, string_types) and value.strip() == ""):
+            continue
+        if key in ('blur_sigma', 'normalize_low', 'normalize_high'):
+            params[key] = float(value)
+        elif key in ('normalize', 'autofocus'):
+            if isinstance(value, string_types):
+                value = value.strip().lower() in ("1", "true", "yes", "on")
+            params[key] = bool(value)
+        elif key in ('zslice', 'z_start', 'z_end', 'tile_budget_mb', 'jpeg_quality', 'focus_channel'):
+            params[key] = int(float(value))
+        elif key == 'roi':
+            params[key] = _parse_roi(value)
+        elif key == 'panel_labels':
+            if isinstance(value, string_types):
+                value = value.split("|")
+            params[key] = [v.strip() for v in value]
+        elif key in ('projections', 'formats'):
+            if isinstance(value, string_types):
+                value = value.split("|")
+            params[key] = [v.strip().lower() for v in value if v.strip()]
+        elif key == 'series':
+            if isinstance(value, string_types):
+                value = value.strip().lower()
+                value = value if value == "all" else value.split("|")
+            elif not isinstance(value, list):
+                value = [value]
+            if value != "all":
+                value = [int(float(v)) for v in value]
+            params[key] = value
+        elif key in ('layout', 'focus_metric'):
+            params[key] = value.strip().lower()
+        elif key in LABEL_COLUMNS:
+            params.setdefault('_labels', {})[LABEL_COLUMNS.index(key)] = value.strip()
+        elif key in ('file', 'pattern'):
+            continue
+        else:
+            raise ValueError("Unknown manifest parameter: {}".format(key))
+    return params
+
+
+class Manifest(object):
+    """Resolved manifest: folders, extensions and per-file parameter rules"""
+
+    def __init__(self, input_dir, output_dir, extensions=None, defaults=None, rules=None, files=None,
+                 workers=None, memory_fraction=0.75, resume=True, retry_failed=False, fingerprint="stat",
+                 recursive=False, watch=False, watch_interval=5.0, watch_settle=10.0, watch_idle=0.0,
+                 contact_sheet=False, contact_columns=6, contact_rows=8, contact_width=320,
+                 queue_dir=None, queue_stale=120.0, queue_attempts=3, leak_check=False):
+        self.input_dir = input_dir
+        self.output_dir = output_dir
+        self.queue_dir = os.path.join(output_dir, queue_dir) if queue_dir else None
+        self.queue_stale = float(queue_stale)
+        self.queue_attempts = int(queue_attempts)
+        self.leak_check = bool(leak_check)
+        self.recursive = bool(recursive)
+        self.watch = bool(watch)
+        self.watch_interval = float(watch_interval)
+        self.watch_settle = float(watch_settle)
+        self.watch_idle = float(watch_idle)
+        self.contact_sheet = bool(contact_sheet)
+        self.contact_columns = int(contact_columns)
+        self.contact_rows = int(contact_rows)
+        self.contact_width = int(contact_width)
+        self.workers = int(workers) if workers else None
+        self.memory_fraction = float(memory_fraction)
+        self.resume = bool(resume)
+        self.retry_failed = bool(retry_failed)
+        if fingerprint not in ("stat", "sha1"):
+            raise ValueError("fingerprint must be 'stat' or 'sha1': {}".format(fingerprint))
+        self.fingerprint = fingerprint
+        self.extensions = [e.lower().lstrip(".") for e in (extensions or ["czi"])]
+        self.defaults = normalize_params(defaults or {})
+        # list of (pattern, params), applied in order
+        self.rules = [(p, normalize_params(r)) for p, r in (rules or [])]
+        self.files = dict((name, normalize_params(r)) for name, r in (files or {}).items())
+
+    def params_for(self, key):
+        """Parameters for one file (relative path or file name): defaults -> wildcard rules -> exact entry"""
+        params = dict(DEFAULT_PARAMS)
+        params['panel_labels'] = list(DEFAULT_LABELS)
+        filename = key.rsplit("/", 1)[-1]
+        layers = [self.defaults]
+        layers += [r for p, r in self.rules
+                   if fnmatch.fnmatch(key.lower(), p.lower()) or fnmatch.fnmatch(filename.lower(), p.lower())]
+        if key in self.files:
+            layers.append(self.files[key])
+        elif filename in self.files:
+            layers.append(self.files[filename])
+        for layer in layers:
+            for name, value in layer.items():
+                if name == '_labels':
+                    for i, label in value.items():
+                        params['panel_labels'][i] = label
+                elif name in ('panel_labels', 'projections', 'formats') or isinstance(value, list):
+                    params[name] = list(value)
+                else:
+                    params[name] = value
+        return params
+
+
+def _load_json(path):
+    with open(path, "r") as f:
+        data = json.load(f)
+    base = os.path.dirname(os.path.abspath(path))
+    input_dir = data.get("input_dir") or base
+    output_dir = data.get("output_dir") or os.path.join(input_dir, "figures")
+    rules = []
+    for rule in data.get("rules", []):
+        rule = dict(rule)
+        rules.append((rule.pop("pattern"), rule))
+    extensions = data.get("extensions") or [data.get("extension", "czi")]
+    return Manifest(input_dir, output_dir, extensions, data.get("defaults"), rules, data.get("files"),
+                    data.get("workers"), data.get("memory_fraction", 0.75), data.get("resume", True),
+                    data.get("retry_failed", False), data.get("fingerprint", "stat"),
+                    data.get("recursive", False), data.get("watch", False), data.get("watch_interval", 5.0),
+                    data.get("watch_settle", 10.0), data.get("watch_idle", 0.0), data.get("contact_sheet", False),
+                    data.get("contact_columns", 6), data.get("contact_rows", 8), data.get("contact_width", 320),
+                    data.get("queue_dir"), data.get("queue_stale", 120.0), data.get("queue_attempts", 3),
+                    data.get("leak_check", False))
+
+
+def _load_csv(path):
+    base = os.path.dirname(os.path.abspath(path))
+    defaults = {}
+    rules = []
+    files = {}
+    with open(path, "r") as f:
+        for row in csv.DictReader(f):
+            name = (row.get("file") or "").strip()
+            if name in ("", "*", "default"):
+                defaults.update(row)
+            elif _has_wildcard(name):
+                rules.append((name, row))
+            else:
+                files[name] = row
+    names = list(files) + [p for p, r in rules]
+    extensions = set()
+    for n in names:
+        filename = n.rsplit("/", 1)[-1]
+        ext = filename.rsplit(".", 1)[-1].lower() if "." in filename else ""
+        if _has_wildcard(ext) or (not ext and _has_wildcard(filename)):
+            # "sample_*" or "*.ti?" may match any format
+            extensions = set(SUPPORTED_EXTENSIONS)
+            break
+        if ext:
+            extensions.add(ext)
+    # entries and patterns in subfolders ("sample_01/cell_3.czi") imply a recursive scan
+    recursive = any("/" in n for n in names)
+    return Manifest(base, os.path.join(base, "figures"), sorted(extensions) or None, defaults, rules, files,
+                    recursive=recursive)
+
+
+def load_manifest(path):
+    """Load a JSON or CSV manifest"""
+    if not os.path.exists(path):
+        raise IOError("Manifest not found: {}".format(path))
+    if path.lower().endswith(".csv"):
+        return _load_csv(path)
+    return _load_json(path)
@@ -0,0 +1,83 @@
+"""
+Background prefetch for the interactive batch loop
+
+While the parameter dialog of file N is open, files N+1..N+depth are opened
+and decoded on a background thread, as long as the heap stays under a
+memory ceiling. Series of multi-series files are opened one at a time with
+Bio-Formats. Finished figures are written in the background by
+ifigure_writer.FigureWriter, so the user never waits on disk I/O between
+images.
+"""
+
+from ij import IJ
+from ij.io import Opener
+from java.util.concurrent import Callable, Executors, ExecutionException
+import os
+
+from ifigure_loader import open_series, series_bytes
+
+
+class _OpenJob(Callable):
+    def __init__(self, item):
+        self.file_path, self.dims = item
+
+    def call(self):
+        if self.dims is None:
+            return Opener().openImage(self.file_path)
+        return open_series(self.file_path, self.dims['series'])
+
+
+class Prefetcher(object):
+    """Opens the next files in the background, get(i) returns the opened ImagePlus of files[i]
+
+    files holds (path, dims) pairs: dims of one series (ifigure_loader.list_series),
+    or None to open the file with Opener.
+    """
+
+    def __init__(self, files, depth=1, memory_fraction=0.5):
+        self.files = files
+        self.depth = depth
+        self.ceiling = IJ.maxMemory() * memory_fraction
+        self.executor = Executors.newSingleThreadExecutor()
+        self.futures = {}
+
+    def _fits(self, item):
+        file_path, dims = item
+        if dims is not None:
+            return IJ.currentMemory() + series_bytes(dims) <= self.ceiling
+        # an opened stack takes about as much heap as the file size (uncompressed formats)
+        return IJ.currentMemory() + os.path.getsize(file_path) <= self.ceiling
+
+    def _schedule(self, i):
+        if i >= len(self.files) or i in self.futures:
+            return
+        if not self._fits(self.files[i]):
+            # no room now, retried on the next get()
+            return
+        self.futures[i] = self.executor.submit(_OpenJob(self.files[i]))
+
+    def get(self, i):
+        """Opened image of files[i] (None if it could not be opened), queues the next ones"""
+        future = self.futures.pop(i, None)
+        if future is None:
+            future = self.executor.submit(_OpenJob(self.files[i]))
+        imp = future.get()
+        for j in range(i + 1, i + 1 + self.depth):
+            self._schedule(j)
+        return imp
+
+    def shutdown(self):
+        """Stop prefetching and close images that were opened but never used"""
+        self.executor.shutdownNow()
+        for future in self.futures.values():
+            if future.isDone() and not future.isCancelled():
+                try:
+                    imp = future.get()
+                except ExecutionException as e:
+                    # an unreadable file that was never reached, logged as the loop logs open errors
+                    IJ.log("ERROR: {}".format(str(e.getCause() or e)))
+                    continue
+                if imp is not None:
+                    imp.close()
+        self.futures = {}
+
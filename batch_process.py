@@ -1,12 +1,48 @@
 """
 Batch processing wrapper for IFigure.py with interactive parameter preview
+
+Headless mode (no dialogs, no windows) is used when a manifest is given
+(see batch_manifest.py for the format) or when ImageJ runs headless:
+
+    ImageJ --headless --jython batch_process.py /path/to/manifest.json
+
+With "watch" in the manifest the run keeps going and processes new files of
+a running acquisition as they are written (see batch_scan.py). With
+"queue_dir" the run is one worker of a queue shared by several machines
+(see batch_queue.py).
+
+The manifest path can also be set with the IFIGURE_MANIFEST environment variable.
 """
 
 from ij import IJ
-from ij.io import Opener, FileSaver, DirectoryChooser
-from ij.gui import GenericDialog, WaitForUserDialog, NonBlockingGenericDialog
-from ij.plugin import ChannelSplitter
+from ij.io import Opener, DirectoryChooser
+from ij.gui import GenericDialog, WaitForUserDialog, NonBlockingGenericDialog, Roi
+from java.awt import GraphicsEnvironment
 import os
+import sys
+import time
+
+# Search in the same directory as this script
+script_dir = os.path.dirname(os.path.abspath(__file__))
+if script_dir not in sys.path:
+    sys.path.append(script_dir)
+
+from batch_manifest import load_manifest, SUPPORTED_EXTENSIONS
+from batch_scan import find_files, relative_key, mirror_dir, FolderWatcher
+from batch_workers import WorkerPool, estimate_job_bytes
+from batch_state import BatchState, DONE, FAILED
+from batch_queue import queue_for, work, status_lines
+from ifigure_loader import (bioformats_available, list_series, figure_series, series_suffix,
+                            load_figure_planes, load_focus_planes)
+from ifigure_tiled import build_figures_tiled, needed_bytes, MB
+from ifigure_core import build_figure, build_figures, auto_focus, middle_slice, resolve_params
+from ifigure_engine import STATISTICS
+from ifigure_preview import FigurePreview, PreviewListener
+from batch_prefetch import Prefetcher
+from batch_contact import ContactSheet
+from ifigure_writer import FigureWriter, save_figure, DEFAULT_JPEG_QUALITY
+from ifigure_metrics import StageTimer, RunReport
+from ifigure_workspace import Workspace
 
 # Store selected folders and dialog reference
 selected_input = [None]
@@ -35,245 +71,650 @@ def browse_output_folder(event):
             gd_reference[0].getStringFields()[1].setText(folder)
         IJ.log("Output folder selected: {}".format(folder))
 
-#----------- Selecting input and output folders
-gd_intro = GenericDialog("Batch Processing - Folder Setup")
-gd_intro.addMessage(" ")
-gd_intro.addMessage("Select folders for batch processing:")
-gd_intro.addMessage(" ")
-gd_intro.addStringField("Input folder:", "", 50)
-gd_intro.addButton("Browse Input Folder", browse_input_folder)
-gd_intro.addMessage(" ")
-gd_intro.addStringField("Output folder:", "", 50)
-gd_intro.addButton("Browse Output Folder", browse_output_folder)
-gd_intro.addMessage(" ")
-
-# Store reference to dialog for button callbacks
-gd_reference[0] = gd_intro
-
-gd_intro.showDialog()
-
-if gd_intro.wasCanceled():
-    exit()
-
-# Get the folders - first try the text fields, then fallback to button selections
-input_dir = gd_intro.getNextString().strip()
-output_dir = gd_intro.getNextString().strip()
-
-# Use button selections if text fields are empty
-if not input_dir:
-    input_dir = selected_input[0]
-if not output_dir:
-    output_dir = selected_output[0]
-
-if input_dir is None or input_dir == "":
-    IJ.log("Input folder not selected. Cancelled.")
-    exit()
-
-if output_dir is None or output_dir == "":
-    IJ.log("Output folder not selected. Cancelled.")
-    exit()
-
-IJ.log("Input folder: {}".format(input_dir))
-IJ.log("Output folder: {}".format(output_dir))
-
-#----------- file format
-gd_setup = GenericDialog("Batch Process - File Format")
-gd_setup.addMessage("Select file format to process:")
-gd_setup.addChoice("File format:", ["czi", "tif", "tiff", "lsm", "nd2"], "czi")
-gd_setup.showDialog()
-
-if gd_setup.wasCanceled():
-    exit()
-
-file_ext = gd_setup.getNextChoice()
-
-# Validate directories
-if not os.path.exists(input_dir):
-    IJ.error("Input folder does not exist: {}".format(input_dir))
-    raise SystemExit
-
-# Create output directory if it doesn't exist
-if not os.path.exists(output_dir):
-    os.makedirs(output_dir)
-
-# Get list of files matching pattern
-files = []
-for f in os.listdir(input_dir):
-    if f.lower().endswith("." + file_ext):
-        files.append(os.path.join(input_dir, f))
-
-if len(files) == 0:
-    IJ.error("No files found with extension .{} in {}".format(file_ext, input_dir))
-    raise SystemExit
-
-IJ.log("Found {} files to process".format(len(files)))
-
-#----------- BATCH processing
-processed = 0
-failed = 0
-skip_all = False
-
-# default labels corresponding to previously used channels on airyscan, might need to be reordered in the future
-last_label_ch1 = "Cyan"
-last_label_ch2 = "Far red"
-last_label_ch3 = "Red"
-last_label_merged = "Merged"
-
-for idx, file_path in enumerate(files, 1):
-    filename = os.path.basename(file_path)
+# file name suffix of each figure layout (see ifigure_core.LAYOUTS)
+LAYOUT_SUFFIXES = {
+    'combined': "_figure",
+    'single': "_figure_row",
+}
+
+def output_base_for(filename, output_dir, layout="combined"):
+    """Output path without extension, ifigure_writer adds one per format"""
+    output_name = filename.split('.')[0] + LAYOUT_SUFFIXES[layout]
+    return os.path.join(output_dir, output_name)
+
+# output format checkboxes of the interactive setup dialog
+OUTPUT_FORMATS = ["jpeg", "png", "tiff"]
+
+# checkbox labels of the projection rows, in ifigure_engine.STATISTICS order
+PROJECTION_LABELS = ["Max", "Mean", "Sum", "SD", "Median"]
+
+def dialog_params(gd):
+    """Current values of the parameter dialog as build_figure parameters (live preview)"""
+    numbers = [float(tf.getText()) for tf in gd.getNumericFields()]
+    labels = [tf.getText() for tf in gd.getStringFields()]
+    checked = [cb.getState() for cb in gd.getCheckboxes()]
+    return {
+        'blur_sigma': numbers[0],
+        'zslice': int(numbers[1]),
+        'z_start': int(numbers[2]),
+        'z_end': int(numbers[3]),
+        'normalize': checked[len(STATISTICS)],
+        'normalize_low': numbers[4],
+        'normalize_high': 100.0 - numbers[4],
+        'panel_labels': labels,
+        'projections': [s for s, on in zip(STATISTICS, checked) if on],
+    }
+
+def log_report(report, output_dir):
+    """Write the per-file stage report and log the stage summary"""
     IJ.log(" ")
-    IJ.log("[{}/{}] Processing: {}".format(idx, len(files), filename))
-    
-    if skip_all:
-        IJ.log("Skipped (user selected skip all)")
-        continue
-    
+    for line in report.summary_lines():
+        IJ.log(line)
     try:
-        # Open image
-        opener = Opener()
-        imp = opener.openImage(file_path)
-        imp.show()
-        
-        channels = imp.getNChannels()
-        slices_img = imp.getNSlices()
-        roi = imp.getRoi()
-        
-        # Get the middle z slice as starting position
-        middle_slice = (slices_img + 1) // 2
-        
-        # Create non-blocking dialog with parameters
-        gd_params = NonBlockingGenericDialog("Image {}/{} - {}".format(idx, len(files), filename))
-        gd_params.addMessage("Set parameters for processing:")
-        gd_params.addMessage(" ")
-        gd_params.addSlider("Gaussian Blur Sigma:", 0.0, 5.0, 0.0)
-        gd_params.addSlider("Z-slice to use:", 1, slices_img, middle_slice)
-        gd_params.addMessage(" ")
-        gd_params.addMessage("Z-Projection range (for bottom row):")
-        gd_params.addSlider("Start slice:", 1, slices_img, 1)
-        gd_params.addSlider("End slice:", 1, slices_img, slices_img)
-        gd_params.addMessage(" ")
-        gd_params.addMessage("Channel labels (top row panels):")
-        gd_params.addStringField("Channel 1 (Cyan):", last_label_ch1, 20)
-        gd_params.addStringField("Channel 2 (Far red):", last_label_ch2, 20)
-        gd_params.addStringField("Channel 3 (Red):", last_label_ch3, 20)
-        gd_params.addStringField("Merged:", last_label_merged, 20)
-        gd_params.addMessage(" ")
-        gd_params.addChoice("Action:", ["Process", "Skip this", "Skip all remaining"], "Process")
-        gd_params.showDialog()
-        
-        if gd_params.wasCanceled():
-            IJ.run("Close All", "")
-            IJ.log("Batch processing cancelled by user")
-            exit()
-        
-        blur_sigma = gd_params.getNextNumber()
-        z_slice = int(gd_params.getNextNumber())
-        z_start = int(gd_params.getNextNumber())
-        z_end = int(gd_params.getNextNumber())
-        label_ch1 = gd_params.getNextString()
-        label_ch2 = gd_params.getNextString()
-        label_ch3 = gd_params.getNextString()
-        label_merged = gd_params.getNextString()
-        action = gd_params.getNextChoice()
-        
-        # Handle skip options
-        if action == "Skip this":
-            IJ.run("Close All", "")
-            IJ.log("Skipped by user")
-            continue
-        elif action == "Skip all remaining":
-            skip_all = True
-            IJ.run("Close All", "")
-            IJ.log("Skipped (skip all selected)")
-            continue
-        
-        # Handle skip options
-        if action == "Skip this":
-            IJ.run("Close All", "")
-            IJ.log("Skipped by user")
-            continue
-        elif action == "Skip all remaining":
-            skip_all = True
-            IJ.run("Close All", "")
-            IJ.log("Skipped (skip all selected)")
+        csv_path, json_path = report.write(output_dir)
+        IJ.log("Run report: {}".format(csv_path))
+    except (IOError, OSError) as e:
+        IJ.log("Could not write the run report: {}".format(e))
+
+def log_contact_sheet(sheet):
+    """Write the last contact sheet page and log all pages"""
+    try:
+        for path in sheet.close():
+            IJ.log("Contact sheet: {}".format(path))
+    except IOError as e:
+        IJ.log("Could not write the contact sheet: {}".format(e))
+
+def log_summary(processed, failed, output_dir):
+    IJ.log(" ")
+    IJ.log("="*60)
+    IJ.log("Batch processing complete!")
+    IJ.log("="*60)
+    IJ.log("Processed: {} files".format(processed))
+    IJ.log("Failed:    {} files".format(failed))
+    IJ.log("Output:    {}".format(output_dir))
+    IJ.log("="*60)
+
+def find_manifest():
+    """Manifest path from the command line or the IFIGURE_MANIFEST environment variable"""
+    args = [a for a in getattr(sys, 'argv', [])[1:] if a]
+    if args:
+        return args[0]
+    return os.environ.get("IFIGURE_MANIFEST")
+
+#----------- HEADLESS processing (manifest driven, no dialogs, no windows)
+def render_headless_series(file_path, manifest_params, dims, output_base, job_label, timer, workspace, sheet=None):
+    """Build and save the figures of one series (dims None: whole file through Opener), returns the paths
+
+    Everything it opens and builds is tracked by workspace, which the caller closes.
+    """
+    imp = None
+    planes = ()
+    tiled = False
+    with timer.stage("open"):
+        if dims is not None:
+            # crop-on-read: only the ROI and the planes the figure needs are loaded
+            params = resolve_params(manifest_params, dims['slices'])
+            budget_mb = params['tile_budget_mb']
+            # mosaics whose planes don't fit in the tile budget are rendered in tiles
+            tiled = budget_mb > 0 and needed_bytes(params, dims) > budget_mb * MB
+            if params['autofocus']:
+                # the z-slice decides which planes are read, so it is picked first
+                focus_imp = workspace.track(
+                    load_focus_planes(file_path, params, dims, budget_mb * MB if tiled else None))
+                params['zslice'] = auto_focus(focus_imp, dict(params, focus_channel=1), None, timer)
+                workspace.release(focus_imp)
+                params['autofocus'] = False
+            if not tiled:
+                planes = workspace.track(load_figure_planes(file_path, params, dims, dims['series']))
+        else:
+            imp = workspace.track(Opener().openImage(file_path))
+            if imp is None:
+                raise IOError("Could not open {}".format(file_path))
+            params = resolve_params(manifest_params, imp.getNSlices())
+            if params['roi'] is not None:
+                x, y, w, h = params['roi']
+                imp.setRoi(Roi(x, y, w, h))
+
+    IJ.log("{} Parameters - Blur: {}, Z-slice: {}, Z-range: {}-{}".format(
+        job_label, params['blur_sigma'], "auto" if params['autofocus'] else params['zslice'],
+        params['z_start'], params['z_end']))
+
+    if tiled:
+        IJ.log("{} Tiled mode ({} MB tile budget)".format(job_label, params['tile_budget_mb']))
+        figures = build_figures_tiled(file_path, params, dims, params['tile_budget_mb'], timer, workspace)
+    else:
+        figures = build_figures(imp, params, planes or None, timer=timer, workspace=workspace)
+    # the stack is not needed for saving, its heap goes to the other workers
+    workspace.release([imp, planes])
+
+    # written on this worker, the other workers keep processing meanwhile
+    outputs = []
+    for layout, fig in sorted(figures.items()):
+        with timer.stage("save"):
+            paths = save_figure(fig, output_base(layout), params['formats'], params['jpeg_quality'])
+        outputs.extend(paths)
+        for path in paths:
+            IJ.log("{} Saved: {}".format(job_label, path))
+    if sheet is not None:
+        with timer.stage("contact"):
+            sheet.add(figures.get("combined") or figures["single"], timer.key)
+    IJ.log("{} Times - {}".format(job_label, timer.summary()))
+    return outputs
+
+def process_headless_file(file_path, key, manifest, output_dir, job_label, state, report, sheet=None):
+    """Build and save the figures of one file, one per series, returns True on success (runs on a worker thread)"""
+    filename = os.path.basename(file_path)
+    IJ.log("{} Processing".format(job_label))
+
+    # the state records the manifest parameters, before z values are resolved
+    manifest_params = manifest.params_for(key)
+    # without Bio-Formats Opener reads the first series only
+    series = [None]
+    if bioformats_available():
+        try:
+            series = figure_series(list_series(file_path), manifest_params['series'])
+        except Exception as e:
+            IJ.log("{} ERROR: {}".format(job_label, str(e)))
+            state.record(key, file_path, manifest_params, FAILED, error=str(e))
+            return False
+        if not series:
+            IJ.log("{} No series selected (series: {})".format(job_label, manifest_params['series']))
+        elif len(series) > 1:
+            IJ.log("{} {} series".format(job_label, len(series)))
+
+    outputs = []
+    errors = []
+    for dims in series:
+        # single-series files keep the plain figure names
+        suffix = series_suffix(dims) if len(series) > 1 else ""
+        label = job_label + (" " + suffix.lstrip("_") if suffix else "")
+        timer = StageTimer(key + ("#" + suffix.lstrip("_") if suffix else ""))
+        workspace = Workspace(manifest.leak_check)
+        try:
+            try:
+                outputs.extend(render_headless_series(
+                    file_path, manifest_params, dims,
+                    lambda layout: output_base_for(filename, output_dir, layout) + suffix, label, timer,
+                    workspace, sheet))
+            finally:
+                # closed once the render's locals are gone, so only real leaks keep its images alive
+                workspace.close(timer)
+                if workspace.leaked_bytes:
+                    IJ.log("{} Leaked {:.1f} MB".format(label, workspace.leaked_bytes / float(MB)))
+            report.add(timer, DONE)
+        except Exception as e:
+            IJ.log("{} ERROR: {}".format(label, str(e)))
+            errors.append(suffix.lstrip("_") + ": " + str(e) if suffix else str(e))
+            report.add(timer, FAILED)
+
+    if errors:
+        state.record(key, file_path, manifest_params, FAILED, outputs, "; ".join(errors))
+        return False
+    state.record(key, file_path, manifest_params, DONE, outputs)
+    return True
+
+def files_to_process(files, manifest, state):
+    """Resume: drop files already processed with the same parameters (or keep only failures)"""
+    if manifest.retry_failed:
+        todo = [f for f in files if state.status(relative_key(f, manifest.input_dir)) == FAILED]
+        IJ.log("Retrying {} failed files".format(len(todo)))
+        return todo
+    if not manifest.resume:
+        return files
+    todo = []
+    for f in files:
+        key = relative_key(f, manifest.input_dir)
+        if not state.is_up_to_date(key, f, manifest.params_for(key)):
+            todo.append(f)
+    if len(todo) < len(files):
+        IJ.log("Skipped (unchanged): {} files".format(len(files) - len(todo)))
+    return todo
+
+def watch_folder(manifest, submit, idle=None):
+    """Submit new files of the input tree once written, until watch_idle minutes pass without any
+
+    idle() is called after every rescan that found nothing new.
+    """
+    watcher = FolderWatcher(manifest.input_dir, manifest.extensions, manifest.recursive,
+                            [manifest.output_dir], manifest.watch_interval, manifest.watch_settle)
+    IJ.log("Watching {} for new files (every {} s{})".format(
+        manifest.input_dir, manifest.watch_interval,
+        ", stops after {} idle minutes".format(manifest.watch_idle) if manifest.watch_idle > 0 else ""))
+    last_new = time.time()
+    try:
+        while True:
+            ready = watcher.ready()
+            for file_path in ready:
+                submit(file_path)
+            if not ready and idle is not None:
+                idle()
+            if ready or watcher.waiting():
+                last_new = time.time()
+            elif manifest.watch_idle > 0 and time.time() - last_new > manifest.watch_idle * 60:
+                IJ.log("No new files for {} minutes, stopping".format(manifest.watch_idle))
+                break
+            watcher.wait()
+    finally:
+        watcher.close()
+
+def run_queue_worker(manifest):
+    """One worker of a shared queue: claims files until every queued file has a result
+
+    The queue's results take the place of the state file, which several
+    machines can't write at once; "resume" and "retry_failed" apply when the
+    coordinator queues the files (batch_queue.py enqueue).
+    """
+    input_dir = manifest.input_dir
+    output_dir = manifest.output_dir
+    queue = queue_for(manifest)
+    IJ.log("Queue:         {} (worker {})".format(manifest.queue_dir, queue.worker))
+
+    if not manifest.watch:
+        # files nobody queued yet; in watch mode the coordinator queues them as they are written
+        files = find_files(input_dir, manifest.extensions, manifest.recursive, [output_dir])
+        added = sum(1 for f in files if queue.add(relative_key(f, input_dir)))
+        IJ.log("Found {} files, {} newly queued".format(len(files), added))
+
+    pool = WorkerPool(manifest.workers, manifest.memory_fraction)
+    IJ.log("Workers: {}, memory budget: {} MB".format(pool.workers, pool.budget_mb))
+
+    # every worker writes its own report and contact sheet, named after it
+    report = RunReport(queue.worker)
+    sheet = None
+    if manifest.contact_sheet:
+        sheet = ContactSheet(output_dir, manifest.contact_columns, manifest.contact_rows,
+                             manifest.contact_width, tag=queue.worker)
+
+    def process(key):
+        file_path = os.path.join(input_dir, *key.split("/"))
+        job_label = "[{}] {}".format(queue.worker, key)
+        pool.submit(process_headless_file, estimate_job_bytes(file_path, manifest.params_for(key)),
+                    file_path, key, manifest, mirror_dir(file_path, input_dir, output_dir),
+                    job_label, queue, report, sheet).get()
+
+    # one claiming thread per pool worker, the pool keeps the memory budget
+    work(queue, process, pool.workers, manifest.watch_idle if manifest.watch else None, IJ.log)
+    pool.shutdown()
+
+    if sheet is not None:
+        log_contact_sheet(sheet)
+    log_report(report, output_dir)
+    IJ.log(" ")
+    for line in status_lines(queue):
+        IJ.log(line)
+    log_summary(queue.counts[DONE], queue.counts[FAILED], output_dir)
+
+def run_headless(manifest_path):
+    if not manifest_path:
+        IJ.log("Headless mode requires a manifest (command line argument or IFIGURE_MANIFEST)")
+        return
+
+    manifest = load_manifest(manifest_path)
+    input_dir = manifest.input_dir
+    output_dir = manifest.output_dir
+
+    IJ.log("Manifest:      {}".format(manifest_path))
+    IJ.log("Input folder:  {}{}".format(input_dir, " (with subfolders)" if manifest.recursive else ""))
+    IJ.log("Output folder: {}".format(output_dir))
+
+    if not os.path.exists(input_dir):
+        IJ.log("Input folder does not exist: {}".format(input_dir))
+        return
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    if manifest.queue_dir:
+        run_queue_worker(manifest)
+        return
+
+    #----------- resume: skip files already processed with the same parameters
+    state = BatchState(output_dir, manifest.fingerprint)
+
+    pool = WorkerPool(manifest.workers, manifest.memory_fraction)
+    IJ.log("Workers: {}, memory budget: {} MB".format(pool.workers, pool.budget_mb))
+
+    report = RunReport()
+    sheet = None
+    if manifest.contact_sheet:
+        sheet = ContactSheet(output_dir, manifest.contact_columns, manifest.contact_rows, manifest.contact_width)
+    futures = []
+
+    def submit(file_path, label):
+        key = relative_key(file_path, input_dir)
+        job_label = "[{}] {}".format(label, key)
+        futures.append(pool.submit(process_headless_file, estimate_job_bytes(file_path, manifest.params_for(key)),
+                                   file_path, key, manifest, mirror_dir(file_path, input_dir, output_dir),
+                                   job_label, state, report, sheet))
+
+    def submit_new(file_path):
+        key = relative_key(file_path, input_dir)
+        if manifest.resume and state.is_up_to_date(key, file_path, manifest.params_for(key)):
+            IJ.log("Skipped (unchanged): {}".format(key))
+            return
+        submit(file_path, len(futures) + 1)
+
+    if manifest.watch:
+        # every file goes through the watcher, including the ones already there, they may still be written
+        # the contact sheet is brought up to date whenever the acquisition pauses
+        watch_folder(manifest, submit_new, sheet.flush if sheet is not None else None)
+    else:
+        files = find_files(input_dir, manifest.extensions, manifest.recursive, [output_dir])
+        IJ.log("Found {} files".format(len(files)))
+        files = files_to_process(files, manifest, state)
+        IJ.log("{} files to process".format(len(files)))
+        for idx, file_path in enumerate(files, 1):
+            submit(file_path, "{}/{}".format(idx, len(files)))
+
+    processed = 0
+    failed = 0
+    for future in futures:
+        if future.get():
+            processed += 1
+        else:
+            failed += 1
+    pool.shutdown()
+
+    if sheet is not None:
+        log_contact_sheet(sheet)
+    log_report(report, output_dir)
+    log_summary(processed, failed, output_dir)
+
+#----------- INTERACTIVE processing
+def run_interactive():
+    #----------- Selecting input and output folders
+    gd_intro = GenericDialog("Batch Processing - Folder Setup")
+    gd_intro.addMessage(" ")
+    gd_intro.addMessage("Select folders for batch processing:")
+    gd_intro.addMessage(" ")
+    gd_intro.addStringField("Input folder:", "", 50)
+    gd_intro.addButton("Browse Input Folder", browse_input_folder)
+    gd_intro.addMessage(" ")
+    gd_intro.addStringField("Output folder:", "", 50)
+    gd_intro.addButton("Browse Output Folder", browse_output_folder)
+    gd_intro.addMessage(" ")
+
+    # Store reference to dialog for button callbacks
+    gd_reference[0] = gd_intro
+
+    gd_intro.showDialog()
+
+    if gd_intro.wasCanceled():
+        exit()
+
+    # Get the folders - first try the text fields, then fallback to button selections
+    input_dir = gd_intro.getNextString().strip()
+    output_dir = gd_intro.getNextString().strip()
+
+    # Use button selections if text fields are empty
+    if not input_dir:
+        input_dir = selected_input[0]
+    if not output_dir:
+        output_dir = selected_output[0]
+
+    if input_dir is None or input_dir == "":
+        IJ.log("Input folder not selected. Cancelled.")
+        exit()
+
+    if output_dir is None or output_dir == "":
+        IJ.log("Output folder not selected. Cancelled.")
+        exit()
+
+    IJ.log("Input folder: {}".format(input_dir))
+    IJ.log("Output folder: {}".format(output_dir))
+
+    #----------- file format
+    gd_setup = GenericDialog("Batch Process - File Format")
+    gd_setup.addMessage("Select file format to process:")
+    gd_setup.addChoice("File format:", SUPPORTED_EXTENSIONS, "czi")
+    gd_setup.addCheckbox("Include subfolders (same subfolders in the output folder)", False)
+    if bioformats_available():
+        gd_setup.addCheckbox("Every series of multi-series files (CZI scenes, ND2 positions)", True)
+    gd_setup.addMessage(" ")
+    gd_setup.addMessage("Open the next files in the background while the current one is tuned:")
+    gd_setup.addNumericField("Prefetch next files:", 1, 0)
+    gd_setup.addNumericField("Prefetch memory limit (% of max):", 50, 0)
+    gd_setup.addMessage(" ")
+    gd_setup.addMessage("Output (several formats can be written from one render):")
+    gd_setup.addCheckboxGroup(1, len(OUTPUT_FORMATS), [f.upper() for f in OUTPUT_FORMATS],
+                              [f == "jpeg" for f in OUTPUT_FORMATS])
+    gd_setup.addNumericField("JPEG quality (0-100):", DEFAULT_JPEG_QUALITY, 0)
+    gd_setup.addCheckbox("Contact sheet of all figures (QC overview)", False)
+    gd_setup.addCheckbox("Start the z-slice slider at the sharpest slice of channel 1", False)
+    gd_setup.showDialog()
+
+    if gd_setup.wasCanceled():
+        exit()
+
+    file_ext = gd_setup.getNextChoice()
+    recursive = gd_setup.getNextBoolean()
+    all_series = bioformats_available() and gd_setup.getNextBoolean()
+    prefetch_depth = max(0, int(gd_setup.getNextNumber()))
+    prefetch_memory = max(1.0, min(gd_setup.getNextNumber(), 100.0)) / 100.0
+    jpeg_quality = max(0, min(int(gd_setup.getNextNumber()), 100))
+    formats = [f for f in OUTPUT_FORMATS if gd_setup.getNextBoolean()] or ["jpeg"]
+    contact_sheet = gd_setup.getNextBoolean()
+    start_in_focus = gd_setup.getNextBoolean()
+
+    # Validate directories
+    if not os.path.exists(input_dir):
+        IJ.error("Input folder does not exist: {}".format(input_dir))
+        raise SystemExit
+
+    # Create output directory if it doesn't exist
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    # Get list of files matching pattern
+    files = find_files(input_dir, [file_ext], recursive, [output_dir])
+
+    if len(files) == 0:
+        IJ.error("No files found with extension .{} in {}".format(file_ext, input_dir))
+        raise SystemExit
+
+    IJ.log("Found {} files to process".format(len(files)))
+
+    # (path, series dims) per figure; dims None = whole file through Opener (first series)
+    items = []
+    for file_path in files:
+        series = []
+        if all_series:
+            try:
+                series = figure_series(list_series(file_path))
+            except Exception as e:
+                IJ.log("Could not read the series of {}: {}".format(file_path, e))
+        if len(series) > 1:
+            IJ.log("{}: {} series".format(relative_key(file_path, input_dir), len(series)))
+            items.extend((file_path, dims) for dims in series)
+        else:
+            items.append((file_path, None))
+
+    #----------- BATCH processing
+    processed = 0
+    failed = 0
+    skip_all = False
+
+    # default labels corresponding to previously used channels on airyscan, might need to be reordered in the future
+    last_label_ch1 = "Cyan"
+    last_label_ch2 = "Far red"
+    last_label_ch3 = "Red"
+    last_label_merged = "Merged"
+    last_projections = ["max"]
+    last_normalize = False
+    last_clip = 0.0
+
+    # next files are opened while the dialog is open, figures are saved in the background
+    prefetcher = Prefetcher(items, prefetch_depth, prefetch_memory)
+    writer = FigureWriter(formats, jpeg_quality)
+    sheet = ContactSheet(output_dir) if contact_sheet else None
+    report = RunReport()
+    timers = []
+
+    for idx, (file_path, dims) in enumerate(items, 1):
+        filename = os.path.basename(file_path)
+        suffix = series_suffix(dims) if dims is not None else ""
+        key = relative_key(file_path, input_dir) + ("#" + suffix.lstrip("_") if suffix else "")
+        IJ.log(" ")
+        IJ.log("[{}/{}] Processing: {}".format(idx, len(items), key))
+
+        if skip_all:
+            IJ.log("Skipped (user selected skip all)")
             continue
-        
-        # Validate ranges
-        z_slice = max(1, min(z_slice, slices_img))
-        z_start = max(1, min(z_start, slices_img))
-        z_end = max(z_start, min(z_end, slices_img))
-        
-        IJ.log("Parameters - Blur: {}, Z-slice: {}, Z-range: {}-{}".format(blur_sigma, z_slice, z_start, z_end))
-        
-        # Save labels for next image
-        last_label_ch1 = label_ch1
-        last_label_ch2 = label_ch2
-        last_label_ch3 = label_ch3
-        last_label_merged = label_merged
-        
-        # Create execution context with parameters
-        exec_context = {
-            'IJ': IJ,
-            'Opener': Opener,
-            'FileSaver': FileSaver,
-            'ChannelSplitter': ChannelSplitter,
-            'imp': imp,
-            'roi': roi,
-            'channels': channels,
-            'slices': slices_img,
-            'blur_sigma': blur_sigma,
-            'zslice': z_slice,
-            'z_start': z_start,
-            'z_end': z_end,
-            'panel_labels': [label_ch1, label_ch2, label_ch3, label_merged],
-            '__name__': '__main__',
-            'exit': exit,
-        }
-        
-        # Search in the same directory as this script
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        ifigure_path = os.path.join(script_dir, "IFigure_batch.py")
-        
-        if not os.path.exists(ifigure_path):
-            IJ.error("IFigure_batch.py not found in: {}".format(script_dir))
-            raise SystemExit
-        
-        with open(ifigure_path, 'r') as f:
-            ifigure_code = f.read()
-        
-        exec(ifigure_code, exec_context)
-        
-        # Get the result image (fig_combined)
-        result_img = IJ.getImage()
-        
-        # Save the combined figure
-        output_name = filename.split('.')[0] + "_figure.jpeg"
-        output_path = os.path.join(output_dir, output_name)
-        
-        fs = FileSaver(result_img)
-        fs.saveAsJpeg(output_path)
-        
-        IJ.log("Saved: {}".format(output_path))
-        processed += 1
-        
-        # Close all windows for this image
-        IJ.run("Close All", "")
-        
-    except Exception as e:
-        IJ.log("ERROR: {}".format(str(e)))
-        failed += 1
+
+        # the image, its figure and everything in between, freed when the file is done
+        workspace = Workspace()
         try:
-            IJ.run("Close All", "")
-        except:
-            pass
-        continue
-
-# ===== STEP 6: Summary =====
-IJ.log(" ")
-IJ.log("="*60)
-IJ.log("Batch processing complete!")
-IJ.log("="*60)
-IJ.log("Processed: {} files".format(processed))
-IJ.log("Failed:    {} files".format(failed))
-IJ.log("Output:    {}".format(output_dir))
-IJ.log("="*60)
+            # Open image (usually already opened by the prefetcher)
+            timer = StageTimer(key)
+            with timer.stage("open"):
+                imp = workspace.track(prefetcher.get(idx - 1))
+            if imp is None:
+                raise IOError("Could not open {}".format(file_path))
+            imp.show()
+
+            slices_img = imp.getNSlices()
+
+            # Get the sharpest (or the middle) z slice as starting position
+            if start_in_focus and slices_img > 1:
+                start_slice = auto_focus(imp, {'focus_channel': 1, 'focus_metric': "laplacian"}, None, timer)
+                IJ.log("Sharpest z-slice: {}".format(start_slice))
+            else:
+                start_slice = middle_slice(slices_img)
+
+            # Create non-blocking dialog with parameters
+            gd_params = NonBlockingGenericDialog("Image {}/{} - {}{}".format(idx, len(items), filename, suffix))
+            gd_params.addMessage("Set parameters for processing:")
+            gd_params.addMessage(" ")
+            gd_params.addSlider("Gaussian Blur Sigma:", 0.0, 5.0, 0.0)
+            gd_params.addSlider("Z-slice to use:", 1, slices_img, start_slice)
+            gd_params.addMessage(" ")
+            gd_params.addMessage("Z-Projection range (for bottom row):")
+            gd_params.addSlider("Start slice:", 1, slices_img, 1)
+            gd_params.addSlider("End slice:", 1, slices_img, slices_img)
+            gd_params.addCheckboxGroup(1, len(STATISTICS), PROJECTION_LABELS,
+                                       [s in last_projections for s in STATISTICS], ["Projection rows:"])
+            gd_params.addCheckbox("Normalize top row channels", last_normalize)
+            gd_params.addNumericField("Clip % at each end:", last_clip, 2)
+            gd_params.addMessage(" ")
+            gd_params.addMessage("Channel labels (top row panels):")
+            gd_params.addStringField("Channel 1 (Cyan):", last_label_ch1, 20)
+            gd_params.addStringField("Channel 2 (Far red):", last_label_ch2, 20)
+            gd_params.addStringField("Channel 3 (Red):", last_label_ch3, 20)
+            gd_params.addStringField("Merged:", last_label_merged, 20)
+            gd_params.addMessage(" ")
+            gd_params.addChoice("Action:", ["Process", "Skip this", "Skip all remaining"], "Process")
+
+            # live preview of the figure from a downsampled pyramid, full resolution only for saving
+            preview = FigurePreview(imp)
+            gd_params.addDialogListener(PreviewListener(preview, dialog_params))
+            try:
+                preview.render(dialog_params(gd_params))
+            except (ValueError, IndexError):
+                pass
+            gd_params.showDialog()
+            preview.close()
+
+            if gd_params.wasCanceled():
+                workspace.close()
+                prefetcher.shutdown()
+                writer.shutdown()
+                IJ.log("Batch processing cancelled by user")
+                exit()
+
+            blur_sigma = gd_params.getNextNumber()
+            z_slice = int(gd_params.getNextNumber())
+            z_start = int(gd_params.getNextNumber())
+            z_end = int(gd_params.getNextNumber())
+            label_ch1 = gd_params.getNextString()
+            label_ch2 = gd_params.getNextString()
+            label_ch3 = gd_params.getNextString()
+            label_merged = gd_params.getNextString()
+            clip = max(0.0, min(gd_params.getNextNumber(), 49.0))
+            projections = [s for s in STATISTICS if gd_params.getNextBoolean()]
+            normalize = gd_params.getNextBoolean()
+            action = gd_params.getNextChoice()
+
+            # Handle skip options
+            if action == "Skip this":
+                workspace.close()
+                IJ.log("Skipped by user")
+                continue
+            elif action == "Skip all remaining":
+                skip_all = True
+                workspace.close()
+                prefetcher.shutdown()
+                IJ.log("Skipped (skip all selected)")
+                continue
+
+            # Validate ranges
+            params = resolve_params({
+                'blur_sigma': blur_sigma,
+                'zslice': z_slice,
+                'z_start': z_start,
+                'z_end': z_end,
+                'panel_labels': [label_ch1, label_ch2, label_ch3, label_merged],
+                'projections': projections or ["max"],
+                'normalize': normalize,
+                'normalize_low': clip,
+                'normalize_high': 100.0 - clip,
+            }, slices_img)
+
+            IJ.log("Parameters - Blur: {}, Z-slice: {}, Z-range: {}-{}, Projections: {}".format(
+                params['blur_sigma'], params['zslice'], params['z_start'], params['z_end'],
+                ", ".join(params['projections'])))
+
+            # Save labels for next image
+            last_label_ch1 = label_ch1
+            last_label_ch2 = label_ch2
+            last_label_ch3 = label_ch3
+            last_label_merged = label_merged
+            last_projections = params['projections']
+            last_normalize = normalize
+            last_clip = clip
+
+            result_img = build_figure(imp, params, timer=timer, workspace=workspace)
+            if sheet is not None:
+                with timer.stage("contact"):
+                    sheet.add(result_img, key)
+
+            # Save the combined figure (encoded and written in the background, the writer closes it)
+            workspace.keep(result_img)
+            writer.write(result_img, output_base_for(filename, mirror_dir(file_path, input_dir, output_dir)) + suffix,
+                         timer)
+            timers.append(timer)
+            processed += 1
+
+            # Close the image window and free the intermediates of this image
+            workspace.close(timer)
+
+        except Exception as e:
+            IJ.log("ERROR: {}".format(str(e)))
+            failed += 1
+            report.add(timer, FAILED)
+            try:
+                workspace.close()
+            except:
+                pass
+            continue
+
+    prefetcher.shutdown()
+    # wait for the last figures to be written
+    failed_saves = set(id(timer) for timer in writer.shutdown())
+    processed -= len(failed_saves)
+    failed += len(failed_saves)
+
+    # rows are added once the background saves (timed as "save") are done
+    for timer in timers:
+        report.add(timer, FAILED if id(timer) in failed_saves else DONE)
+    if sheet is not None:
+        log_contact_sheet(sheet)
+    log_report(report, output_dir)
+
+    # ===== STEP 6: Summary =====
+    log_summary(processed, failed, output_dir)
+
+
+manifest_path = find_manifest()
+if manifest_path or GraphicsEnvironment.isHeadless():
+    run_headless(manifest_path)
+else:
+    run_interactive()
@@ -0,0 +1,661 @@
+"""
+Work queue in a shared folder, for batches spread over several machines
+
+Any number of headless workers (Fiji workstations, Linux boxes) mounting the
+same NAS take their files from one queue folder:
+
+    <queue_dir>/jobs/<id>.json       one per input file, {"key": path relative to the input folder}
+    <queue_dir>/claims/<id>.json     lock of the worker processing the file
+    <queue_dir>/results/<id>.json    per-file status: done/failed, outputs, error, worker
+    <queue_dir>/stale/<id>.<n>       claims taken back from lost workers
+    <queue_dir>/workers/<name>.json  heartbeat and counters of every worker
+
+A worker claims a job by creating its claim file with O_CREAT | O_EXCL, which
+succeeds on exactly one machine (also over NFSv3+ and SMB). While it works,
+a heartbeat thread touches its claims every stale_after / 4 seconds. A claim
+not touched for stale_after seconds (measured with the file server's clock,
+not the local one) belongs to a crashed or disconnected worker: the first
+worker to notice moves it to stale/ and the file is pending again. After
+max_attempts lost claims the file is recorded as failed instead, so a file
+that kills its worker does not take down the other workers one by one.
+Files are processed at least once; a worker that was only slow may finish a
+file taken back from it, which rewrites the same outputs.
+
+Jobs hold only the path relative to the input folder, so the nodes may mount
+the NAS at different places (one manifest copy per node, same queue_dir).
+
+The coordinator runs with any Python, or with Fiji's Jython:
+
+    python batch_queue.py enqueue manifest.json     queue the input files (resume, retry_failed, watch)
+    python batch_queue.py status manifest.json      progress, workers and failures (--watch 10 refreshes)
+    python batch_queue.py requeue manifest.json     take back stale claims now (--failed, --all: results too)
+    python batch_queue.py demo --workers 4          local worker processes on a temp folder, one killed mid-job
+
+Workers are headless batch runs with "queue_dir" in the manifest (see
+batch_process.py); the first one to start queues the files nobody queued yet.
+"""
+
+from __future__ import print_function
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from batch_state import file_fingerprint, params_hash, write_json, DONE, FAILED
+
+PENDING = "pending"
+RUNNING = "running"
+STALE = "stale"
+
+FOLDERS = ("jobs", "claims", "results", "stale", "workers")
+
+
+def job_id(key):
+    """File name of a job: SHA-1 of its key (keys are nested relative paths)"""
+    if not isinstance(key, bytes):
+        key = key.encode("utf-8")
+    return hashlib.sha1(key).hexdigest()[:20]
+
+
+def worker_name():
+    """host-pid, unique among the processes sharing a queue"""
+    try:
+        pid = os.getpid()
+    except (AttributeError, OSError):
+        pid = uuid.uuid4().hex[:6]
+    return "{}-{}".format(socket.gethostname().split(".")[0], pid)
+
+
+def _read_json(path):
+    """Contents of a JSON file, None if it is missing or still being written"""
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _ids(folder, suffix=".json"):
+    try:
+        names = os.listdir(folder)
+    except OSError:
+        return set()
+    return set(n[:-len(suffix)] for n in names if n.endswith(suffix) and not n.startswith("."))
+
+
+class WorkQueue(object):
+    """Jobs, claims and results in one shared folder, one instance per worker process"""
+
+    def __init__(self, queue_dir, worker=None, stale_after=120.0, max_attempts=3, fingerprint="stat"):
+        self.queue_dir = queue_dir
+        self.worker = worker or worker_name()
+        self.stale_after = float(stale_after)
+        self.heartbeat = self.stale_after / 4
+        self.max_attempts = int(max_attempts)
+        self.fingerprint = fingerprint
+        for name in FOLDERS:
+            path = os.path.join(queue_dir, name)
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path)
+                except OSError:
+                    # created meanwhile by another worker
+                    if not os.path.isdir(path):
+                        raise
+        self.lock = threading.Lock()
+        # job id -> token of the claims this process holds
+        self.held = {}
+        self.counts = {DONE: 0, FAILED: 0}
+        self.started = time.strftime("%Y-%m-%d %H:%M:%S")
+        # job id -> key, jobs never change their key
+        self._keys = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _path(self, folder, jid, suffix=".json"):
+        return os.path.join(self.queue_dir, folder, jid + suffix)
+
+    def clock(self):
+        """Current time of the file server (mtime of a fresh file), local time if that fails"""
+        path = self._path("workers", "." + self.worker, ".clock")
+        try:
+            with open(path, "w") as f:
+                f.write(self.worker)
+            now = os.stat(path).st_mtime
+            os.remove(path)
+            return now
+        except (IOError, OSError):
+            return time.time()
+
+    #--------- jobs and results
+    def add(self, key):
+        """Queue a file by its key, returns False if it was queued before"""
+        path = self._path("jobs", job_id(key))
+        if os.path.exists(path):
+            return False
+        write_json(path, {'key': key, 'added': time.strftime("%Y-%m-%d %H:%M:%S")})
+        return True
+
+    def jobs(self):
+        """{job id: key} of all queued files"""
+        with self.lock:
+            known = set(self._keys)
+        for jid in _ids(os.path.join(self.queue_dir, "jobs")) - known:
+            job = _read_json(self._path("jobs", jid))
+            if job is not None:
+                with self.lock:
+                    self._keys[jid] = job['key']
+        with self.lock:
+            return dict(self._keys)
+
+    def result(self, key):
+        return _read_json(self._path("results", job_id(key)))
+
+    def open_jobs(self):
+        """Number of queued files without a result (pending or being processed)"""
+        return len(set(self.jobs()) - _ids(os.path.join(self.queue_dir, "results")))
+
+    def record(self, key, file_path, params, status, outputs=None, error=None):
+        """Write the result of one file (same arguments as BatchState.record)"""
+        result = {
+            'key': key,
+            'status': status,
+            'outputs': outputs or [],
+            'worker': self.worker,
+            'time': time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        if file_path is not None:
+            try:
+                result['fingerprint'] = file_fingerprint(file_path, self.fingerprint)
+            except OSError:
+                # removed since, the next enqueue sees a new fingerprint anyway
+                pass
+        if params is not None:
+            result['params'] = params_hash(params)
+        if error is not None:
+            result['error'] = error
+        write_json(self._path("results", job_id(key)), result)
+        with self.lock:
+            self.counts[status] = self.counts.get(status, 0) + 1
+
+    def attempts(self, jid):
+        """Number of claims of a job lost with their worker"""
+        prefix = jid + "."
+        try:
+            return sum(1 for n in os.listdir(os.path.join(self.queue_dir, "stale")) if n.startswith(prefix))
+        except OSError:
+            return 0
+
+    def reset(self, key):
+        """Make a finished file pending again (its result and lost-claim count are removed)"""
+        jid = job_id(key)
+        paths = [self._path("results", jid)]
+        stale_dir = os.path.join(self.queue_dir, "stale")
+        paths += [os.path.join(stale_dir, n) for n in os.listdir(stale_dir) if n.startswith(jid + ".")]
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    #--------- claims
+    def claim(self):
+        """Claim the next pending file, returns its key (None when nothing is left to claim)"""
+        jobs = self.jobs()
+        # results listed before claims: a job always has one or the other once claimed
+        taken = _ids(os.path.join(self.queue_dir, "results"))
+        taken |= _ids(os.path.join(self.queue_dir, "claims"))
+        for jid in sorted(set(jobs) - taken):
+            path = self._path("claims", jid)
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except OSError:
+                # claimed by another worker since the listing
+                continue
+            token = uuid.uuid4().hex
+            try:
+                os.write(fd, json.dumps({'key': jobs[jid], 'worker': self.worker, 'token': token,
+                                         'claimed': time.strftime("%Y-%m-%d %H:%M:%S")}).encode("utf-8"))
+            finally:
+                os.close(fd)
+            if os.path.exists(self._path("results", jid)):
+                # finished by another worker between the listing and the claim
+                os.remove(path)
+                continue
+            with self.lock:
+                self.held[jid] = token
+            return jobs[jid]
+        return None
+
+    def release(self, key):
+        """Remove the claim of a file after its result is written (unless it was taken back)"""
+        jid = job_id(key)
+        with self.lock:
+            token = self.held.pop(jid, None)
+        path = self._path("claims", jid)
+        claim = _read_json(path)
+        if token is not None and claim is not None and claim.get('token') == token:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def requeue_stale(self):
+        """Take back the claims without heartbeat for stale_after seconds, returns their keys"""
+        now = None
+        keys = []
+        for jid in _ids(os.path.join(self.queue_dir, "claims")):
+            path = self._path("claims", jid)
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                # released meanwhile
+                continue
+            if now is None:
+                now = self.clock()
+            if now - mtime <= self.stale_after:
+                continue
+            claim = _read_json(path) or {}
+            # rename is atomic: only one worker takes a claim back
+            try:
+                os.rename(path, os.path.join(self.queue_dir, "stale", "{}.{}".format(jid, uuid.uuid4().hex[:8])))
+            except OSError:
+                continue
+            key = claim.get('key') or self.jobs().get(jid)
+            if key is None:
+                continue
+            lost = self.attempts(jid)
+            if lost >= self.max_attempts:
+                write_json(self._path("results", jid), {
+                    'key': key, 'status': FAILED, 'outputs': [], 'worker': claim.get('worker'),
+                    'time': time.strftime("%Y-%m-%d %H:%M:%S"),
+                    'error': "worker lost {} times (last: {})".format(lost, claim.get('worker')),
+                })
+            keys.append(key)
+        return keys
+
+    #--------- heartbeat
+    def _beat(self, finished=False):
+        with self.lock:
+            held = dict(self.held)
+        running = []
+        for jid, token in held.items():
+            path = self._path("claims", jid)
+            claim = _read_json(path)
+            if claim is None or claim.get('token') != token:
+                # taken back as stale, another worker may hold it now
+                with self.lock:
+                    self.held.pop(jid, None)
+                continue
+            try:
+                os.utime(path, None)
+            except OSError:
+                pass
+            running.append(claim.get('key'))
+        with self.lock:
+            counts = dict(self.counts)
+        info = {'worker': self.worker, 'started': self.started, 'running': sorted(running),
+                'done': counts.get(DONE, 0), 'failed': counts.get(FAILED, 0)}
+        if finished:
+            info['finished'] = time.strftime("%Y-%m-%d %H:%M:%S")
+        write_json(self._path("workers", self.worker), info)
+
+    def _heartbeat_loop(self):
+        while not self._stop.is_set():
+            self._stop.wait(self.heartbeat)
+            if self._stop.is_set():
+                break
+            try:
+                self._beat()
+            except (IOError, OSError):
+                # NAS hiccup, the next beat tries again
+                pass
+
+    def start_heartbeat(self):
+        self._beat()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._heartbeat_loop, name="ifigure-queue-heartbeat")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop_heartbeat(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._beat(finished=True)
+
+    #--------- progress
+    def snapshot(self):
+        """{'states': {key: state}, 'counts': {state: n}, 'results': {key: result}, 'workers': [info]}"""
+        jobs = self.jobs()
+        results = {}
+        for jid in _ids(os.path.join(self.queue_dir, "results")):
+            result = _read_json(self._path("results", jid))
+            if result is not None:
+                results[jid] = result
+        now = self.clock()
+        claim_ages = {}
+        for jid in _ids(os.path.join(self.queue_dir, "claims")):
+            try:
+                claim_ages[jid] = now - os.stat(self._path("claims", jid)).st_mtime
+            except OSError:
+                pass
+        states = {}
+        for jid, key in jobs.items():
+            if jid in results:
+                states[key] = results[jid]['status']
+            elif jid in claim_ages:
+                states[key] = STALE if claim_ages[jid] > self.stale_after else RUNNING
+            else:
+                states[key] = PENDING
+        workers = []
+        for name in sorted(_ids(os.path.join(self.queue_dir, "workers"))):
+            path = self._path("workers", name)
+            info = _read_json(path)
+            if info is None:
+                continue
+            try:
+                age = now - os.stat(path).st_mtime
+            except OSError:
+                continue
+            info['state'] = "stopped" if info.get('finished') else ("alive" if age <= self.stale_after else "lost")
+            workers.append(info)
+        counts = {}
+        for state in states.values():
+            counts[state] = counts.get(state, 0) + 1
+        return {'states': states, 'counts': counts, 'workers': workers,
+                'results': dict((r['key'], r) for r in results.values())}
+
+
+def queue_for(manifest, worker=None):
+    """WorkQueue of a manifest with "queue_dir" """
+    return WorkQueue(manifest.queue_dir, worker, manifest.queue_stale, manifest.queue_attempts,
+                     manifest.fingerprint)
+
+
+def work(queue, process, threads=1, idle_minutes=None, log=print):
+    """Claim and process files on `threads` threads until every queued file has a result
+
+    process(key) handles one file and writes its result with queue.record();
+    an exception is recorded as a failure. With idle_minutes (watch mode) the
+    threads keep waiting for new files and stop after that many minutes
+    without any (0 = until the run is stopped).
+    """
+    poll = min(10.0, queue.heartbeat)
+
+    def loop():
+        last = time.time()
+        while True:
+            key = queue.claim()
+            if key is None:
+                for lost in queue.requeue_stale():
+                    log("[{}] Took back the claim of {} (worker lost)".format(queue.worker, lost))
+                key = queue.claim()
+            if key is not None:
+                try:
+                    process(key)
+                except Exception as e:
+                    log("[{}] {} ERROR: {}".format(queue.worker, key, e))
+                    queue.record(key, None, None, FAILED, error=str(e))
+                finally:
+                    queue.release(key)
+                last = time.time()
+                continue
+            if idle_minutes is None:
+                # the files still open are processed elsewhere, wait in case their worker is lost
+                if queue.open_jobs() == 0:
+                    return
+            elif idle_minutes > 0 and time.time() - last > idle_minutes * 60:
+                return
+            time.sleep(poll)
+
+    queue.start_heartbeat()
+    try:
+        pool = [threading.Thread(target=loop, name="ifigure-queue-{}".format(i)) for i in range(threads)]
+        for t in pool:
+            t.start()
+        for t in pool:
+            t.join()
+    finally:
+        queue.stop_heartbeat()
+
+
+def status_lines(queue, failed_limit=10):
+    """Progress of the queue: files per state, workers, failures"""
+    snapshot = queue.snapshot()
+    counts = snapshot['counts']
+    lines = ["Queue {}: {} files".format(queue.queue_dir, len(snapshot['states']))]
+    for state in (DONE, FAILED, RUNNING, STALE, PENDING):
+        lines.append("  {:<8} {:>6}".format(state, counts.get(state, 0)))
+    if snapshot['workers']:
+        lines.append("Workers:")
+    for info in snapshot['workers']:
+        lines.append("  {:<24} {:<8} done {:>5}  failed {:>4}  {}".format(
+            info['worker'], info['state'], info.get('done', 0), info.get('failed', 0),
+            ", ".join(info.get('running', [])) if info['state'] == "alive" else ""))
+    failed = sorted((k, r) for k, r in snapshot['results'].items() if r['status'] == FAILED)
+    if failed:
+        lines.append("Failed:")
+    for key, result in failed[:failed_limit]:
+        lines.append("  {}: {}".format(key, result.get('error', "")))
+    if len(failed) > failed_limit:
+        lines.append("  ... and {} more".format(len(failed) - failed_limit))
+    return lines
+
+
+#--------- coordinator
+def enqueue(queue, manifest, files, log=print):
+    """Queue files of the manifest; "resume" and "retry_failed" decide which finished ones run again"""
+    from batch_scan import relative_key
+
+    added = requeued = 0
+    for file_path in files:
+        key = relative_key(file_path, manifest.input_dir)
+        if queue.add(key):
+            added += 1
+            continue
+        result = queue.result(key)
+        if result is None:
+            continue
+        if result['status'] == FAILED:
+            again = manifest.retry_failed or not manifest.resume
+        else:
+            # same check as BatchState.is_up_to_date: file and parameters unchanged
+            again = (not manifest.resume
+                     or result.get('fingerprint') != file_fingerprint(file_path, manifest.fingerprint)
+                     or result.get('params') != params_hash(manifest.params_for(key)))
+        if again:
+            queue.reset(key)
+            requeued += 1
+    log("Queued {} new files, {} again".format(added, requeued))
+    return added + requeued
+
+
+def _load(target):
+    """WorkQueue and manifest of a manifest path, or WorkQueue and None of a queue folder"""
+    if os.path.isdir(target):
+        return WorkQueue(target), None
+    from batch_manifest import load_manifest
+
+    manifest = load_manifest(target)
+    if not manifest.queue_dir:
+        raise SystemExit("No queue_dir in {}".format(target))
+    return queue_for(manifest), manifest
+
+
+def _enqueue_command(args):
+    from batch_scan import find_files, FolderWatcher
+
+    queue, manifest = _load(args.manifest)
+    if manifest is None:
+        raise SystemExit("enqueue needs the manifest, not the queue folder")
+    if not manifest.watch:
+        files = find_files(manifest.input_dir, manifest.extensions, manifest.recursive, [manifest.output_dir])
+        print("Found {} files".format(len(files)))
+        enqueue(queue, manifest, files)
+        return 0
+    # live acquisition: queue files once written, as batch_process.watch_folder does for one machine
+    watcher = FolderWatcher(manifest.input_dir, manifest.extensions, manifest.recursive,
+                            [manifest.output_dir], manifest.watch_interval, manifest.watch_settle)
+    print("Watching {} for new files".format(manifest.input_dir))
+    last_new = time.time()
+    try:
+        while True:
+            ready = watcher.ready()
+            if ready:
+                enqueue(queue, manifest, ready)
+            if ready or watcher.waiting():
+                last_new = time.time()
+            elif manifest.watch_idle > 0 and time.time() - last_new > manifest.watch_idle * 60:
+                print("No new files for {} minutes, stopping".format(manifest.watch_idle))
+                break
+            watcher.wait()
+    finally:
+        watcher.close()
+    return 0
+
+
+def _status_command(args):
+    queue, manifest = _load(args.target)
+    while True:
+        print("\n".join(status_lines(queue, args.failed)))
+        if not args.watch:
+            return 0
+        print("")
+        time.sleep(args.watch)
+
+
+def _requeue_command(args):
+    queue, manifest = _load(args.target)
+    for key in queue.requeue_stale():
+        print("Stale claim taken back: {}".format(key))
+    if args.failed or args.all:
+        snapshot = queue.snapshot()
+        keys = [k for k, r in snapshot['results'].items() if args.all or r['status'] == FAILED]
+        for key in keys:
+            queue.reset(key)
+        print("{} files pending again".format(len(keys)))
+    return 0
+
+
+def _demo_worker_command(args):
+    """Worker of the demo: "processes" a file by sleeping, then appends its name to <key>.txt"""
+    queue = WorkQueue(args.queue_dir, stale_after=args.stale)
+    out_dir = os.path.join(os.path.dirname(args.queue_dir), "out")
+
+    def process(key):
+        time.sleep(args.seconds)
+        path = os.path.join(out_dir, key + ".txt")
+        with open(path, "a") as f:
+            f.write(queue.worker + "\n")
+        queue.record(key, None, None, DONE, [path])
+
+    work(queue, process, args.threads, log=lambda line: None)
+    return 0
+
+
+def _demo_command(args):
+    """Several worker processes on one temp folder, checks that every file is processed"""
+    root = tempfile.mkdtemp(prefix="ifigure_queue_")
+    queue_dir = os.path.join(root, "queue")
+    os.makedirs(os.path.join(root, "out"))
+    queue = WorkQueue(queue_dir, stale_after=args.stale)
+    keys = ["file_{:03d}.czi".format(i) for i in range(args.jobs)]
+    for key in keys:
+        queue.add(key)
+    command = [sys.executable, os.path.abspath(__file__), "demo-worker", queue_dir,
+               "--seconds", str(args.seconds), "--stale", str(args.stale), "--threads", str(args.threads)]
+    print("{} files, {} worker processes, queue in {}".format(args.jobs, args.workers, queue_dir))
+    workers = [subprocess.Popen(command) for i in range(args.workers)]
+    if args.kill and args.workers > 1:
+        # mid-job: its claims must be taken back by the others after stale_after
+        time.sleep(args.seconds * 2.5)
+        workers[0].kill()
+        print("Killed worker pid {}".format(workers[0].pid))
+    while any(w.poll() is None for w in workers):
+        time.sleep(1.0)
+        counts = queue.snapshot()['counts']
+        print("  " + "  ".join("{} {}".format(s, counts.get(s, 0)) for s in (DONE, RUNNING, STALE, PENDING)))
+    print("\n".join(status_lines(queue)))
+
+    missing = []
+    repeated = []
+    for key in keys:
+        result = queue.result(key)
+        path = os.path.join(root, "out", key + ".txt")
+        if result is None or result['status'] != DONE or not os.path.exists(path):
+            missing.append(key)
+            continue
+        with open(path) as f:
+            if len(f.read().split()) > 1:
+                repeated.append(key)
+    if repeated:
+        # at-least-once: a worker killed between writing and recording its result
+        print("Processed more than once: {}".format(", ".join(repeated)))
+    if args.keep:
+        print("Kept {}".format(root))
+    else:
+        shutil.rmtree(root, ignore_errors=True)
+    if missing:
+        print("NOT PROCESSED: {}".format(", ".join(missing)))
+        return 1
+    print("OK: all {} files processed".format(len(keys)))
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Coordinator of the shared-folder batch queue")
+    commands = parser.add_subparsers(dest="command")
+
+    p = commands.add_parser("enqueue", help="queue the input files of a manifest")
+    p.add_argument("manifest")
+    p.set_defaults(run=_enqueue_command)
+
+    p = commands.add_parser("status", help="progress of the queue")
+    p.add_argument("target", help="manifest or queue folder")
+    p.add_argument("--watch", type=float, default=0, help="refresh every WATCH seconds")
+    p.add_argument("--failed", type=int, default=10, help="failures listed")
+    p.set_defaults(run=_status_command)
+
+    p = commands.add_parser("requeue", help="take back stale claims, optionally finished files")
+    p.add_argument("target", help="manifest or queue folder")
+    p.add_argument("--failed", action="store_true", help="failed files run again")
+    p.add_argument("--all", action="store_true", help="every file runs again")
+    p.set_defaults(run=_requeue_command)
+
+    p = commands.add_parser("demo", help="local worker processes on a temp folder")
+    p.add_argument("--jobs", type=int, default=40)
+    p.add_argument("--workers", type=int, default=4)
+    p.add_argument("--threads", type=int, default=1, help="threads per worker process")
+    p.add_argument("--seconds", type=float, default=0.2, help="time per file")
+    p.add_argument("--stale", type=float, default=3.0, help="stale_after of the demo queue")
+    p.add_argument("--no-kill", dest="kill", action="store_false", help="do not kill a worker mid-job")
+    p.add_argument("--keep", action="store_true", help="keep the temp folder")
+    p.set_defaults(run=_demo_command)
+
+    p = commands.add_parser("demo-worker")
+    p.add_argument("queue_dir")
+    p.add_argument("--seconds", type=float, default=0.2)
+    p.add_argument("--stale", type=float, default=3.0)
+    p.add_argument("--threads", type=int, default=1)
+    p.set_defaults(run=_demo_worker_command)
+
+    args = parser.parse_args(argv)
+    if not hasattr(args, "run"):
+        parser.print_help()
+        return 2
+    return args.run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,141 @@
+"""
+Finding input files: recursive folder scan and watch-folder mode
+
+find_files indexes a folder (optionally its whole subtree) for several
+extensions. Files are identified by their path relative to the input folder
+("2025-12-15/sample_01/cell_3.czi"), which is also the key of the batch state
+and of the manifest rules, and the output tree mirrors the input tree.
+
+FolderWatcher is for live acquisitions: it rescans the input tree and hands
+out new files once their size and mtime stayed the same for `settle`
+seconds, i.e. once the microscope software finished writing them. Rescans
+happen every `interval` seconds, or earlier when the Java WatchService
+(inotify on Linux) reports a new file or folder.
+"""
+
+import os
+import time
+
+try:
+    from java.nio.file import Paths, StandardWatchEventKinds
+    from java.util.concurrent import TimeUnit
+    from java.io import IOException
+except ImportError:
+    Paths = None
+
+
+def _extension(filename):
+    return filename.lower().rsplit(".", 1)[-1] if "." in filename else ""
+
+
+def find_files(input_dir, extensions, recursive=False, exclude=()):
+    """Sorted paths of files matching any of the extensions; folders in exclude (and hidden ones) are skipped"""
+    extensions = set(e.lower().lstrip(".") for e in extensions)
+    excluded = set(os.path.abspath(d) for d in exclude if d)
+    files = []
+    for dir_path, dir_names, file_names in os.walk(input_dir):
+        # pruning dir_names in place stops os.walk from descending
+        dir_names[:] = sorted(d for d in dir_names if recursive and not d.startswith(".")
+                              and os.path.abspath(os.path.join(dir_path, d)) not in excluded)
+        for f in sorted(file_names):
+            if not f.startswith(".") and _extension(f) in extensions:
+                files.append(os.path.join(dir_path, f))
+    return files
+
+
+def relative_key(file_path, input_dir):
+    """Path relative to the input folder with "/" separators, the file's key in state and manifest"""
+    return os.path.relpath(file_path, input_dir).replace(os.sep, "/")
+
+
+def mirror_dir(file_path, input_dir, output_dir):
+    """Output folder of a file: output_dir plus the file's subfolder in the input tree (created)"""
+    sub_dir = os.path.dirname(os.path.relpath(file_path, input_dir))
+    target = os.path.join(output_dir, sub_dir) if sub_dir else output_dir
+    if not os.path.isdir(target):
+        try:
+            os.makedirs(target)
+        except OSError:
+            # created meanwhile by another job
+            if not os.path.isdir(target):
+                raise
+    return target
+
+
+class FolderWatcher(object):
+    """New, completely written files of an input tree, as they appear"""
+
+    def __init__(self, input_dir, extensions, recursive=False, exclude=(), interval=5.0, settle=10.0):
+        self.input_dir = input_dir
+        self.extensions = extensions
+        self.recursive = recursive
+        self.exclude = exclude
+        self.interval = interval
+        self.settle = settle
+        # path -> (size, mtime, time the file was first seen with them)
+        self.pending = {}
+        self.handed_out = set()
+        self.watch_service = None
+        self.watched_dirs = set()
+        if Paths is not None:
+            try:
+                self.watch_service = Paths.get(input_dir).getFileSystem().newWatchService()
+            except IOException:
+                self.watch_service = None
+
+    def _watch_dirs(self):
+        """Register folders not watched yet (new session/sample folders appear during the run)"""
+        if self.watch_service is None:
+            return
+        excluded = set(os.path.abspath(d) for d in self.exclude if d)
+        for dir_path, dir_names, file_names in os.walk(self.input_dir):
+            dir_names[:] = [d for d in dir_names if self.recursive and not d.startswith(".")
+                            and os.path.abspath(os.path.join(dir_path, d)) not in excluded]
+            if dir_path not in self.watched_dirs:
+                try:
+                    Paths.get(dir_path).register(self.watch_service, StandardWatchEventKinds.ENTRY_CREATE)
+                    self.watched_dirs.add(dir_path)
+                except IOException:
+                    pass
+
+    def ready(self):
+        """Rescan, returns the files that became stable since the last call"""
+        now = time.time()
+        self._watch_dirs()
+        result = []
+        for path in find_files(self.input_dir, self.extensions, self.recursive, self.exclude):
+            if path in self.handed_out:
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                # renamed or removed while scanning
+                continue
+            seen = self.pending.get(path)
+            if seen is None or seen[:2] != (st.st_size, st.st_mtime):
+                self.pending[path] = (st.st_size, st.st_mtime, now)
+            elif st.st_size > 0 and now - seen[2] >= self.settle:
+                del self.pending[path]
+                self.handed_out.add(path)
+                result.append(path)
+        return result
+
+    def waiting(self):
+        """Number of files seen but still being written"""
+        return len(self.pending)
+
+    def wait(self):
+        """Sleep until the next rescan: interval seconds, or a new entry in a watched folder"""
+        if self.watch_service is None:
+            time.sleep(self.interval)
+            return
+        key = self.watch_service.poll(int(self.interval * 1000), TimeUnit.MILLISECONDS)
+        if key is not None:
+            key.pollEvents()
+            key.reset()
+            # a new file is still being written, give it a moment before rescanning
+            time.sleep(min(1.0, self.interval))
+
+    def close(self):
+        if self.watch_service is not None:
+            self.watch_service.close()
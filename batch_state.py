@@ -0,0 +1,126 @@
+"""
+Per-output-folder record of processed files, so batches can be resumed
+
+The state file (.ifigure_batch.json in the output folder) keeps, for every
+input file: a fingerprint of the file (size + mtime, or a SHA-1 of the
+contents), a hash of the parameters used, the output paths and whether it
+succeeded. On a re-run, files with an unchanged fingerprint, unchanged
+parameters and existing outputs are skipped; failures can be retried alone.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+
+STATE_FILE = ".ifigure_batch.json"
+
+DONE = "done"
+FAILED = "failed"
+
+
+def file_fingerprint(path, mode="stat"):
+    """size + mtime ("stat", cheap) or size + SHA-1 of the contents ("sha1")"""
+    st = os.stat(path)
+    fp = {'size': st.st_size}
+    if mode == "sha1":
+        digest = hashlib.sha1()
+        with open(path, "rb") as f:
+            while True:
+                block = f.read(1024 * 1024)
+                if not block:
+                    break
+                digest.update(block)
+        fp['sha1'] = digest.hexdigest()
+    else:
+        fp['mtime'] = int(st.st_mtime)
+    return fp
+
+
+def write_json(path, data, tmp_path=None):
+    """Replace path by data as JSON through tmp_path (default a unique name next to it)
+
+    Readers, also on other machines, see the old or the new file, never half
+    of one. A fixed tmp_path is left behind when a Windows writer dies
+    between the remove and the rename, for the reader to fall back on.
+    """
+    tmp_path = tmp_path or "{}.{}.tmp".format(path, uuid.uuid4().hex[:8])
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    try:
+        # atomic on POSIX
+        os.rename(tmp_path, path)
+    except OSError:
+        # Windows does not rename over an existing file
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp_path, path)
+
+
+def params_hash(params):
+    """Stable hash of a parameter dict"""
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class BatchState(object):
+    """Thread-safe, incrementally saved record of a batch in one output folder"""
+
+    def __init__(self, output_dir, fingerprint="stat"):
+        self.path = os.path.join(output_dir, STATE_FILE)
+        self.fingerprint = fingerprint
+        self.lock = threading.Lock()
+        self.entries = {}
+        # a run killed while replacing the state on Windows can leave only the temp file
+        for path in (self.path, self.path + ".tmp"):
+            if os.path.exists(path):
+                try:
+                    with open(path, "r") as f:
+                        self.entries = json.load(f).get("files", {})
+                    break
+                except ValueError:
+                    # half-written temp file
+                    continue
+
+    def _entry_matches(self, key, file_path, params):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry.get('fingerprint') != file_fingerprint(file_path, self.fingerprint):
+            return None
+        if entry.get('params') != params_hash(params):
+            return None
+        return entry
+
+    def is_up_to_date(self, key, file_path, params):
+        """True when the file was processed successfully with these parameters and is unchanged"""
+        entry = self._entry_matches(key, file_path, params)
+        if entry is None or entry.get('status') != DONE:
+            return False
+        return all(os.path.exists(p) for p in entry.get('outputs', []))
+
+    def status(self, key):
+        return self.entries.get(key, {}).get('status')
+
+    def failed(self):
+        return sorted(k for k, e in self.entries.items() if e.get('status') == FAILED)
+
+    def record(self, key, file_path, params, status, outputs=None, error=None):
+        """Store the result of one file and write the state file straight away"""
+        entry = {
+            'fingerprint': file_fingerprint(file_path, self.fingerprint),
+            'params': params_hash(params),
+            'status': status,
+            'outputs': outputs or [],
+            'time': time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        if error is not None:
+            entry['error'] = error
+        with self.lock:
+            self.entries[key] = entry
+            self._save()
+
+    def _save(self):
+        # fixed temp name, __init__ reads it back when a crash left only that
+        write_json(self.path, {'files': self.entries}, self.path + ".tmp")
@@ -0,0 +1,103 @@
+"""
+Worker pool for processing several files at once inside one JVM
+
+Jobs run on a fixed java.util.concurrent thread pool. Every job reserves an
+estimate of its heap use from a shared memory budget before it starts, so the
+number of files open at the same time is capped by memory as well as by the
+number of workers.
+"""
+
+from ij import IJ
+from java.lang import Runtime
+from java.util.concurrent import Callable, Executors, Semaphore, TimeUnit
+import os
+
+from ifigure_loader import bioformats_available, list_series, figure_series, clip_roi, FIGURE_CHANNELS
+from ifigure_tiled import needed_bytes
+from ifigure_core import resolve_params
+
+MB = 1024 * 1024
+
+# without Bio-Formats the whole file is opened: the stack (about the file size for
+# uncompressed formats) plus the 2D planes built from it
+OPENED_FACTOR = 1.25
+# figure panels: RGB pixel + the two 8-bit canvas planes
+FIGURE_BYTES_PER_PIXEL = 6
+
+
+def default_workers():
+    """One worker per core, leaving one core for the JVM/GC"""
+    return max(1, Runtime.getRuntime().availableProcessors() - 1)
+
+
+def panel_bytes(params, pixels):
+    """2D planes of one figure built from an ROI of `pixels`: slice copies, 32-bit projections
+    and their blurred/8-bit copies, the figure canvas"""
+    rows = len(params.get('projections') or ["max"])
+    planes = FIGURE_CHANNELS * 4 * (rows + 3)
+    panels = 4 + 3 * rows
+    return pixels * (planes + panels * FIGURE_BYTES_PER_PIXEL)
+
+
+def estimate_job_bytes(file_path, params):
+    """Heap estimate for the figures of file_path: what crop-on-read loads plus the panels
+
+    The series are rendered one after the other, so the largest one counts.
+    Tiled renders load at most their tile budget.
+    """
+    if bioformats_available():
+        try:
+            series = figure_series(list_series(file_path), params.get('series', "all"))
+        except Exception:
+            # unreadable metadata, the job reports the error itself
+            series = []
+        estimate = 0
+        for dims in series:
+            p = resolve_params(params, dims['slices'])
+            loaded = needed_bytes(p, dims)
+            budget = (p.get('tile_budget_mb') or 0) * MB
+            if budget > 0:
+                loaded = min(loaded, budget)
+            roi = clip_roi(p['roi'], dims['width'], dims['height']) or [0, 0, dims['width'], dims['height']]
+            estimate = max(estimate, loaded + panel_bytes(p, roi[2] * roi[3]))
+        if estimate:
+            return estimate
+    return int(os.path.getsize(file_path) * OPENED_FACTOR)
+
+
+class _Job(Callable):
+    """Runs fn(*args) once the job's share of the memory budget is free"""
+
+    def __init__(self, pool, permits, fn, args):
+        self.pool = pool
+        self.permits = permits
+        self.fn = fn
+        self.args = args
+
+    def call(self):
+        self.pool.memory.acquire(self.permits)
+        try:
+            return self.fn(*self.args)
+        finally:
+            self.pool.memory.release(self.permits)
+
+
+class WorkerPool(object):
+    """Fixed-size thread pool with a memory budget shared by all running jobs"""
+
+    def __init__(self, workers=None, memory_fraction=0.75):
+        self.workers = workers or default_workers()
+        # budget in MB, so a semaphore permit is one MB of heap
+        self.budget_mb = max(1, int(IJ.maxMemory() * memory_fraction / MB))
+        self.memory = Semaphore(self.budget_mb, True)
+        self.executor = Executors.newFixedThreadPool(self.workers)
+
+    def submit(self, fn, estimate_bytes, *args):
+        """Queue fn(*args), returns a java Future"""
+        # a job bigger than the whole budget still runs, but on its own
+        permits = min(self.budget_mb, max(1, int(estimate_bytes / MB)))
+        return self.executor.submit(_Job(self, permits, fn, args))
+
+    def shutdown(self):
+        self.executor.shutdown()
+        self.executor.awaitTermination(1, TimeUnit.DAYS)
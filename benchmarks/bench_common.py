@@ -0,0 +1,122 @@
+"""
+Case grid, result files and baseline comparison shared by the benchmarks
+
+bench_numpy.py (CPython) and bench_fiji.py (Fiji/Jython) run the same
+synthetic cases and write the same JSON layout:
+
+    {"engine": "numpy", "created": "...", "results": {
+        "1024x1024x10z3c16b_roi": {"load": {"seconds": 0.12, "mvox_per_s": 250.0, "peak_mb": 61.0}, ...}}}
+
+so a run can be compared stage by stage with a saved baseline.
+"""
+
+import json
+import time
+
+MB = 1024 * 1024
+GB = 1024 * MB
+
+STAGES = ["load", "crop", "slice", "project", "blur", "compose", "encode", "figure"]
+
+PRESETS = {
+    'quick': {'sizes': [512, 1024], 'slices': [1, 10], 'channels': [3], 'bits': [16], 'roi': [False, True]},
+    'full': {'sizes': [512, 1024, 2048, 4096, 8192], 'slices': [1, 10, 40, 100], 'channels': [2, 3, 5],
+             'bits': [8, 16], 'roi': [False, True]},
+}
+
+# stage slower than baseline by more than this fraction counts as a regression
+REGRESSION_THRESHOLD = 0.10
+
+
+def case_name(case):
+    name = "{0}x{0}x{1}z{2}c{3}b".format(case['size'], case['slices'], case['channels'], case['bits'])
+    return name + "_roi" if case['roi'] else name
+
+
+def stack_bytes(case):
+    return case['size'] * case['size'] * case['slices'] * case['channels'] * case['bits'] // 8
+
+
+def roi_for(case):
+    """Centred ROI of half the image size, [x, y, w, h] (None without ROI)"""
+    if not case['roi']:
+        return None
+    size = case['size']
+    return [size // 4, size // 4, size // 2, size // 2]
+
+
+def cases(preset="quick", max_bytes=4 * GB):
+    """Cases of a preset, skipping stacks larger than max_bytes"""
+    grid = PRESETS[preset]
+    result = []
+    for size in grid['sizes']:
+        for slices in grid['slices']:
+            for channels in grid['channels']:
+                for bits in grid['bits']:
+                    for roi in grid['roi']:
+                        case = {'size': size, 'slices': slices, 'channels': channels, 'bits': bits, 'roi': roi}
+                        if stack_bytes(case) <= max_bytes:
+                            result.append(case)
+    return result
+
+
+def record(seconds, case, peak_bytes):
+    """Result of one stage: median wall time, throughput over the whole stack, peak memory"""
+    voxels = case['size'] * case['size'] * case['slices'] * case['channels']
+    return {
+        'seconds': round(seconds, 6),
+        'mvox_per_s': round(voxels / 1e6 / seconds, 3) if seconds > 0 else None,
+        'peak_mb': round(peak_bytes / float(MB), 1),
+    }
+
+
+def median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    return values[mid] if len(values) % 2 else (values[mid - 1] + values[mid]) / 2.0
+
+
+def save_results(path, engine, results):
+    with open(path, "w") as f:
+        json.dump({'engine': engine, 'created': time.strftime("%Y-%m-%d %H:%M:%S"), 'results': results},
+                  f, indent=1, sort_keys=True)
+
+
+def load_results(path):
+    with open(path, "r") as f:
+        return json.load(f)['results']
+
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    """[(case, stage, baseline_s, now_s)] of stages slower than the baseline by more than threshold"""
+    regressions = []
+    for name in sorted(results):
+        for stage, now in sorted(results[name].items()):
+            base = baseline.get(name, {}).get(stage)
+            if base is None or not base['seconds']:
+                continue
+            if now['seconds'] > base['seconds'] * (1 + threshold):
+                regressions.append((name, stage, base['seconds'], now['seconds']))
+    return regressions
+
+
+def format_table(results):
+    """Plain-text table, one line per case and stage"""
+    lines = ["{:<28} {:<8} {:>10} {:>10} {:>9}".format("case", "stage", "seconds", "Mvox/s", "peak MB")]
+    for name in sorted(results):
+        for stage in STAGES:
+            r = results[name].get(stage)
+            if r is None:
+                continue
+            lines.append("{:<28} {:<8} {:>10.4f} {:>10} {:>9.1f}".format(
+                name, stage, r['seconds'], r['mvox_per_s'], r['peak_mb']))
+    return "\n".join(lines)
+
+
+def format_regressions(regressions, threshold=REGRESSION_THRESHOLD):
+    if not regressions:
+        return "No regressions against the baseline"
+    lines = ["Regressions (> {:.0%} slower):".format(threshold)]
+    for name, stage, base, now in regressions:
+        lines.append("  {} {}: {:.4f}s -> {:.4f}s ({:+.0%})".format(name, stage, base, now, now / base - 1))
+    return "\n".join(lines)
@@ -0,0 +1,149 @@
+"""
+Benchmark of the Fiji pipeline (ifigure_core.py) on synthetic hyperstacks
+
+    ImageJ --headless --jython benchmarks/bench_fiji.py quick results.json [baseline.json]
+
+Same cases and result layout as bench_numpy.py (see bench_common.py). Each
+stage runs after a System.gc(); the memory column is the heap growth over
+the stage (IJ.currentMemory), an approximation of its peak.
+"""
+
+from ij import IJ, ImagePlus, ImageStack
+from ij.io import Opener, FileSaver
+from ij.gui import Roi
+from ij.process import ByteProcessor, ShortProcessor
+from java.lang import System
+import os
+import shutil
+import sys
+import tempfile
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+for d in (bench_dir, os.path.dirname(bench_dir)):
+    if d not in sys.path:
+        sys.path.append(d)
+
+import bench_common as common
+from ifigure_engine import fused_slice_and_project
+from ifigure_core import build_figures, blur, display8, merge8, compose_combined
+
+REPEAT = 3
+SIGMA = 2.0
+
+
+def synthetic_imp(case):
+    """Noise hyperstack (C, Z order as ImageJ), so blur and projections do real work"""
+    size = case['size']
+    stack = ImageStack(size, size)
+    for z in range(case['slices']):
+        for c in range(case['channels']):
+            if case['bits'] == 8:
+                ip = ByteProcessor(size, size)
+                ip.add(100)
+                ip.noise(40)
+            else:
+                ip = ShortProcessor(size, size)
+                ip.add(2000)
+                ip.noise(800)
+            stack.addSlice(ip)
+    imp = ImagePlus(common.case_name(case), stack)
+    imp.setDimensions(case['channels'], case['slices'], 1)
+    imp.setOpenAsHyperStack(True)
+    return imp
+
+
+def timed(fn):
+    """(median seconds, heap growth in bytes, last result) of fn()"""
+    times = []
+    grown = 0
+    result = None
+    for i in range(REPEAT):
+        result = None
+        System.gc()
+        before = IJ.currentMemory()
+        start = System.nanoTime()
+        result = fn()
+        times.append((System.nanoTime() - start) / 1e9)
+        grown = max(grown, IJ.currentMemory() - before)
+    return common.median(times), grown, result
+
+
+def run_case(case, tmp_dir):
+    path = os.path.join(tmp_dir, common.case_name(case) + ".tif")
+    FileSaver(synthetic_imp(case)).saveAsTiff(path)
+    roi = common.roi_for(case)
+    zslice = (case['slices'] + 1) // 2
+    results = {}
+
+    def stage(name, fn):
+        seconds, grown, value = timed(fn)
+        results[name] = common.record(seconds, case, grown)
+        return value
+
+    imp = stage("load", lambda: Opener().openImage(path))
+    rect = Roi(*roi).getBounds() if roi is not None else None
+    stack = imp.getStack()
+
+    def crop_all():
+        # ROI of every plane, what the fused engine reads
+        for n in range(1, stack.getSize() + 1):
+            ip = stack.getProcessor(n)
+            if rect is not None:
+                ip.setRoi(rect)
+            ip.crop()
+
+    stage("crop", crop_all)
+    slice_ips = stage("slice", lambda: fused_slice_and_project(imp, zslice, None, None, rect)[0])
+    max_ips = stage("project", lambda: fused_slice_and_project(imp, None, 1, case['slices'], rect, ("max",)))[1]["max"]
+
+    def blur_all():
+        for ip in slice_ips:
+            blur(ImagePlus("C", ip.duplicate()), SIGMA)
+
+    stage("blur", blur_all)
+
+    #--------- compose on its own: layout + LUT blitting of ready 8-bit channels
+    # (cases with fewer than 3 channels repeat them in the panels)
+    ch = lambda ips, c: ips[c % len(ips)]
+    top = [display8(ch(slice_ips, c)) for c in (2, 0, 1)]
+    top.append((merge8(ch(slice_ips, 0)), merge8(ch(slice_ips, 1))))
+    rows_z = [([display8(ch(max_ips, 0)), display8(ch(max_ips, 1)),
+                (merge8(ch(max_ips, 0)), merge8(ch(max_ips, 1)))], " (Max Z)")]
+    stage("compose", lambda: compose_combined(top, rows_z, ["Cyan", "Far red", "Red", "Merged"]))
+
+    if case['channels'] >= 3:
+        if roi is not None:
+            imp.setRoi(Roi(*roi))
+        params = {'blur_sigma': SIGMA, 'zslice': zslice}
+        figures = stage("figure", lambda: build_figures(imp, params))
+        out_path = os.path.join(tmp_dir, "figure.jpeg")
+        stage("encode", lambda: FileSaver(figures["combined"]).saveAsJpeg(out_path))
+    imp.close()
+    os.remove(path)
+    return results
+
+
+def main(args):
+    preset = args[0] if args else "quick"
+    out_path = args[1] if len(args) > 1 else None
+    baseline_path = args[2] if len(args) > 2 else None
+
+    # stacks up to a quarter of the heap, the figure pipeline needs the rest
+    max_bytes = IJ.maxMemory() // 4
+    tmp_dir = tempfile.mkdtemp(prefix="ifigure_bench_")
+    results = {}
+    try:
+        for case in common.cases(preset, max_bytes):
+            IJ.log("running {}".format(common.case_name(case)))
+            results[common.case_name(case)] = run_case(case, tmp_dir)
+    finally:
+        shutil.rmtree(tmp_dir, True)
+
+    IJ.log(common.format_table(results))
+    if out_path:
+        common.save_results(out_path, "fiji", results)
+    if baseline_path:
+        IJ.log(common.format_regressions(common.compare(results, common.load_results(baseline_path))))
+
+
+main([a for a in getattr(sys, 'argv', [])[1:] if a])
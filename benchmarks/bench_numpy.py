@@ -0,0 +1,123 @@
+"""
+Benchmark of the NumPy engine (ifigure_numpy.py) on synthetic hyperstacks
+
+    python benchmarks/bench_numpy.py --preset quick --save baseline_numpy.json
+    python benchmarks/bench_numpy.py --preset quick --baseline baseline_numpy.json
+
+Every stage (load, crop, slice, project, blur, compose, encode) is timed on
+its own, plus the whole figure. Peak memory is the tracemalloc peak of the
+stage (NumPy buffers are traced). Exits with 1 when a stage is slower than
+the baseline by more than --threshold.
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import ifigure_numpy as engine
+import bench_common as common
+
+
+def synthetic_stack(case, seed=0):
+    """(C, Z, Y, X) noise stack with some structure, so blur and projections do real work"""
+    rng = np.random.default_rng(seed)
+    dtype = np.uint8 if case['bits'] == 8 else np.uint16
+    top = 200 if case['bits'] == 8 else 4000
+    shape = (case['channels'], case['slices'], case['size'], case['size'])
+    return rng.integers(0, top, shape, dtype=dtype)
+
+
+def timed(fn, repeat):
+    """(median seconds, peak bytes, last result) of fn()"""
+    times = []
+    peak = 0
+    result = None
+    for _ in range(repeat):
+        tracemalloc.start()
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return common.median(times), peak, result
+
+
+def run_case(case, tmp_dir, sigma, repeat):
+    stack = synthetic_stack(case)
+    path = os.path.join(tmp_dir, common.case_name(case) + ".tif")
+    # ImageJ hyperstack order
+    engine.tifffile.imwrite(path, np.ascontiguousarray(stack.transpose(1, 0, 2, 3)), imagej=True,
+                            metadata={'axes': 'ZCYX'})
+    roi = common.roi_for(case)
+    zslice = (case['slices'] + 1) // 2
+    bit_depth = case['bits']
+    results = {}
+
+    def stage(name, fn):
+        seconds, peak, value = timed(fn, repeat)
+        results[name] = common.record(seconds, case, peak)
+        return value
+
+    loaded = stage("load", lambda: engine.load_stack(path))
+    # crop is a view in the engine; the copy shows what touching the ROI costs
+    cropped = stage("crop", lambda: np.ascontiguousarray(engine.crop(loaded, roi)))
+    slice_chs = stage("slice", lambda: cropped[:, zslice - 1].copy())
+    proj = stage("project", lambda: engine.project(cropped, 1, case['slices'], "max"))
+    stage("blur", lambda: engine.gaussian_blur(slice_chs, sigma, bit_depth))
+
+    h, w = slice_chs.shape[-2:]
+    panels = [np.zeros((h, w, 3), np.uint8)] * 4
+    rows_z = [[np.zeros(proj.shape[-2:] + (3,), np.uint8)] * 3]
+    labels = ["Cyan", "Far red", "Red", "Merged"]
+    fig = stage("compose", lambda: engine.compose_combined(panels, rows_z, labels, [labels[1:]]))
+    out_path = os.path.join(tmp_dir, "figure.png" if engine.Image is not None else "figure.tif")
+    stage("encode", lambda: engine.save_figure(out_path, fig))
+
+    if case['channels'] >= 3:
+        params = {'blur_sigma': sigma, 'roi': roi, 'zslice': zslice}
+        stage("figure", lambda: engine.build_figure(loaded, params))
+    os.remove(path)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the NumPy figure engine")
+    parser.add_argument("--preset", choices=sorted(common.PRESETS), default="quick")
+    parser.add_argument("--max-gb", type=float, default=2.0, help="skip stacks larger than this")
+    parser.add_argument("--sigma", type=float, default=2.0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--save", help="write the results (e.g. as a new baseline)")
+    parser.add_argument("--baseline", help="compare with a saved result file")
+    parser.add_argument("--threshold", type=float, default=common.REGRESSION_THRESHOLD)
+    args = parser.parse_args(argv)
+
+    tmp_dir = tempfile.mkdtemp(prefix="ifigure_bench_")
+    results = {}
+    try:
+        for case in common.cases(args.preset, int(args.max_gb * common.GB)):
+            print("running {}".format(common.case_name(case)), file=sys.stderr)
+            results[common.case_name(case)] = run_case(case, tmp_dir, args.sigma, args.repeat)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    print(common.format_table(results))
+    if args.save:
+        common.save_results(args.save, "numpy", results)
+    if args.baseline:
+        regressions = common.compare(results, common.load_results(args.baseline), args.threshold)
+        print(common.format_regressions(regressions, args.threshold))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,406 @@
+# -*- coding: utf-8 -*-
+"""
+IFigure figure pipeline as an importable module
+
+build_figure(imp, params) builds the combined figure (top row: single
+z-slice, one bottom row per Z projection in params['projections'], max by
+default) and returns it as an RGB ImagePlus. With params['autofocus'] the
+z-slice is the sharpest plane instead of a fixed one.
+Shared by IFigure.py, IFigure_batch.py and batch_process.py, so the code is
+compiled once per session instead of once per file.
+
+Everything works on explicit ImagePlus/ImageProcessor objects (no IJ.run,
+no window state), so several figures can be built at once from worker threads.
+What a figure allocates is registered with the caller's workspace
+(ifigure_workspace.py), which frees it when the file is done.
+"""
+
+from ij import ImagePlus
+from ij.process import ByteProcessor
+from ij.plugin.filter import GaussianBlur
+from collections import OrderedDict
+import jarray
+
+from ifigure_engine import fused_slice_and_project, focus_scores, best_focus, STATISTICS
+from ifigure_metrics import NO_TIMER
+from ifigure_workspace import NO_WORKSPACE
+from ifigure_layout import plan_for, FigureCanvas
+from ifigure_params import DEFAULT_PARAMS
+
+LAYOUTS = {
+    'combined': ["combined"],
+    'single': ["single"],
+    'both': ["single", "combined"],
+}
+
+# label suffixes of the bottom rows (max uses params['projection_suffix'])
+PROJECTION_SUFFIXES = {
+    'mean': " (Mean Z)",
+    'sum': " (Sum Z)",
+    'sd': " (SD Z)",
+    'median': " (Median Z)",
+}
+
+def histogram_bounds(ip, low=0.0, high=100.0):
+    """(lo, hi) pixel values at the low/high percentiles, from a single histogram of ip
+
+    0 and 100 give the min and max. 8/16-bit images use one bin per value,
+    32-bit images the 256-bin min..max histogram.
+    """
+    if ip.getBitDepth() == 32:
+        stats = ip.getStats()
+        hist = stats.getHistogram()
+        start, size = stats.histMin, stats.binSize
+    else:
+        hist = ip.getHistogram()
+        start, size = 0, 1
+    total = sum(hist)
+    lo_count = total * low / 100.0
+    hi_count = total * high / 100.0
+    cum = 0
+    lo_bin = None
+    hi_bin = 0
+    for i, n in enumerate(hist):
+        if n == 0:
+            continue
+        cum += n
+        if lo_bin is None and cum > lo_count:
+            lo_bin = i
+        if cum >= hi_count:
+            hi_bin = i
+            break
+    if lo_bin is None:
+        lo_bin = hi_bin
+    if ip.getBitDepth() == 32:
+        # upper edge of the bin, so 100 gives the exact max
+        return start + lo_bin * size, min(stats.histMax, start + (hi_bin + 1) * size)
+    return lo_bin, hi_bin
+
+
+def normalize_channel(img, low=0.0, high=100.0):
+    """Stretch the low..high percentiles of img to 0-255, img gets an 8-bit processor
+
+    One histogram read plus one mapping pass straight from the original
+    pixels (ImageJ's scaled 8-bit conversion is that lookup table), no float
+    copy. A flat channel becomes black instead of dividing by zero.
+    """
+    ip = img.getProcessor()
+    lo, hi = histogram_bounds(ip, low, high)
+    if hi <= lo:
+        img.setProcessor(ByteProcessor(ip.getWidth(), ip.getHeight()))
+        return img
+    img.setProcessor(to_byte(ip, lo, hi))
+    return img
+
+
+def to_byte(ip, lo, hi):
+    """8-bit copy of ip with lo..hi mapped to 0..255, in one pass over the pixels"""
+    if ip.getBitDepth() == 8:
+        # skalira 0 - 255 (same rounding as the 16-bit conversion)
+        scale = 256.0 / (hi - lo + 1)
+        lut = [max(0, min(255, int((v - lo) * scale + 0.5))) for v in range(256)]
+        out = ip.duplicate()
+        out.applyTable(jarray.array(lut, 'i'))
+        return out
+    # the processor may be shared (BlurCache), its display range is put back
+    old_min, old_max = ip.getMin(), ip.getMax()
+    ip.setMinAndMax(lo, hi)
+    out = ip.convertToByteProcessor(True)
+    ip.setMinAndMax(old_min, old_max)
+    return out
+
+
+def blur(img, sigma):
+    """Gaussian blur in place (same accuracy as Process > Filters > Gaussian Blur...)
+
+    sigma 0 (the batch default) does nothing. For large sigma GaussianBlur
+    itself blurs a downscaled copy with a short kernel and upscales it, so
+    the cost does not grow with sigma.
+    """
+    if sigma <= 0:
+        return
+    accuracy = 0.002 if img.getBitDepth() in (8, 24) else 0.0002
+    GaussianBlur().blurGaussian(img.getProcessor(), sigma, sigma, accuracy)
+
+
+def display8(ip):
+    """8-bit channel of a grey panel: scaled by its display range (the 8-bit conversion), 8-bit as it is"""
+    if ip.getBitDepth() == 8:
+        return ip
+    return to_byte(ip, ip.getMin(), ip.getMax())
+
+
+def merge8(ip):
+    """8-bit channel of the red + white composite, whose display ranges are 0-255"""
+    if ip.getBitDepth() == 8:
+        return ip
+    return to_byte(ip, 0, 255)
+
+
+class BlurCache(object):
+    """Blurred panel planes of one source image, keyed by (plane key, sigma)
+
+    The plane key names the plane that was blurred (role, channel, z, ROI),
+    so re-rendering with an unchanged plane and sigma (e.g. a preview where
+    only the z-slice slider moved) reuses the blurred copy. Cached processors
+    are shared, callers must not modify them.
+    """
+
+    def __init__(self, max_entries=32):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def blurred(self, key, img, sigma):
+        """img with its processor blurred by sigma, computed once per (key, sigma)"""
+        if sigma <= 0:
+            return img
+        cache_key = (key, sigma)
+        ip = self.entries.pop(cache_key, None)
+        if ip is None:
+            blur(img, sigma)
+            ip = img.getProcessor()
+        else:
+            img.setProcessor(ip)
+        self.entries[cache_key] = ip
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return img
+
+    def clear(self):
+        self.entries.clear()
+
+
+def middle_slice(slices):
+    """Default z-slice (1-based): the middle one, the lower of the two for an even count"""
+    return (slices + 1) // 2
+
+
+def resolve_params(params, slices):
+    """Defaults for missing parameters, z values clamped to the stack
+
+    None takes the default; keys without one (e.g. the manifest's roi) are kept as given.
+    """
+    p = dict(DEFAULT_PARAMS)
+    p.update(dict((k, v) for k, v in params.items() if v is not None or k not in p))
+
+    # If zslice not provided, use middle slice
+    if p['zslice'] is None:
+        p['zslice'] = middle_slice(slices)
+    # If z_start/z_end not provided, use full range
+    if p['z_start'] is None:
+        p['z_start'] = 1
+    if p['z_end'] is None:
+        p['z_end'] = slices
+
+    p['zslice'] = int(max(1, min(p['zslice'], slices)))
+    p['z_start'] = int(max(1, min(p['z_start'], slices)))
+    p['z_end'] = int(max(p['z_start'], min(p['z_end'], slices)))
+    return p
+
+
+def auto_focus(imp, params, rect=None, timer=NO_TIMER):
+    """Sharpest z-slice of params['focus_channel'] within rect, noted as focus_z/focus_score in the timer"""
+    channel = max(1, min(int(params['focus_channel']), imp.getNChannels()))
+    with timer.stage("focus"):
+        scores = focus_scores(imp, channel, rect, metric=params['focus_metric'])
+    zslice = best_focus(scores)
+    timer.note("focus_z", zslice)
+    timer.note("focus_score", round(scores[zslice - 1], 4))
+    return zslice
+
+
+def extract_planes(imp, params, loaded_planes=None, projection=True):
+    """z-slice + Z projections of every channel in a single pass (ifigure_engine.py)
+
+    Returns (slice_ips, {stat: [ip per channel]}) for the statistics in
+    params['projections']. loaded_planes = (slice_imp, range_imp) when only
+    the ROI and the needed planes were read from the file (see
+    ifigure_loader.py), imp is then unused. projection=False skips the
+    projections (the dict is then empty).
+    """
+    stats = params['projections'] if projection else ()
+    if loaded_planes is not None:
+        slice_imp, range_imp = loaded_planes
+        n_range = range_imp.getNSlices()
+        z_first = 1 if projection else None
+        if slice_imp is None:
+            # zslice lies inside the loaded z-range
+            return fused_slice_and_project(range_imp, params['zslice'] - params['z_start'] + 1, z_first, n_range,
+                                           stats=stats)
+        slice_ips = fused_slice_and_project(slice_imp, 1, None, None)[0]
+        if not projection:
+            return slice_ips, {}
+        return slice_ips, fused_slice_and_project(range_imp, None, 1, n_range, stats=stats)[1]
+
+    #--------- ROI selection (optional - use whole image if no ROI)
+    roi = imp.getRoi()
+    rect = roi.getBounds() if roi is not None and roi.isArea() else None
+    z_start = params['z_start'] if projection else None
+    # planes are cropped to the ROI bounds as they are read, the stack is never duplicated
+    return fused_slice_and_project(imp, params['zslice'], z_start, params['z_end'], rect, stats)
+
+
+def _finish(canvas, title, workspace):
+    """Figure of a filled canvas; the canvas planes are freed as soon as they are packed"""
+    fig = workspace.track(canvas.image(title))
+    workspace.release([canvas.red, canvas.green_blue])
+    return fig
+
+
+def compose_single_row(top, panel_labels, font_size=None, workspace=NO_WORKSPACE):
+    """One-row figure: the grey panels, then the red + white composite
+
+    top is the 8-bit channels of the row, (grey panels..., (red, white)).
+    """
+    gray, (red, white) = top[:-1], top[-1]
+    plan = plan_for("single", red.getWidth(), red.getHeight(), panel_labels, font_size=font_size)
+    canvas = FigureCanvas(plan)
+    workspace.track([canvas.red, canvas.green_blue])
+    for (x_pos, y_pos), ip8 in zip(plan.top, gray):
+        canvas.gray(ip8, x_pos, y_pos)
+    x_pos, y_pos = plan.top[len(gray)]
+    canvas.red_white(red, white, x_pos, y_pos)
+    return _finish(canvas, "Figure", workspace)
+
+
+def compose_combined(top, rows_z, panel_labels, font_size=None, workspace=NO_WORKSPACE):
+    """Combined figure - single slice top row, one z-projection row per (channels, label_suffix) in rows_z
+
+    Channels as in compose_single_row: 8-bit grey channels, then the (red,
+    white) pair of the composite panel.
+    """
+    red, white = top[-1]
+    red_z, white_z = rows_z[0][0][-1]
+    plan = plan_for("combined", red.getWidth(), red.getHeight(), panel_labels, red_z.getWidth(),
+                    red_z.getHeight(), [suffix for channels, suffix in rows_z], font_size)
+    canvas = FigureCanvas(plan)
+    workspace.track([canvas.red, canvas.green_blue])
+
+    #--------- Top row - single slice, Bottom rows - z projections
+    for positions, channels in [(plan.top, top)] + [(p, ch) for p, (ch, suffix) in zip(plan.rows, rows_z)]:
+        for (x_pos, y_pos), ip8 in zip(positions, channels[:-1]):
+            canvas.gray(ip8, x_pos, y_pos)
+        x_pos, y_pos = positions[len(channels) - 1]
+        canvas.red_white(channels[-1][0], channels[-1][1], x_pos, y_pos)
+    return _finish(canvas, "Combined Figure", workspace)
+
+
+def build_figures(imp, params, loaded_planes=None, blur_cache=None, timer=NO_TIMER, range_max=None,
+                  workspace=NO_WORKSPACE):
+    """Build the figures requested by params['layout'], returns {"single"/"combined": ImagePlus}
+
+    Every channel is converted to 8-bit once and shared by all requested
+    layouts, which LUT-blit it into the figure (ifigure_layout.py); the bottom
+    rows (projections, blur, 8-bit) are only computed for "combined".
+    Each displayed channel is blurred once; blur_cache (a BlurCache of imp)
+    keeps the blurred planes between calls. timer (ifigure_metrics.StageTimer)
+    records the project, blur, normalize and compose stages.
+    params['autofocus'] replaces the z-slice by the sharpest one (auto_focus).
+    range_max (an ifigure_engine.RangeMaxIndex of imp) answers the max
+    projection from two planes instead of a pass over the z-range.
+    workspace (ifigure_workspace.Workspace) tracks the planes, 8-bit copies
+    and figures; the caller frees them, or keeps the figures it hands on.
+    """
+    if loaded_planes is not None:
+        params = dict(DEFAULT_PARAMS, **dict((k, v) for k, v in params.items() if v is not None))
+    else:
+        params = resolve_params(params, imp.getNSlices())
+    if params['layout'] not in LAYOUTS:
+        raise ValueError("Unknown layout: {} (use one of {})".format(params['layout'], ", ".join(sorted(LAYOUTS))))
+    outputs = LAYOUTS[params['layout']]
+    if "combined" in outputs and not params['projections']:
+        raise ValueError("The combined figure needs at least one projection")
+    for stat in params['projections']:
+        if stat not in STATISTICS:
+            raise ValueError("Unknown projection: {} (use {})".format(stat, ", ".join(STATISTICS)))
+    panel_labels = params['panel_labels']
+    blur_sigma = params['blur_sigma']
+
+    roi = imp.getRoi() if loaded_planes is None else None
+    rect = roi.getBounds() if roi is not None and roi.isArea() else None
+    source = (rect.x, rect.y, rect.width, rect.height) if rect is not None else None
+
+    # loaded planes were read for a z-slice the caller already picked
+    if params['autofocus'] and loaded_planes is None:
+        params['zslice'] = auto_focus(imp, params, rect, timer)
+
+    with timer.stage("project"):
+        if range_max is not None and loaded_planes is None and "max" in params['projections']:
+            others = [stat for stat in params['projections'] if stat != "max"]
+            slice_ips, projected = extract_planes(imp, dict(params, projections=others), None,
+                                                  "combined" in outputs and bool(others))
+            if "combined" in outputs:
+                projected["max"] = [range_max.query(c, params['z_start'], params['z_end'], rect)
+                                    for c in range(1, range_max.channels() + 1)]
+        else:
+            slice_ips, projected = extract_planes(imp, params, loaded_planes, "combined" in outputs)
+        workspace.track([slice_ips, projected])
+
+    if blur_cache is None or loaded_planes is not None:
+        blur_cache = BlurCache(0)
+
+    processed = []
+    with timer.stage("blur"):
+        for c, ip in enumerate(slice_ips):
+            ch = ImagePlus("C{}".format(c + 1), ip)
+            processed.append(blur_cache.blurred(("slice", c, params['zslice'], source), ch, blur_sigma))
+
+    # processed[0] = kanal 1/3
+    # processed[1] = kanal 2/3
+    # processed[2] = kanal 3/3
+
+    #--------- normalizacija svih kanala
+    # trenutno po mom shvaćanju normalizacija nije potrebna ukoliko je
+    # tijekom mikroskopiranja sve dobro postimano, zato je po defaultu iskljucena
+    if params['normalize']:
+        with timer.stage("normalize"):
+            processed = [normalize_channel(ch, params['normalize_low'], params['normalize_high'])
+                         for ch in processed]
+            workspace.track([p.getProcessor() for p in processed])
+
+    with timer.stage("compose"):
+        #--------- Layout panela - mijenjanje poretka
+        # converted to 8-bit once, shared by the single row and the combined figure;
+        # merged = kanal 1 (red) + kanal 2 (white)
+        top = [display8(p.getProcessor()) for p in [processed[2], processed[0], processed[1]]]
+        top.append((merge8(processed[0].getProcessor()), merge8(processed[1].getProcessor())))
+        workspace.track(top)
+
+    figures = {}
+    if "single" in outputs:
+        with timer.stage("compose"):
+            figures["single"] = compose_single_row(top, panel_labels, params['font_size'], workspace)
+    if "combined" not in outputs:
+        return figures
+
+    #--------- Z projekcije (already projected in the fused pass above)
+    rows_z = []
+    for stat in params['projections']:
+        #--------- sastavljanje composita za projection (bez normalizacije)
+        if len(projected[stat]) < 2:
+            raise ValueError("Image has {} channels, but 2 channels are required for Z-projection.".format(
+                len(projected[stat])))
+
+        # only the first 2 projected channels are shown, the rest is never blurred
+        proc_z = []
+        with timer.stage("blur"):
+            for c, ip in enumerate(projected[stat][:2]):
+                proj_ch = ImagePlus("{}_C{}".format(stat.upper(), c + 1), ip)
+                key = (stat, c, params['z_start'], params['z_end'], source)
+                proc_z.append(blur_cache.blurred(key, proj_ch, blur_sigma))
+
+        with timer.stage("compose"):
+            # channel 0, channel 1, and merged (0+1)
+            ips = [p.getProcessor() for p in proc_z]
+            channels_z = workspace.track([display8(ips[0]), display8(ips[1]), (merge8(ips[0]), merge8(ips[1]))])
+        rows_z.append((channels_z, PROJECTION_SUFFIXES.get(stat, params['projection_suffix'])))
+
+    with timer.stage("compose"):
+        figures["combined"] = compose_combined(top, rows_z, panel_labels, params['font_size'], workspace)
+    return figures
+
+
+def build_figure(imp, params, loaded_planes=None, timer=NO_TIMER, workspace=NO_WORKSPACE):
+    """Build the combined figure for imp (ROI = imp.getRoi()), returns an RGB ImagePlus"""
+    params = dict(params, layout="combined")
+    return build_figures(imp, params, loaded_planes, timer=timer, workspace=workspace)["combined"]
@@ -0,0 +1,284 @@
+"""
+Fused single-pass slice extraction + Z projections
+
+Every (channel, z) plane the figure needs, the selected z-slice and the
+projection range, is visited exactly once; planes between the two are never
+read (they may be loaded lazily from a virtual stack). The plane is
+folded into running per-channel accumulators (max, sum, and the sums of the
+deviations from the first plane and of their squares, for the SD) and,
+if it is the selected z-slice, copied out for the top row. Max, mean, sum and
+standard deviation all come from the same pass; no substacks, split
+channels or ZProjector images are created on the way.
+
+The median can't be accumulated; it is computed from buffered planes when
+they fit in MEDIAN_BUFFER_BYTES, otherwise in row strips that do (one extra
+read of the range per strip).
+
+RangeMaxIndex answers the max projection of any z-range from two
+precomputed planes, for the interactive preview where the range is tuned.
+
+focus_scores rates the sharpness of every z-plane of one channel (variance
+of the Laplacian, or normalized variance) for the auto-focus z-slice.
+"""
+
+from ij import ImagePlus, ImageStack
+from ij.plugin import ZProjector
+from ij.process import Blitter, FloatProcessor
+
+STATISTICS = ["max", "mean", "sum", "sd", "median"]
+# "laplacian" = variance of the Laplacian, "normvar" = variance / mean
+FOCUS_METRICS = ["laplacian", "normvar"]
+LAPLACIAN = [0, 1, 0, 1, -4, 1, 0, 1, 0]
+
+# planes kept in memory at once for the median projection
+MEDIAN_BUFFER_BYTES = 256 * 1024 * 1024
+
+
+def _crop(ip, rect):
+    """Copy of the plane, cropped to rect when given"""
+    if rect is None:
+        return ip.duplicate()
+    ip.setRoi(rect)
+    return ip.crop()
+
+
+def channel_display_range(imp, c):
+    """Display range of channel c (1-based), as ChannelSplitter would copy it"""
+    if imp.isComposite():
+        lut = imp.getChannelLut(c)
+        return lut.min, lut.max
+    return imp.getDisplayRangeMin(), imp.getDisplayRangeMax()
+
+
+class _Accumulator(object):
+    """Running per-pixel statistics of one channel"""
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.n = 0
+        self.max_ip = None
+        self.sum_ip = None
+        # SD: sums of d = plane - first plane and of d^2; without the shift the float32
+        # sum of squares of bright 16-bit stacks cancels (n*sumsq - sum^2 loses every digit)
+        self.shift_ip = None
+        self.dsum_ip = None
+        self.dsumsq_ip = None
+
+    def add(self, ip, rect, ox, oy):
+        if "max" in self.stats:
+            if self.max_ip is None:
+                self.max_ip = _crop(ip, rect)
+            else:
+                # negative offsets clip the source to the ROI, no intermediate copy
+                self.max_ip.copyBits(ip, ox, oy, Blitter.MAX)
+        if "mean" in self.stats or "sum" in self.stats or "sd" in self.stats:
+            plane = _crop(ip, rect).convertToFloatProcessor()
+            if self.sum_ip is None:
+                self.sum_ip = FloatProcessor(plane.getWidth(), plane.getHeight())
+                if "sd" in self.stats:
+                    self.shift_ip = plane.duplicate()
+                    self.dsum_ip = FloatProcessor(plane.getWidth(), plane.getHeight())
+                    self.dsumsq_ip = FloatProcessor(plane.getWidth(), plane.getHeight())
+            self.sum_ip.copyBits(plane, 0, 0, Blitter.ADD)
+            if self.shift_ip is not None:
+                plane.copyBits(self.shift_ip, 0, 0, Blitter.SUBTRACT)
+                self.dsum_ip.copyBits(plane, 0, 0, Blitter.ADD)
+                plane.sqr()
+                self.dsumsq_ip.copyBits(plane, 0, 0, Blitter.ADD)
+        self.n += 1
+
+    def result(self, stat):
+        n = self.n
+        if stat == "max":
+            return self.max_ip
+        if stat == "sum":
+            return self.sum_ip
+        if stat == "mean":
+            mean = self.sum_ip.duplicate()
+            mean.multiply(1.0 / n)
+            return mean
+        if stat == "sd":
+            # sample standard deviation, as ZProjector.SD_METHOD (shift-invariant, so from the deviations)
+            if n < 2:
+                return FloatProcessor(self.sum_ip.getWidth(), self.sum_ip.getHeight())
+            sq_of_sum = self.dsum_ip.duplicate()
+            sq_of_sum.sqr()
+            var = self.dsumsq_ip.duplicate()
+            var.multiply(n)
+            var.copyBits(sq_of_sum, 0, 0, Blitter.SUBTRACT)
+            var.multiply(1.0 / (n * (n - 1)))
+            var.min(0.0)  # rounding can make it slightly negative
+            var.sqrt()
+            return var
+        raise ValueError("Unknown projection: {}".format(stat))
+
+
+def median_projection(imp, c, z_start, z_end, rect=None, frame=1, buffer_bytes=MEDIAN_BUFFER_BYTES):
+    """Median over z_start..z_end of channel c, in row strips that fit buffer_bytes"""
+    stack = imp.getStack()
+    if rect is None:
+        x, y, w, h = 0, 0, imp.getWidth(), imp.getHeight()
+    else:
+        x, y, w, h = rect.x, rect.y, rect.width, rect.height
+    n = z_end - z_start + 1
+    bytes_per_row = w * n * max(1, imp.getBitDepth() // 8)
+    strip_rows = max(1, min(h, int(buffer_bytes // bytes_per_row)))
+
+    median = FloatProcessor(w, h)
+    for y0 in range(0, h, strip_rows):
+        rows = min(strip_rows, h - y0)
+        strip = ImageStack(w, rows)
+        for z in range(z_start, z_end + 1):
+            ip = stack.getProcessor(imp.getStackIndex(c, z, frame))
+            ip.setRoi(x, y + y0, w, rows)
+            strip.addSlice(ip.crop())
+        zproj = ZProjector(ImagePlus("strip", strip))
+        zproj.setMethod(ZProjector.MEDIAN_METHOD)
+        zproj.doProjection()
+        median.insert(zproj.getProjection().getProcessor().convertToFloatProcessor(), 0, y0)
+    return median
+
+
+def fused_slice_and_project(imp, zslice, z_start, z_end, rect=None, stats=("max",), frame=1):
+    """One pass over the stack, returns (slice_ips, {stat: [ip per channel]})
+
+    zslice, z_start and z_end are 1-based. zslice=None skips the slice,
+    z_start=None skips the projections. rect crops the planes to the ROI
+    bounds without copying the whole plane. "max" keeps the pixel type, the
+    other statistics are 32-bit.
+    """
+    for stat in stats:
+        if stat not in STATISTICS:
+            raise ValueError("Unknown projection: {} (use {})".format(stat, ", ".join(STATISTICS)))
+    stack = imp.getStack()
+    channels = imp.getNChannels()
+    if rect is not None:
+        ox, oy = -rect.x, -rect.y
+    else:
+        ox, oy = 0, 0
+    if z_start is None:
+        stats = ()
+    streamed = [s for s in stats if s != "median"]
+
+    # the slice and the range, not the planes between them when the slice lies outside
+    z_planes = set()
+    if zslice is not None:
+        z_planes.add(zslice)
+    if streamed:
+        z_planes.update(range(z_start, z_end + 1))
+
+    slice_ips = []
+    projections = dict((stat, []) for stat in stats)
+    for c in range(1, channels + 1):
+        slice_ip = None
+        acc = _Accumulator(streamed)
+        for z in sorted(z_planes):
+            ip = stack.getProcessor(imp.getStackIndex(c, z, frame))
+            if z == zslice:
+                slice_ip = _crop(ip, rect)
+            if streamed and z_start <= z <= z_end:
+                acc.add(ip, rect, ox, oy)
+
+        if slice_ip is not None:
+            lo, hi = channel_display_range(imp, c)
+            slice_ip.setMinAndMax(lo, hi)
+        slice_ips.append(slice_ip)
+
+        for stat in stats:
+            if stat == "median":
+                proj = median_projection(imp, c, z_start, z_end, rect, frame)
+            else:
+                proj = acc.result(stat)
+            # same as a ZProjector output image, scaled to its own min/max
+            proj.resetMinAndMax()
+            projections[stat].append(proj)
+    return slice_ips, projections
+
+
+def range_max_bytes(imp, channels=2):
+    """Memory of a RangeMaxIndex of imp: about n log2(n) planes per channel"""
+    n = imp.getNSlices()
+    planes = 0
+    size = 1
+    while size <= n:
+        planes += n - size + 1
+        size *= 2
+    plane_bytes = imp.getWidth() * imp.getHeight() * max(1, imp.getBitDepth() // 8)
+    return planes * plane_bytes * min(channels, imp.getNChannels())
+
+
+class RangeMaxIndex(object):
+    """Sparse table of per-pixel z maxima of the first channels of a stack
+
+    table[k][i] is the max of z-planes i..i + 2**k - 1 (0-based), built once
+    with n log n MAX blits. query() covers any z-range with the two
+    overlapping power-of-two blocks, so a max projection costs two planes
+    whatever the range. The stack must not change while the index is used.
+    """
+
+    def __init__(self, imp, channels=2, frame=1):
+        stack = imp.getStack()
+        n = imp.getNSlices()
+        self.tables = []
+        for c in range(1, min(channels, imp.getNChannels()) + 1):
+            # level 0 are the stack planes themselves, never modified
+            table = [[stack.getProcessor(imp.getStackIndex(c, z, frame)) for z in range(1, n + 1)]]
+            half = 1
+            while 2 * half <= n:
+                prev = table[-1]
+                level = []
+                for i in range(n - 2 * half + 1):
+                    ip = prev[i].duplicate()
+                    ip.copyBits(prev[i + half], 0, 0, Blitter.MAX)
+                    level.append(ip)
+                table.append(level)
+                half *= 2
+            self.tables.append(table)
+
+    def channels(self):
+        return len(self.tables)
+
+    def query(self, c, z_start, z_end, rect=None):
+        """Max projection of z_start..z_end (1-based, inclusive) of channel c, cropped to rect"""
+        table = self.tables[c - 1]
+        i, j = z_start - 1, z_end - 1
+        k = 0
+        while (2 << k) <= j - i + 1:
+            k += 1
+        proj = _crop(table[k][i], rect)
+        ox, oy = (-rect.x, -rect.y) if rect is not None else (0, 0)
+        proj.copyBits(table[k][j - (1 << k) + 1], ox, oy, Blitter.MAX)
+        # same as a ZProjector output image, scaled to its own min/max
+        proj.resetMinAndMax()
+        return proj
+
+
+def focus_score(ip, metric="laplacian"):
+    """Sharpness of one plane, larger is sharper"""
+    fp = ip.duplicate() if ip.getBitDepth() == 32 else ip.convertToFloat()
+    if metric == "laplacian":
+        # kernel sum is 0, so convolve3x3 does not rescale; edges repeat the border pixels
+        fp.convolve3x3(LAPLACIAN)
+        return fp.getStatistics().stdDev ** 2
+    stats = fp.getStatistics()
+    return stats.stdDev ** 2 / stats.mean if stats.mean > 0 else 0.0
+
+
+def focus_scores(imp, c=1, rect=None, frame=1, metric="laplacian"):
+    """[score per z] of channel c (1-based) within rect, one read of each plane"""
+    if metric not in FOCUS_METRICS:
+        raise ValueError("Unknown focus metric: {} (use {})".format(metric, ", ".join(FOCUS_METRICS)))
+    stack = imp.getStack()
+    scores = []
+    for z in range(1, imp.getNSlices() + 1):
+        ip = stack.getProcessor(imp.getStackIndex(c, z, frame))
+        if rect is not None:
+            ip.setRoi(rect)
+            ip = ip.crop()
+        scores.append(focus_score(ip, metric))
+    return scores
+
+
+def best_focus(scores):
+    """1-based z of the highest score"""
+    return max(range(len(scores)), key=lambda i: scores[i]) + 1
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Figure layout plans and LUT blitting of the panels
+
+A FigurePlan holds everything about a figure that depends only on the panel
+sizes, the labels and the font: figure size, panel positions, font and
+label positions (font metrics included). plan_for() keeps the plans, so a
+batch of equally sized crops computes them once.
+
+FigureCanvas takes the 8-bit channels of the panels and writes them into
+the figure through their LUTs: grey (R = G = B = v), and the red + white
+composite (R = min(255, r + w), G = B = w). Both LUTs give G == B, so the
+canvas is one red plane and one green/blue plane, written with ImageJ's
+blitters (COPY, ADD for the composite) and packed into the figure's RGB
+pixels in one pass - no RGB copy of any panel.
+"""
+
+from ij import ImagePlus
+from ij.process import ByteProcessor, ColorProcessor, Blitter
+from java.awt import Color, Font
+from collections import OrderedDict
+import threading
+
+#--------- podešavanje izgleda crne pozadine i teksta
+PADDING = 60
+LABEL_SPACE = 30
+ROW_LABEL_SPACE = 30
+
+# plans kept by plan_for, one per panel size / label set in use
+MAX_PLANS = 64
+
+
+def combined_geometry(w, h, w_z, h_z, num_panels, num_bottom, num_rows):
+    """Size and panel positions of the combined figure, returns (width, height, top, rows)
+
+    top is the [(x, y)] of the top row panels, rows one [(x, y)] list per
+    projection row (offset by one panel width to the right).
+    """
+    width = w * num_panels + PADDING * (num_panels + 1)
+    height = h + num_rows * h_z + (num_rows + 2) * PADDING + (num_rows + 1) * ROW_LABEL_SPACE
+    top = [(PADDING + i * (w + PADDING), PADDING + ROW_LABEL_SPACE) for i in range(num_panels)]
+    rows = []
+    for row in range(num_rows):
+        y_pos = PADDING + ROW_LABEL_SPACE + h + (row + 1) * (PADDING + ROW_LABEL_SPACE) + row * h_z
+        rows.append([(PADDING + (i + 1) * (w_z + PADDING), y_pos) for i in range(num_bottom)])
+    return width, height, top, rows
+
+
+class FigurePlan(object):
+    """Geometry, font and label positions of one figure
+
+    kind "single": one row of len(panel_labels) panels of w x h.
+    kind "combined": that top row plus one row of 3 panels of w_z x h_z per
+    label suffix in suffixes (the projection rows).
+    """
+
+    def __init__(self, kind, w, h, panel_labels, w_z=None, h_z=None, suffixes=(), font_size=None):
+        self.kind = kind
+        num_panels = len(panel_labels)
+        if kind == "single":
+            self.width = w * num_panels + PADDING * (num_panels + 1)
+            self.height = h + 2 * PADDING + LABEL_SPACE  # extra space for labels
+            #--------- centriranje slika
+            y_pos = PADDING + (self.height - 2 * PADDING - h)//2
+            self.top = [(PADDING + i * (w + PADDING), y_pos) for i in range(num_panels)]
+            self.rows = []
+            # font proportional to the panel width
+            font_size = font_size or max(10, int(w / 30.0))
+        else:
+            self.width, self.height, self.top, self.rows = combined_geometry(
+                w, h, w_z, h_z, num_panels, 3, len(suffixes))
+            # font proportional to the panel height
+            font_size = font_size or max(10, int(h / 20.0))
+        self.font = Font("SansSerif", Font.BOLD, font_size)
+
+        #--------- label positions, centred above the panels
+        metrics = ColorProcessor(1, 1)
+        metrics.setFont(self.font)
+        self.labels = []
+        for i, (x_pos, y_pos) in enumerate(self.top):
+            label = panel_labels[i]
+            x = x_pos + (w - metrics.getStringWidth(label))//2
+            self.labels.append((label, x, PADDING//2 if kind == "single" else y_pos - 10))
+        # custom labels of the projected channels, then "Merged"
+        for positions, suffix in zip(self.rows, suffixes):
+            for i, (x_pos, y_pos) in enumerate(positions):
+                label = panel_labels[i + 1] + suffix
+                self.labels.append((label, x_pos + (w_z - metrics.getStringWidth(label))//2, y_pos - 10))
+
+    def draw_labels(self, ip):
+        ip.setFont(self.font)
+        ip.setColor(Color.white)
+        for label, x, y in self.labels:
+            ip.drawString(label, x, y)
+
+
+_plans = OrderedDict()
+_plans_lock = threading.Lock()
+
+
+def plan_for(kind, w, h, panel_labels, w_z=None, h_z=None, suffixes=(), font_size=None):
+    """FigurePlan for these sizes and labels, computed once and reused (thread-safe)"""
+    key = (kind, w, h, tuple(panel_labels), w_z, h_z, tuple(suffixes), font_size)
+    with _plans_lock:
+        plan = _plans.pop(key, None)
+        if plan is None:
+            plan = FigurePlan(kind, w, h, panel_labels, w_z, h_z, suffixes, font_size)
+        _plans[key] = plan
+        while len(_plans) > MAX_PLANS:
+            _plans.popitem(last=False)
+    return plan
+
+
+class FigureCanvas(object):
+    """Red and green/blue planes of a figure, filled panel by panel, black background"""
+
+    def __init__(self, plan):
+        self.plan = plan
+        self.red = ByteProcessor(plan.width, plan.height)
+        self.green_blue = ByteProcessor(plan.width, plan.height)
+
+    def gray(self, ip8, x, y):
+        """Grey LUT panel of an 8-bit channel, top left corner at x, y"""
+        self.red.insert(ip8, x, y)
+        self.green_blue.insert(ip8, x, y)
+
+    def red_white(self, red8, white8, x, y):
+        """Red + white composite panel of two 8-bit channels (additive, saturating)"""
+        self.red.insert(red8, x, y)
+        self.red.copyBits(white8, x, y, Blitter.ADD)
+        self.green_blue.insert(white8, x, y)
+
+    def image(self, title):
+        """The finished figure with its labels, as an RGB ImagePlus"""
+        cp = ColorProcessor(self.plan.width, self.plan.height)
+        cp.setRGB(self.red.getPixels(), self.green_blue.getPixels(), self.green_blue.getPixels())
+        self.plan.draw_labels(cp)
+        return ImagePlus(title, cp)
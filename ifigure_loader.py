@@ -0,0 +1,243 @@
+"""
+Crop-on-read loading with Bio-Formats
+
+Instead of opening the whole hyperstack and duplicating it, only the ROI
+rectangle and the planes the figure needs (z_start..z_end plus zslice) are
+read from the file. Falls back to None when Bio-Formats is not installed, the
+caller then uses ij.io.Opener as before.
+
+Multi-position CZI and ND2 files hold many series (scenes, positions);
+list_series enumerates them from the metadata and every function here takes
+the series to read, so each one is loaded on its own.
+
+TileReader keeps one reader open for the tiles of a tiled render
+(ifigure_tiled.py), instead of a Bio-Formats setId per tile.
+"""
+
+from collections import OrderedDict
+import os
+import re
+import threading
+
+from ij import ImagePlus, ImageStack
+
+try:
+    import loci.plugins
+    from loci.plugins import BF
+    from loci.plugins.util import ImageProcessorReader
+    from loci.formats import ImageReader, ChannelSeparator, FormatTools, MetadataTools
+    from loci.common import Region
+    # "in" is a Python keyword, so the package can't be named in an import statement
+    ImporterOptions = getattr(loci.plugins, "in").ImporterOptions
+except ImportError:
+    BF = None
+
+# the figure uses the first 3 channels (3 single channel panels in the top row)
+FIGURE_CHANNELS = 3
+
+# list_series results kept, the memory estimate of a job and the job itself both need them
+MAX_LISTED = 256
+_listed = OrderedDict()
+_listed_lock = threading.Lock()
+
+
+def bioformats_available():
+    return BF is not None
+
+
+def _dimensions(reader, series):
+    reader.setSeries(series)
+    return {
+        'series': series,
+        'width': reader.getSizeX(),
+        'height': reader.getSizeY(),
+        'channels': reader.getSizeC(),
+        'slices': reader.getSizeZ(),
+        'frames': reader.getSizeT(),
+        'bytes_per_pixel': FormatTools.getBytesPerPixel(reader.getPixelType()),
+    }
+
+
+def list_series(path):
+    """Dimensions of every series plus 'number' (1-based) and 'name', pyramid sub-resolutions left out
+
+    The metadata of a file is read once while its size and mtime stay the same.
+    """
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_size, st.st_mtime)
+    with _listed_lock:
+        entries = _listed.get(key)
+    if entries is None:
+        entries = _read_series(path)
+        with _listed_lock:
+            _listed[key] = entries
+            while len(_listed) > MAX_LISTED:
+                _listed.popitem(last=False)
+    return [dict(e) for e in entries]
+
+
+def _read_series(path):
+    reader = ImageReader()
+    meta = MetadataTools.createOMEXMLMetadata()
+    reader.setMetadataStore(meta)
+    # one entry per series instead of one per resolution level; seriesToCoreIndex gives the
+    # index the importer (and TileReader) use, where every resolution is a series of its own
+    reader.setFlattenedResolutions(False)
+    try:
+        reader.setId(path)
+        result = []
+        for s in range(reader.getSeriesCount()):
+            reader.setSeries(s)
+            entry = _dimensions(reader, s)
+            entry['series'] = reader.seriesToCoreIndex(s)
+            entry['number'] = s + 1
+            entry['name'] = meta.getImageName(s) or ""
+            result.append(entry)
+        return result
+    finally:
+        reader.close()
+
+
+def figure_series(entries, selection="all"):
+    """Series to render: the selected numbers (or "all"), without label and overview images
+
+    Slide scans carry label/macro/preview images next to the scenes; series
+    with fewer channels than the figure needs are left out, unless no series
+    has enough (the figure then fails with the usual message).
+    """
+    if selection != "all":
+        entries = [e for e in entries if e['number'] in selection]
+    full = [e for e in entries if e['channels'] >= FIGURE_CHANNELS]
+    return full or entries
+
+
+def series_suffix(entry):
+    """File name suffix of one series, e.g. _s03_Scene_3"""
+    name = re.sub(r"[^A-Za-z0-9-]+", "_", entry['name']).strip("_")[:40]
+    suffix = "_s{:02d}".format(entry['number'])
+    return suffix + "_" + name if name else suffix
+
+
+def series_bytes(dims):
+    """Heap taken by a whole series once opened"""
+    return dims['width'] * dims['height'] * dims['channels'] * dims['slices'] * dims['frames'] * \
+        dims['bytes_per_pixel']
+
+
+def clip_roi(roi, width, height):
+    """Clamp an [x, y, w, h] ROI to the image, None means the whole image"""
+    if roi is None:
+        return None
+    x, y, w, h = roi
+    x = max(0, min(x, width - 1))
+    y = max(0, min(y, height - 1))
+    w = max(1, min(w, width - x))
+    h = max(1, min(h, height - y))
+    return [x, y, w, h]
+
+
+def open_planes(path, z_begin, z_end, roi=None, c_end=None, series=0, c_begin=1):
+    """Read z_begin..z_end (1-based, inclusive) of channels c_begin..c_end, cropped to roi"""
+    options = ImporterOptions()
+    options.setId(path)
+    options.setQuiet(True)
+    options.setWindowless(True)
+    options.setColorMode(ImporterOptions.COLOR_MODE_COMPOSITE)
+    options.setSeriesOn(0, series == 0)
+    options.setSeriesOn(series, True)
+    options.setSpecifyRanges(True)
+    options.setZBegin(series, z_begin - 1)
+    options.setZEnd(series, z_end - 1)
+    options.setZStep(series, 1)
+    if c_end is not None:
+        options.setCBegin(series, c_begin - 1)
+        options.setCEnd(series, c_end - 1)
+        options.setCStep(series, 1)
+    if roi is not None:
+        x, y, w, h = roi
+        options.setCrop(True)
+        options.setCropRegion(series, Region(x, y, w, h))
+    return BF.openImagePlus(options)[0]
+
+
+def open_series(path, series=0):
+    """Whole series as a hyperstack (interactive batch, which needs every plane for the dialog)"""
+    options = ImporterOptions()
+    options.setId(path)
+    options.setQuiet(True)
+    options.setWindowless(True)
+    options.setColorMode(ImporterOptions.COLOR_MODE_COMPOSITE)
+    options.setSeriesOn(0, series == 0)
+    options.setSeriesOn(series, True)
+    return BF.openImagePlus(options)[0]
+
+
+def load_figure_planes(path, params, dims, series=0):
+    """Read only what the figure renders, returns (slice_imp, range_imp)
+
+    range_imp holds z_start..z_end, slice_imp the single zslice plane; when
+    zslice lies inside the range slice_imp is None and the plane is taken
+    from range_imp by the fused engine (ifigure_engine.py).
+    """
+    roi = clip_roi(params['roi'], dims['width'], dims['height'])
+    c_end = min(dims['channels'], FIGURE_CHANNELS)
+    zslice = params['zslice']
+    z_start = params['z_start']
+    z_end = params['z_end']
+
+    range_imp = open_planes(path, z_start, z_end, roi, c_end, series)
+    if z_start <= zslice <= z_end:
+        slice_imp = None
+    else:
+        slice_imp = open_planes(path, zslice, zslice, roi, c_end, series)
+    return slice_imp, range_imp
+
+
+class TileReader(object):
+    """Planes of ROI tiles of one series, from a single open reader
+
+    planes() gives the same (slice_imp, range_imp) as load_figure_planes,
+    without the importer's autoscaled display ranges (see ifigure_tiled.py).
+    """
+
+    def __init__(self, path, series=0):
+        # ChannelSeparator splits RGB files into channels, as the importer does
+        self.reader = ImageProcessorReader(ChannelSeparator(ImageReader()))
+        self.reader.setId(path)
+        self.reader.setSeries(series)
+
+    def _hyperstack(self, z_begin, z_end, channels, rect):
+        x, y, w, h = rect
+        stack = ImageStack(w, h)
+        for z in range(z_begin, z_end + 1):
+            for c in range(channels):
+                stack.addSlice(self.reader.openProcessors(self.reader.getIndex(z - 1, c, 0), x, y, w, h)[0])
+        imp = ImagePlus("tile", stack)
+        imp.setDimensions(channels, z_end - z_begin + 1, 1)
+        return imp
+
+    def planes(self, params, dims, rect):
+        """(slice_imp, range_imp) of the tile rect = [x, y, w, h] (image coordinates)"""
+        channels = min(dims['channels'], FIGURE_CHANNELS)
+        range_imp = self._hyperstack(params['z_start'], params['z_end'], channels, rect)
+        if params['z_start'] <= params['zslice'] <= params['z_end']:
+            return None, range_imp
+        return self._hyperstack(params['zslice'], params['zslice'], channels, rect), range_imp
+
+    def close(self):
+        self.reader.close()
+
+
+def load_focus_planes(path, params, dims, max_bytes=None):
+    """Every z-plane of params['focus_channel'] within the ROI, for the auto-focus
+
+    With max_bytes (tiled mode) only the centre of the ROI that fits is read.
+    """
+    x, y, w, h = clip_roi(params['roi'], dims['width'], dims['height']) or [0, 0, dims['width'], dims['height']]
+    if max_bytes is not None:
+        side = int((max_bytes / float(dims['slices'] * dims['bytes_per_pixel'])) ** 0.5)
+        if side < w or side < h:
+            x, w = x + max(0, (w - side) // 2), min(w, side)
+            y, h = y + max(0, (h - side) // 2), min(h, side)
+    channel = max(1, min(int(params['focus_channel']), dims['channels']))
+    return open_planes(path, 1, dims['slices'], [x, y, w, h], channel, dims['series'], channel)
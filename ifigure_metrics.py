@@ -0,0 +1,171 @@
+"""
+Per-stage timing and heap instrumentation of the batch runs
+
+Every file gets a StageTimer; the pipeline wraps its stages in
+timer.stage("name") (open, project, blur, normalize, compose, save). A stage
+costs two clock reads and two heap samples (Runtime total - free, no GC), so
+it stays on in production. RunReport collects the timers of a batch, writes
+one CSV and one JSON row per file to the output folder and logs p50/p95 per
+stage and the slowest stages at the end. timer.note("name", value) adds a
+value of the file to its row (e.g. the auto-focus z-slice and score).
+"""
+
+from contextlib import contextmanager
+import csv
+import json
+import os
+import threading
+import time
+
+try:
+    from ij import IJ
+except ImportError:
+    IJ = None
+
+MB = 1024 * 1024
+STAGES = ["open", "project", "blur", "normalize", "compose", "save"]
+
+
+def heap_used():
+    """Used JVM heap in bytes (0 outside Fiji)"""
+    return IJ.currentMemory() if IJ is not None else 0
+
+
+class StageTimer(object):
+    """Accumulated wall time per stage and heap samples around the stages of one file"""
+
+    def __init__(self, key):
+        self.key = key
+        self.seconds = {}
+        self.heap_start = heap_used()
+        self.heap_peak = self.heap_start
+        self.heap_end = self.heap_start
+        self.values = {}
+
+    @contextmanager
+    def stage(self, name):
+        heap_before = heap_used()
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.seconds[name] = self.seconds.get(name, 0.0) + time.time() - start
+            self.heap_end = heap_used()
+            self.heap_peak = max(self.heap_peak, heap_before, self.heap_end)
+
+    def note(self, name, value):
+        """Value of the file for its report row"""
+        self.values[name] = value
+
+    def total(self):
+        return sum(self.seconds.values())
+
+    def summary(self):
+        """Stage times for the batch log, e.g. open 1.20s, project 0.35s"""
+        return ", ".join("{} {:.2f}s".format(name, self.seconds[name]) for name in _ordered(self.seconds))
+
+    def row(self, status):
+        row = {
+            'file': self.key,
+            'status': status,
+            'total_s': round(self.total(), 4),
+            'heap_start_mb': round(self.heap_start / float(MB), 1),
+            'heap_peak_mb': round(self.heap_peak / float(MB), 1),
+            'heap_end_mb': round(self.heap_end / float(MB), 1),
+        }
+        for name, seconds in self.seconds.items():
+            row[name + "_s"] = round(seconds, 4)
+        row.update(self.values)
+        return row
+
+
+class _NoTimer(object):
+    """Timer that records nothing, the default when a caller passes no timer"""
+
+    @contextmanager
+    def stage(self, name):
+        yield
+
+    def note(self, name, value):
+        pass
+
+
+NO_TIMER = _NoTimer()
+
+
+def _ordered(names):
+    return [s for s in STAGES if s in names] + sorted(n for n in names if n not in STAGES)
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a non-empty list"""
+    values = sorted(values)
+    rank = max(1, int(-(-p * len(values) // 100)))
+    return values[min(rank, len(values)) - 1]
+
+
+class RunReport(object):
+    """Timers of one batch run, thread-safe (tag: appended to the file names, e.g. the queue worker)"""
+
+    def __init__(self, tag=None):
+        self.lock = threading.Lock()
+        self.rows = []
+        self.created = time.strftime("%Y%m%d_%H%M%S") + ("_" + tag if tag else "")
+
+    def add(self, timer, status):
+        with self.lock:
+            self.rows.append(timer.row(status))
+
+    def stage_names(self):
+        names = set()
+        for row in self.rows:
+            names.update(k[:-2] for k in row if k.endswith("_s") and k != "total_s")
+        return _ordered(names)
+
+    def write(self, output_dir):
+        """Write ifigure_report_<time>.csv and .json, returns both paths"""
+        base = os.path.join(output_dir, "ifigure_report_{}".format(self.created))
+        columns = ['file', 'status', 'total_s'] + [s + "_s" for s in self.stage_names()] + \
+                  ['heap_start_mb', 'heap_peak_mb', 'heap_end_mb']
+        with self.lock:
+            rows = list(self.rows)
+        # timer.note values, in columns after the fixed ones
+        columns += sorted(set(k for row in rows for k in row if k not in columns and not k.endswith("_s")))
+        with open(base + ".csv", "w") as f:
+            writer = csv.DictWriter(f, columns, lineterminator="\n")
+            writer.writeheader()
+            for row in rows:
+                writer.writerow(row)
+        with open(base + ".json", "w") as f:
+            json.dump({'files': rows, 'summary': self.summary()}, f, indent=1, sort_keys=True)
+        return base + ".csv", base + ".json"
+
+    def summary(self):
+        """{stage: {'p50': s, 'p95': s, 'max': s, 'slowest': file}}"""
+        result = {}
+        for name in self.stage_names():
+            times = [(row[name + "_s"], row['file']) for row in self.rows if name + "_s" in row]
+            values = [t for t, f in times]
+            slowest = max(times)
+            result[name] = {'p50': percentile(values, 50), 'p95': percentile(values, 95),
+                            'max': slowest[0], 'slowest': slowest[1]}
+        return result
+
+    def summary_lines(self, top=5):
+        """Lines for the batch log: p50/p95 per stage, then the slowest (file, stage) pairs"""
+        if not self.rows:
+            return []
+        summary = self.summary()
+        lines = ["Stage times (p50 / p95 / max):"]
+        for name in self.stage_names():
+            s = summary[name]
+            lines.append("  {:<10} {:.2f}s / {:.2f}s / {:.2f}s".format(name, s['p50'], s['p95'], s['max']))
+        pairs = []
+        for row in self.rows:
+            for name in self.stage_names():
+                if name + "_s" in row:
+                    pairs.append((row[name + "_s"], row['file'], name))
+        lines.append("Slowest stages:")
+        for seconds, key, name in sorted(pairs, reverse=True)[:top]:
+            lines.append("  {:.2f}s  {} ({})".format(seconds, key, name))
+        return lines
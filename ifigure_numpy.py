@@ -0,0 +1,476 @@
+"""
+Pure NumPy reference engine for the IFigure pipeline (CPython, no Fiji/JVM)
+
+Same steps as ifigure_core.build_figure: ROI crop, z-slice pick, Z
+projections (max, mean, sum, sd, median), Gaussian blur, optional normalize_channel, LUT colouring,
+red/white composite and the combined panel layout. All steps are vectorized
+array operations. Panel pixels match the Fiji output within a small
+tolerance (blur rounding, 8-bit scaling); labels are only drawn when Pillow
+is installed, so compare the engines with compare_figures() which looks at
+the panel areas only.
+
+    python ifigure_numpy.py stack.tif figure.png --blur 1.0 --zslice 12 --z-range 5 20
+
+Requires numpy and tifffile (Pillow optional, for labels and PNG/JPEG output).
+"""
+
+import argparse
+import math
+
+import numpy as np
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+try:
+    from PIL import Image, ImageDraw, ImageFont
+except ImportError:
+    Image = None
+
+# same defaults and layout as ifigure_core.py
+DEFAULT_PARAMS = {
+    'blur_sigma': 0.0,
+    'zslice': None,          # None = middle slice
+    'z_start': None,         # None = first slice
+    'z_end': None,           # None = last slice
+    'panel_labels': ["Cyan", "Far red", "Red", "Merged"],
+    'normalize': False,
+    'normalize_low': 0.0,    # percentile mapped to 0
+    'normalize_high': 100.0, # percentile mapped to 255
+    'font_size': None,
+    'projection_suffix': " (Max Z)",
+    'projections': ["max"],  # bottom rows, any of STATISTICS
+    'roi': None,             # [x, y, width, height]
+    'display_ranges': None,  # per channel (min, max) of the top row, None = whole stack min/max
+    'autofocus': False,      # zslice = sharpest plane of focus_channel (within the ROI)
+    'focus_channel': 1,
+    'focus_metric': "laplacian",
+}
+
+STATISTICS = ["max", "mean", "sum", "sd", "median"]
+FOCUS_METRICS = ["laplacian", "normvar"]
+PROJECTION_SUFFIXES = {
+    'mean': " (Mean Z)",
+    'sum': " (Sum Z)",
+    'sd': " (SD Z)",
+    'median': " (Median Z)",
+}
+
+PADDING = 60
+ROW_LABEL_SPACE = 30
+
+# kernels longer than this are applied by FFT instead of one shifted add per tap
+FFT_KERNEL_RADIUS = 24
+
+
+#--------- loading
+
+def to_czyx(data, axes):
+    """Reorder a tifffile array with the given axes string to (C, Z, Y, X), first T only"""
+    axes = axes.upper()
+    for ax in "TS":
+        if ax in axes and ax not in "CZYX":
+            data = np.take(data, 0, axis=axes.index(ax))
+            axes = axes.replace(ax, "")
+    for ax in "CZ":
+        if ax not in axes:
+            data = data[np.newaxis]
+            axes = ax + axes
+    # any other axis letters (e.g. I, Q) are treated as Z
+    axes = "".join(a if a in "CZYX" else "Z" for a in axes)
+    return np.transpose(data, [axes.index(a) for a in "CZYX"])
+
+
+def load_stack(path):
+    """Read a TIFF hyperstack as a (C, Z, Y, X) array"""
+    if tifffile is None:
+        raise ImportError("tifffile is required to read {}".format(path))
+    with tifffile.TiffFile(path) as tif:
+        series = tif.series[0]
+        return to_czyx(series.asarray(), series.axes)
+
+
+#--------- pipeline steps
+
+def resolve_params(params, slices):
+    """Defaults for missing parameters, z values clamped to the stack (as ifigure_core)"""
+    p = dict(DEFAULT_PARAMS)
+    p.update(dict((k, v) for k, v in params.items() if v is not None))
+    if p['zslice'] is None:
+        p['zslice'] = (slices + 1) // 2  # ifigure_core.middle_slice
+    if p['z_start'] is None:
+        p['z_start'] = 1
+    if p['z_end'] is None:
+        p['z_end'] = slices
+    p['zslice'] = int(max(1, min(p['zslice'], slices)))
+    p['z_start'] = int(max(1, min(p['z_start'], slices)))
+    p['z_end'] = int(max(p['z_start'], min(p['z_end'], slices)))
+    return p
+
+
+def crop(stack, roi):
+    """Crop (C, Z, Y, X) to an [x, y, w, h] ROI clamped to the image"""
+    if roi is None:
+        return stack
+    x, y, w, h = roi
+    height, width = stack.shape[-2:]
+    x = max(0, min(x, width - 1))
+    y = max(0, min(y, height - 1))
+    return stack[..., y:y + max(1, min(h, height - y)), x:x + max(1, min(w, width - x))]
+
+
+def project(stack, z_start, z_end, stat="max"):
+    """(C, Y, X) projection of z_start..z_end (1-based, inclusive) as ifigure_engine
+
+    max keeps the pixel type, the other statistics are float32; sd is the
+    sample standard deviation (ZProjector.SD_METHOD).
+    """
+    z = stack[:, z_start - 1:z_end]
+    if stat == "max":
+        return z.max(axis=1)
+    z = z.astype(np.float64)
+    if stat == "sum":
+        out = z.sum(axis=1)
+    elif stat == "mean":
+        out = z.mean(axis=1)
+    elif stat == "sd":
+        out = z.std(axis=1, ddof=1) if z.shape[1] > 1 else np.zeros(z.shape[:1] + z.shape[2:])
+    elif stat == "median":
+        out = np.median(z, axis=1)
+    else:
+        raise ValueError("Unknown projection: {} (use {})".format(stat, ", ".join(STATISTICS)))
+    return out.astype(np.float32)
+
+
+def slice_and_max(stack, zslice, z_start, z_end):
+    """(C, Y, X) z-slice and (C, Y, X) max projection of z_start..z_end (1-based, inclusive)"""
+    return stack[:, zslice - 1], project(stack, z_start, z_end, "max")
+
+
+def focus_scores(planes, metric="laplacian"):
+    """Sharpness of every plane of a (Z, Y, X) stack, all planes at once (as ifigure_engine.focus_scores)"""
+    if metric not in FOCUS_METRICS:
+        raise ValueError("Unknown focus metric: {} (use {})".format(metric, ", ".join(FOCUS_METRICS)))
+    a = planes.astype(np.float32)
+    if metric == "normvar":
+        mean = a.mean(axis=(1, 2), dtype=np.float64)
+        var = a.var(axis=(1, 2), dtype=np.float64, ddof=1)
+        return np.where(mean > 0, var / np.where(mean > 0, mean, 1), 0.0)
+    # 3x3 Laplacian, border pixels repeated as in ImageJ's convolve3x3
+    p = np.pad(a, ((0, 0), (1, 1), (1, 1)), mode="edge")
+    lap = p[:, :-2, 1:-1] + p[:, 2:, 1:-1] + p[:, 1:-1, :-2] + p[:, 1:-1, 2:] - 4 * a
+    return lap.var(axis=(1, 2), dtype=np.float64, ddof=1)
+
+
+def gaussian_kernel(sigma, accuracy, max_radius):
+    """One-sided kernel (kernel[0] = centre) like ij.plugin.filter.GaussianBlur"""
+    k_radius = int(math.ceil(sigma * math.sqrt(-2 * math.log(accuracy)))) + 1
+    max_radius = max(max_radius, 50)
+    k_radius = min(k_radius, max_radius)
+    i = np.arange(k_radius, dtype=np.float64)
+    kernel = np.exp(-0.5 * i * i / sigma / sigma)
+    if 3 < k_radius < max_radius:
+        # edge correction: smooth quadratic tail instead of a hard cut-off
+        sqrt_slope = float("inf")
+        r = k_radius
+        while r > k_radius // 2:
+            r -= 1
+            a = math.sqrt(kernel[r]) / (k_radius - r)
+            if a < sqrt_slope:
+                sqrt_slope = a
+            else:
+                break
+        r1 = np.arange(r + 2, k_radius)
+        kernel[r + 2:] = (k_radius - r1) ** 2 * sqrt_slope * sqrt_slope
+    return kernel / (kernel[0] + 2 * kernel[1:].sum())
+
+
+def _blur_last_axis(a, kernel):
+    r = len(kernel) - 1
+    n = a.shape[-1]
+    pad = [(0, 0)] * (a.ndim - 1) + [(r, r)]
+    # out-of-image pixels take the nearest edge value, as in ImageJ
+    p = np.pad(a, pad, mode="edge")
+    out = kernel[0] * a
+    for i in range(1, r + 1):
+        out += kernel[i] * (p[..., r + i:r + i + n] + p[..., r - i:r - i + n])
+    return out
+
+
+def _blur_last_axis_fft(a, kernel):
+    """Same as _blur_last_axis, one FFT convolution instead of len(kernel) shifted adds"""
+    r = len(kernel) - 1
+    n = a.shape[-1]
+    pad = [(0, 0)] * (a.ndim - 1) + [(r, r)]
+    p = np.pad(a, pad, mode="edge")
+    full = np.concatenate([kernel[:0:-1], kernel])
+    size = p.shape[-1] + 2 * r
+    conv = np.fft.irfft(np.fft.rfft(p, size) * np.fft.rfft(full, size), size)
+    return conv[..., 2 * r:2 * r + n]
+
+
+def _blur_axis(a, kernel):
+    if len(kernel) - 1 > FFT_KERNEL_RADIUS:
+        return _blur_last_axis_fft(a, kernel)
+    return _blur_last_axis(a, kernel)
+
+
+def gaussian_blur(img, sigma, bit_depth=16):
+    """Separable Gaussian blur of a 2D (or (C, Y, X)) array, result rounded to the input type
+
+    sigma 0 returns img unchanged; long kernels (large sigma) go through an
+    FFT so the cost stays flat in sigma.
+    """
+    if sigma <= 0:
+        return img
+    accuracy = 0.002 if bit_depth == 8 else 0.0002
+    out = img.astype(np.float64)
+    out = _blur_axis(out, gaussian_kernel(sigma, accuracy, out.shape[-1]))
+    out = np.swapaxes(_blur_axis(np.swapaxes(out, -1, -2), gaussian_kernel(sigma, accuracy, out.shape[-2])), -1, -2)
+    if np.issubdtype(img.dtype, np.integer):
+        info = np.iinfo(img.dtype)
+        return np.clip(np.floor(out + 0.5), info.min, info.max).astype(img.dtype)
+    return out.astype(img.dtype)
+
+
+def histogram_bounds(img, low=0.0, high=100.0):
+    """(lo, hi) values at the low/high percentiles of a single histogram, as ifigure_core"""
+    if np.issubdtype(img.dtype, np.integer):
+        hist = np.bincount(img.ravel())
+        start, size = 0, 1
+    else:
+        hist, edges = np.histogram(img, 256)
+        start, size = edges[0], edges[1] - edges[0]
+    cum = np.cumsum(hist)
+    total = cum[-1]
+    lo_bin = int(np.searchsorted(cum, total * low / 100.0, side="right"))
+    hi_bin = int(np.searchsorted(cum, total * high / 100.0, side="left"))
+    lo_bin = min(lo_bin, hi_bin)
+    if size == 1:
+        return lo_bin, hi_bin
+    return float(start + lo_bin * size), float(min(edges[-1], start + (hi_bin + 1) * size))
+
+
+def normalize_channel(img, low=0.0, high=100.0):
+    """low..high percentiles stretched to 0..255 (uint8), as ifigure_core.normalize_channel"""
+    lo, hi = histogram_bounds(img, low, high)
+    if hi <= lo:
+        return np.zeros(img.shape, dtype=np.uint8)
+    if np.issubdtype(img.dtype, np.integer):
+        # one lookup table over all possible values, applied with a single gather
+        values = np.arange(int(img.max()) + 1, dtype=np.float64)
+        table = np.clip(np.floor((values - lo) * (256.0 / (hi - lo + 1)) + 0.5), 0, 255).astype(np.uint8)
+        return table[img]
+    return to_8bit(img, lo, hi)
+
+
+def to_8bit(img, lo, hi):
+    """ImageJ 8-bit conversion using the display range lo..hi"""
+    if img.dtype == np.uint8:
+        return img
+    if np.issubdtype(img.dtype, np.integer):
+        # ShortProcessor -> ByteProcessor
+        scale = 256.0 / (hi - lo + 1)
+    else:
+        # FloatProcessor -> ByteProcessor
+        scale = 255.0 / (hi - lo) if hi > lo else 1.0
+    return np.clip(np.floor((img.astype(np.float64) - lo) * scale + 0.5), 0, 255).astype(np.uint8)
+
+
+def lut_rgb(img8, color):
+    """(Y, X, 3) RGB of an 8-bit image through a single-colour LUT ((r, g, b) in 0..1)"""
+    return (img8[..., np.newaxis] * np.asarray(color, dtype=np.float64)[np.newaxis, np.newaxis]).astype(np.uint8)
+
+
+def composite_add(*rgbs):
+    """Additive composite with clipping, as CompositeImage.COMPOSITE"""
+    total = np.zeros(rgbs[0].shape, dtype=np.uint16)
+    for rgb in rgbs:
+        total += rgb
+    return np.minimum(total, 255).astype(np.uint8)
+
+
+RED = (1, 0, 0)
+WHITE = (1, 1, 1)
+
+
+def merge_red_white(red, white):
+    """Red + white composite of two channels with display range 0-255"""
+    return composite_add(lut_rgb(to_8bit(red, 0, 255), RED), lut_rgb(to_8bit(white, 0, 255), WHITE))
+
+
+#--------- layout
+
+def panel_rects(w, h, w_z, h_z, n_top=4, n_bottom=3, n_rows=1):
+    """(x, y, w, h) of every panel of the combined figure (n_rows bottom rows) plus the figure size"""
+    rects = []
+    for i in range(n_top):
+        rects.append((PADDING + i * (w + PADDING), PADDING + ROW_LABEL_SPACE, w, h))
+    for row in range(n_rows):
+        y_bottom = PADDING + ROW_LABEL_SPACE + h + (row + 1) * (PADDING + ROW_LABEL_SPACE) + row * h_z
+        for i in range(n_bottom):
+            rects.append((PADDING + (i + 1) * (w_z + PADDING), y_bottom, w_z, h_z))
+    width = w * n_top + PADDING * (n_top + 1)
+    height = h + n_rows * h_z + (n_rows + 2) * PADDING + (n_rows + 1) * ROW_LABEL_SPACE
+    return rects, (width, height)
+
+
+def _draw_labels(fig, rects, labels, font_size):
+    if Image is None:
+        return fig
+    img = Image.fromarray(fig)
+    draw = ImageDraw.Draw(img)
+    try:
+        font = ImageFont.truetype("DejaVuSans-Bold.ttf", font_size)
+    except IOError:
+        font = ImageFont.load_default()
+    for (x, y, w, h), label in zip(rects, labels):
+        label_width = draw.textlength(label, font=font)
+        # ImageJ drawString y is the baseline
+        draw.text((x + (w - label_width) // 2, y - 10), label, fill=(255, 255, 255), font=font, anchor="ls")
+    return np.asarray(img)
+
+
+def compose_combined(panels, rows_z, labels, labels_z, font_size=None):
+    """Lay out RGB panels in the combined figure, returns (H, W, 3) uint8
+
+    rows_z and labels_z hold one list of panels / labels per bottom row.
+    """
+    h, w = panels[0].shape[:2]
+    h_z, w_z = rows_z[0][0].shape[:2]
+    rects, (width, height) = panel_rects(w, h, w_z, h_z, len(panels), len(rows_z[0]), len(rows_z))
+    fig = np.zeros((height, width, 3), dtype=np.uint8)
+    all_panels = list(panels) + [panel for row in rows_z for panel in row]
+    for (x, y, pw, ph), panel in zip(rects, all_panels):
+        fig[y:y + ph, x:x + pw] = panel
+    if font_size is None:
+        font_size = max(10, int(h / 20.0))
+    return _draw_labels(fig, rects, list(labels) + [label for row in labels_z for label in row], font_size)
+
+
+#--------- full pipeline
+
+def build_figure(stack, params):
+    """Combined figure of a (C, Z, Y, X) stack, returns (H, W, 3) uint8"""
+    p = resolve_params(params, stack.shape[1])
+    if stack.shape[0] < 3:
+        raise ValueError("Image has {} channels, but 3 channels are required.".format(stack.shape[0]))
+    bit_depth = 8 if stack.dtype == np.uint8 else 16
+
+    # display ranges of the top row panels, as inherited from the opened image
+    ranges = p['display_ranges']
+    if ranges is None:
+        ranges = [(float(stack[c].min()), float(stack[c].max())) for c in range(stack.shape[0])]
+
+    if not p['projections']:
+        raise ValueError("The combined figure needs at least one projection")
+
+    cropped = crop(stack, p['roi'])
+    if p['autofocus']:
+        channel = max(1, min(int(p['focus_channel']), stack.shape[0]))
+        p['zslice'] = int(np.argmax(focus_scores(cropped[channel - 1], p['focus_metric']))) + 1
+    slice_chs = cropped[:, p['zslice'] - 1]
+
+    sigma = p['blur_sigma']
+    # all 3 channels at once, each is blurred once and shared by its panels
+    processed = list(gaussian_blur(slice_chs, sigma, bit_depth))
+    if p['normalize']:
+        processed = [normalize_channel(ch, p['normalize_low'], p['normalize_high']) for ch in processed]
+        ranges = [(0.0, 255.0)] * len(processed)
+
+    gray = [lut_rgb(to_8bit(processed[c], *ranges[c]), WHITE) for c in range(3)]
+    panels = [gray[2], gray[0], gray[1], merge_red_white(processed[0], processed[1])]
+    labels = p['panel_labels']
+
+    rows_z = []
+    labels_z = []
+    for stat in p['projections']:
+        proj_chs = project(cropped, p['z_start'], p['z_end'], stat)
+        # projection panels are scaled to their own min/max (before the blur)
+        proj_ranges = [(float(ch.min()), float(ch.max())) for ch in proj_chs]
+        # 32-bit projections are blurred with the 16-bit/float accuracy
+        # only the 2 shown channels are blurred
+        proc_z = list(gaussian_blur(proj_chs[:2], sigma, bit_depth if stat == "max" else 32))
+        gray_z = [lut_rgb(to_8bit(proc_z[c], *proj_ranges[c]), WHITE) for c in range(2)]
+        rows_z.append([gray_z[0], gray_z[1], merge_red_white(proc_z[0], proc_z[1])])
+        suffix = PROJECTION_SUFFIXES.get(stat, p['projection_suffix'])
+        labels_z.append([label + suffix for label in labels[1:4]])
+    return compose_combined(panels, rows_z, labels, labels_z, p['font_size'])
+
+
+def compare_figures(a, b, tolerance=2, n_rows=1):
+    """Panel-area comparison of two figures, returns (max_abs_diff, fraction_over_tolerance)
+
+    Labels are ignored (fonts differ between Java and Pillow). n_rows is the
+    number of projection rows.
+    """
+    if a.shape != b.shape:
+        raise ValueError("Figure sizes differ: {} vs {}".format(a.shape, b.shape))
+    # both rows come from the same crop, so the panel size follows from the figure size
+    height, width = a.shape[:2]
+    w = (width - 5 * PADDING) // 4
+    h = (height - (n_rows + 2) * PADDING - (n_rows + 1) * ROW_LABEL_SPACE) // (n_rows + 1)
+    rects = panel_rects(w, h, w, h, n_rows=n_rows)[0]
+    mask = np.zeros((height, width), dtype=bool)
+    for x, y, pw, ph in rects:
+        mask[y:y + ph, x:x + pw] = True
+    diff = np.abs(a.astype(np.int16) - b.astype(np.int16)).max(axis=-1)[mask]
+    return int(diff.max()), float((diff > tolerance).mean())
+
+
+def save_figure(path, fig):
+    """Save an RGB figure as TIFF (tifffile) or PNG/JPEG (Pillow)"""
+    if path.lower().endswith((".tif", ".tiff")):
+        tifffile.imwrite(path, fig, photometric="rgb")
+    elif Image is not None:
+        Image.fromarray(fig).save(path)
+    else:
+        raise ImportError("Pillow is required to save {}".format(path))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render an IFigure combined figure without Fiji")
+    parser.add_argument("input")
+    parser.add_argument("output")
+    parser.add_argument("--blur", type=float, default=0.0)
+    parser.add_argument("--zslice", type=int)
+    parser.add_argument("--autofocus", action="store_true", help="use the sharpest z-slice instead of --zslice")
+    parser.add_argument("--focus-channel", type=int, default=1)
+    parser.add_argument("--focus-metric", choices=FOCUS_METRICS, default="laplacian")
+    parser.add_argument("--z-range", type=int, nargs=2, metavar=("START", "END"))
+    parser.add_argument("--roi", type=int, nargs=4, metavar=("X", "Y", "W", "H"))
+    parser.add_argument("--labels", nargs=4)
+    parser.add_argument("--normalize", action="store_true")
+    parser.add_argument("--clip", type=float, default=0.0, help="percent clipped at each end when normalizing")
+    parser.add_argument("--projections", nargs="+", choices=STATISTICS, default=["max"])
+    parser.add_argument("--compare", help="Fiji figure to cross-check against")
+    args = parser.parse_args(argv)
+
+    params = {
+        'blur_sigma': args.blur,
+        'zslice': args.zslice,
+        'z_start': args.z_range[0] if args.z_range else None,
+        'z_end': args.z_range[1] if args.z_range else None,
+        'roi': args.roi,
+        'panel_labels': args.labels,
+        'normalize': args.normalize,
+        'normalize_low': args.clip,
+        'normalize_high': 100.0 - args.clip,
+        'projections': args.projections,
+        'autofocus': args.autofocus,
+        'focus_channel': args.focus_channel,
+        'focus_metric': args.focus_metric,
+    }
+    fig = build_figure(load_stack(args.input), params)
+    save_figure(args.output, fig)
+
+    if args.compare:
+        reference = np.asarray(Image.open(args.compare).convert("RGB")) if Image else tifffile.imread(args.compare)
+        max_diff, over = compare_figures(fig, reference, n_rows=len(args.projections))
+        print("max difference: {}, pixels over tolerance: {:.3%}".format(max_diff, over))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,29 @@
+"""
+Default figure parameters, shared by ifigure_core.py and batch_manifest.py
+
+Plain Python without ImageJ imports: the manifest is also loaded outside
+Fiji by the queue coordinator (python batch_queue.py), whose parameter
+hashes have to match the workers'. ifigure_numpy.py keeps its own copy, it
+runs without the Fiji modules next to it.
+"""
+
+# default labels corresponding to previously used channels on airyscan
+DEFAULT_LABELS = ["Cyan", "Far red", "Red", "Merged"]
+
+DEFAULT_PARAMS = {
+    'blur_sigma': 0.0,
+    'zslice': None,          # None = middle slice
+    'z_start': None,         # None = first slice
+    'z_end': None,           # None = last slice
+    'panel_labels': list(DEFAULT_LABELS),
+    'normalize': False,      # normalize_channel on the top row channels
+    'normalize_low': 0.0,    # percentile mapped to 0 (0 = channel min)
+    'normalize_high': 100.0, # percentile mapped to 255 (100 = channel max)
+    'font_size': None,       # None = scaled with the panel size
+    'projection_suffix': " (Max Z)",
+    'projections': ["max"],  # bottom rows, any of ifigure_engine.STATISTICS
+    'layout': "combined",    # figures to compose: "combined", "single" (one row) or "both"
+    'autofocus': False,      # zslice = sharpest plane of focus_channel (within the ROI)
+    'focus_channel': 1,
+    'focus_metric': "laplacian", # or "normvar", see ifigure_engine.FOCUS_METRICS
+}
@@ -0,0 +1,144 @@
+"""
+Live figure preview for the interactive batch dialog
+
+A 2x/4x/8x downsampled pyramid of the opened stack is built once per file.
+While the NonBlockingGenericDialog sliders move, the combined figure is
+re-rendered from the coarsest level that still gives panels of about
+PREVIEW_PANEL_SIZE pixels, so an update takes tens of milliseconds. The full
+resolution stack is only used for the final save. Blurred planes are kept
+per level, so moving one slider does not re-blur the panels it leaves
+unchanged, and each level gets a range-max index (sparse table over z) when
+it fits RANGE_MAX_BUDGET, so moving the z-range sliders updates the max
+projection row from two planes instead of a pass over the range.
+"""
+
+from ij import ImagePlus, ImageStack, CompositeImage
+from ij.gui import Roi, DialogListener
+from ij.process import ImageProcessor
+from java.awt import Rectangle
+
+from ifigure_core import build_figures, BlurCache
+from ifigure_engine import RangeMaxIndex, range_max_bytes
+
+PYRAMID_FACTORS = [2, 4, 8]
+# longest panel side the preview aims for
+PREVIEW_PANEL_SIZE = 384
+# heap a level's range-max index may take (n log n planes of the 2 projected channels)
+RANGE_MAX_BUDGET = 256 * 1024 * 1024
+
+
+def downsample(imp, factor, source=None, source_factor=1):
+    """imp downsampled by factor (averaging), built from an already downsampled source level"""
+    src = source if source is not None else imp
+    step = factor // source_factor
+    stack = src.getStack()
+    w = max(1, src.getWidth() // step)
+    h = max(1, src.getHeight() // step)
+    small = ImageStack(w, h)
+    for n in range(1, stack.getSize() + 1):
+        ip = stack.getProcessor(n)
+        ip.setInterpolationMethod(ImageProcessor.BILINEAR)
+        small.addSlice(stack.getSliceLabel(n), ip.resize(w, h, True))
+
+    level = ImagePlus("{} (1/{})".format(imp.getTitle(), factor), small)
+    level.setDimensions(imp.getNChannels(), imp.getNSlices(), imp.getNFrames())
+    if imp.isComposite():
+        # keep channel LUTs and display ranges, the top row panels inherit them
+        level = CompositeImage(level, imp.getMode())
+        level.setLuts(imp.getLuts())
+    else:
+        level.setDisplayRange(imp.getDisplayRangeMin(), imp.getDisplayRangeMax())
+    return level
+
+
+def build_pyramid(imp, factors=PYRAMID_FACTORS):
+    """[(factor, ImagePlus)] from full resolution (factor 1) to the coarsest level"""
+    levels = [(1, imp)]
+    for factor in factors:
+        if imp.getWidth() // factor < 1 or imp.getHeight() // factor < 1:
+            break
+        prev_factor, prev = levels[-1]
+        levels.append((factor, downsample(imp, factor, prev if prev_factor > 1 else None, prev_factor)))
+    return levels
+
+
+class FigurePreview(object):
+    """Preview window of the combined figure, rendered from the pyramid"""
+
+    def __init__(self, imp, panel_size=PREVIEW_PANEL_SIZE):
+        self.imp = imp
+        self.panel_size = panel_size
+        self.levels = build_pyramid(imp)
+        self.blur_caches = dict((factor, BlurCache()) for factor, level in self.levels)
+        # factor -> RangeMaxIndex (None when it does not fit), built on first use
+        self.range_max = {}
+        self.window_imp = None
+
+    def pick_level(self, rect):
+        """Coarsest level whose ROI crop is still at least panel_size on its longest side"""
+        longest = max(rect.width, rect.height)
+        chosen = self.levels[0]
+        for factor, level in self.levels:
+            if longest // factor >= self.panel_size:
+                chosen = (factor, level)
+        return chosen
+
+    def range_max_for(self, factor, level):
+        if factor not in self.range_max:
+            fits = level.getNSlices() > 2 and range_max_bytes(level) <= RANGE_MAX_BUDGET
+            self.range_max[factor] = RangeMaxIndex(level) if fits else None
+        return self.range_max[factor]
+
+    def render(self, params):
+        """Re-render the figure for params from the ROI currently drawn on the full image"""
+        roi = self.imp.getRoi()
+        if roi is not None and roi.isArea():
+            rect = roi.getBounds()
+        else:
+            rect = Rectangle(0, 0, self.imp.getWidth(), self.imp.getHeight())
+        factor, level = self.pick_level(rect)
+        level.setRoi(Roi(rect.x // factor, rect.y // factor,
+                         max(1, rect.width // factor), max(1, rect.height // factor)))
+
+        # blur sigma is in pixels, so it shrinks with the level
+        preview_params = dict(params, blur_sigma=params['blur_sigma'] / float(factor), layout="combined")
+        fig = build_figures(level, preview_params, blur_cache=self.blur_caches[factor],
+                            range_max=self.range_max_for(factor, level))["combined"]
+
+        if self.window_imp is None or self.window_imp.getWindow() is None:
+            self.window_imp = ImagePlus("Figure preview", fig.getProcessor())
+            self.window_imp.show()
+        else:
+            self.window_imp.setProcessor(fig.getProcessor())
+            self.window_imp.updateAndDraw()
+
+    def close(self):
+        if self.window_imp is not None:
+            self.window_imp.close()
+        for factor, level in self.levels[1:]:
+            level.flush()
+        self.levels = self.levels[:1]
+        for cache in self.blur_caches.values():
+            cache.clear()
+        self.range_max = {}
+
+
+class PreviewListener(DialogListener):
+    """Re-renders the preview whenever a dialog field changes
+
+    params_from_dialog(gd) turns the current field values into build_figure
+    parameters; it must read the fields directly (not getNextNumber), the
+    values are read again when the dialog is closed.
+    """
+
+    def __init__(self, preview, params_from_dialog):
+        self.preview = preview
+        self.params_from_dialog = params_from_dialog
+
+    def dialogItemChanged(self, gd, event):
+        try:
+            self.preview.render(self.params_from_dialog(gd))
+        except (ValueError, IndexError):
+            # half-typed values or a stack with too few channels, keep the last preview
+            pass
+        return True
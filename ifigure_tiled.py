@@ -0,0 +1,273 @@
+"""
+Tiled, memory-bounded rendering of the combined figure for very large mosaics
+
+Tile-scan files (e.g. 20k x 20k x 40z x 3c) never fit in the heap as a
+hyperstack. Here the figure is built in two tiled passes:
+
+1. the crop is read in XY tiles from one open reader (ifigure_loader.TileReader)
+   sized so that all z planes of one tile fit in the tile budget; each tile
+   is reduced to its z-slice and projections right away and only those 2D
+   planes are kept, together with the min/max of every channel.
+2. the 2D planes are blurred and LUT-mapped in tiles that overlap by the
+   blur radius, and the tile interiors are written straight into the figure
+   canvas.
+
+The top row panels are scaled to the channel min/max over the planes the
+untiled figure loads (the z-range, or the slice alone when it lies outside),
+which is the display range the importer's autoscale gives the untiled one,
+so both render with the same contrast.
+
+Peak memory is one tile of the stack plus the 2D panel planes and the RGB
+figure. Those two grow with the crop, not the tile budget: a 20k x 20k crop
+makes a figure of about 80k x 41k pixels, more than one Java array holds.
+check_tiled_figure rejects such crops (and those whose panels and figure
+don't fit in the heap) before anything is read. Very large sigmas
+(GaussianBlur downscaling) can differ from the untiled figure by a grey level
+at tile seams.
+"""
+
+import math
+
+from ij import IJ, ImagePlus
+from ij.gui import NewImage
+from ij.process import ColorProcessor, Blitter
+
+from ifigure_loader import TileReader, clip_roi, FIGURE_CHANNELS
+from ifigure_metrics import NO_TIMER
+from ifigure_workspace import NO_WORKSPACE
+from ifigure_core import (DEFAULT_PARAMS, PROJECTION_SUFFIXES, LAYOUTS, extract_planes, blur,
+                          histogram_bounds, to_byte)
+from ifigure_layout import plan_for, combined_geometry
+
+MB = 1024 * 1024
+# smallest tile side, below that the per-tile overhead dominates
+MIN_TILE = 256
+# ImageJ keeps the pixels of an image in one Java array, indexed by int
+MAX_ARRAY_PIXELS = 2 ** 31 - 1
+
+
+def blur_radius(sigma, bit_depth):
+    """How far (in pixels) a GaussianBlur of sigma reaches, i.e. the tile overlap needed"""
+    if sigma <= 0:
+        return 0
+    accuracy = 0.002 if bit_depth in (8, 24) else 0.0002
+    radius = int(math.ceil(sigma * math.sqrt(-2 * math.log(accuracy)))) + 1
+    if sigma > 2 * 2 + 0.5:
+        # GaussianBlur blurs a downscaled copy, its down/upscaling kernels reach a bit further
+        radius += 2 * int(math.ceil(sigma / 2.0))
+    return radius
+
+
+def tile_grid(width, height, tile):
+    """[(x, y, w, h)] of tile x tile tiles covering width x height"""
+    return [(x, y, min(tile, width - x), min(tile, height - y))
+            for y in range(0, height, tile) for x in range(0, width, tile)]
+
+
+def needed_bytes(params, dims):
+    """Bytes of the planes an untiled figure would load (ROI, figure channels, z-range + slice)"""
+    roi = clip_roi(params['roi'], dims['width'], dims['height']) or [0, 0, dims['width'], dims['height']]
+    planes = min(dims['channels'], FIGURE_CHANNELS) * (params['z_end'] - params['z_start'] + 2)
+    return roi[2] * roi[3] * planes * dims['bytes_per_pixel']
+
+
+def read_tile_size(params, dims, budget_bytes):
+    """Side of the square read tiles whose planes fit in budget_bytes"""
+    planes = min(dims['channels'], FIGURE_CHANNELS) * (params['z_end'] - params['z_start'] + 2)
+    side = int(math.sqrt(budget_bytes / float(planes * dims['bytes_per_pixel'])))
+    return max(MIN_TILE, side)
+
+
+def _channel_ranges(imp, ranges):
+    """Widen ranges[c] = [min, max] by every plane of channel c + 1 of imp"""
+    stack = imp.getStack()
+    for c in range(imp.getNChannels()):
+        for z in range(1, imp.getNSlices() + 1):
+            ip = stack.getProcessor(imp.getStackIndex(c + 1, z, 1))
+            ip.resetMinAndMax()
+            if ranges[c] is None:
+                ranges[c] = [ip.getMin(), ip.getMax()]
+            else:
+                ranges[c] = [min(ranges[c][0], ip.getMin()), max(ranges[c][1], ip.getMax())]
+
+
+def project_tiled(path, params, dims, budget_bytes, timer=NO_TIMER, workspace=NO_WORKSPACE):
+    """Pass 1: (slice_planes, {stat: planes}, slice_ranges) of the whole crop, read tile by tile
+
+    slice_ranges holds the (min, max) of every channel over the planes the
+    slice is taken from, i.e. the untiled figure's display ranges.
+    """
+    roi = clip_roi(params['roi'], dims['width'], dims['height']) or [0, 0, dims['width'], dims['height']]
+    rx, ry, width, height = roi
+    slice_planes = None
+    projections = None
+    ranges = [None] * min(dims['channels'], FIGURE_CHANNELS)
+    with timer.stage("open"):
+        reader = TileReader(path, dims['series'])
+    try:
+        for x, y, w, h in tile_grid(width, height, read_tile_size(params, dims, budget_bytes)):
+            with timer.stage("open"):
+                planes = workspace.track(reader.planes(params, dims, [rx + x, ry + y, w, h]))
+            try:
+                with timer.stage("project"):
+                    slice_ips, projected = extract_planes(None, params, planes)
+                    _channel_ranges(planes[0] or planes[1], ranges)
+            finally:
+                for imp in planes:
+                    if imp is not None:
+                        imp.close()
+                workspace.release(planes)
+            if slice_planes is None:
+                slice_planes = [ip.createProcessor(width, height) for ip in slice_ips]
+                # only the first 2 projected channels are shown
+                projections = dict((stat, [ip.createProcessor(width, height) for ip in ips[:2]])
+                                   for stat, ips in projected.items())
+                workspace.track([slice_planes, projections])
+            for plane, ip in zip(slice_planes, slice_ips):
+                plane.insert(ip, x, y)
+            for stat, ips in projected.items():
+                for plane, ip in zip(projections[stat], ips):
+                    plane.insert(ip, x, y)
+    finally:
+        reader.close()
+    return slice_planes, projections, [tuple(r) for r in ranges]
+
+
+def check_tiled_figure(params, dims, budget_bytes):
+    """ValueError when the combined figure of the crop can't be built in one image or in the heap
+
+    Counts what the render keeps besides the stack tiles: the slice planes
+    (source type), the 2 projected planes per row (32-bit, max in the source
+    type) and the RGB figure.
+    """
+    roi = clip_roi(params['roi'], dims['width'], dims['height']) or [0, 0, dims['width'], dims['height']]
+    width, height = roi[2], roi[3]
+    stats = params['projections']
+    fig_width, fig_height = combined_geometry(width, height, width, height, len(params['panel_labels']), 3,
+                                              len(stats))[:2]
+    if fig_width * fig_height > MAX_ARRAY_PIXELS:
+        raise ValueError("Combined figure of a {}x{} crop would be {}x{} pixels, more than one image can hold "
+                         "({} pixels); use a smaller roi".format(width, height, fig_width, fig_height,
+                                                                 MAX_ARRAY_PIXELS))
+    bpp = dims['bytes_per_pixel']
+    plane_bytes = FIGURE_CHANNELS * bpp + sum(2 * (bpp if stat == "max" else 4) for stat in stats)
+    needed = budget_bytes + width * height * plane_bytes + fig_width * fig_height * 4
+    if needed > IJ.maxMemory():
+        raise ValueError("Tiled figure of a {}x{} crop needs about {} MB (tiles, panel planes and figure), "
+                         "the heap is {} MB; use a smaller roi or more memory".format(
+                             width, height, needed // MB, IJ.maxMemory() // MB))
+
+
+def _blurred_tile(plane, rect, sigma):
+    plane.setRoi(rect[0], rect[1], rect[2], rect[3])
+    tile = ImagePlus("tile", plane.crop())
+    blur(tile, sigma)
+    return tile.getProcessor()
+
+
+def _interior(ip, x, y, w, h):
+    ip.setRoi(x, y, w, h)
+    return ip.crop()
+
+
+def _merged_rgb(red8, white8):
+    """Red + white additive composite of two 8-bit tiles, as ifigure_layout.FigureCanvas.red_white"""
+    red = red8.duplicate()
+    red.copyBits(white8, 0, 0, Blitter.ADD)
+    cp = ColorProcessor(red.getWidth(), red.getHeight())
+    cp.setRGB(red.getPixels(), white8.getPixels(), white8.getPixels())
+    return cp
+
+
+def render_tiled(slice_planes, projections, params, channel_ranges=None, tile=1024):
+    """Pass 2: blur + LUT map in overlapping tiles, written straight into the combined figure
+
+    channel_ranges are the display ranges of the top row channels (project_tiled),
+    None takes the min/max of the slice planes.
+    """
+    width = slice_planes[0].getWidth()
+    height = slice_planes[0].getHeight()
+    sigma = params['blur_sigma']
+    stats = params['projections']
+    overlap = blur_radius(sigma, slice_planes[0].getBitDepth())
+
+    #--------- display ranges of the whole panels, before tiling
+    slice_ranges = []
+    for c, plane in enumerate(slice_planes):
+        if params['normalize']:
+            # bounds from the unblurred slice, the blur only narrows the histogram slightly
+            slice_ranges.append(histogram_bounds(plane, params['normalize_low'], params['normalize_high']))
+        elif channel_ranges is not None:
+            slice_ranges.append(channel_ranges[c])
+        else:
+            plane.resetMinAndMax()
+            slice_ranges.append((plane.getMin(), plane.getMax()))
+    proj_ranges = {}
+    for stat in stats:
+        proj_ranges[stat] = []
+        for plane in projections[stat]:
+            plane.resetMinAndMax()
+            proj_ranges[stat].append((plane.getMin(), plane.getMax()))
+
+    suffixes = [PROJECTION_SUFFIXES.get(stat, params['projection_suffix']) for stat in stats]
+    plan = plan_for("combined", width, height, params['panel_labels'], width, height, suffixes, params['font_size'])
+    top, rows = plan.top, plan.rows
+    # RGB canvas written tile by tile (FigureCanvas planes would add 2 bytes per figure pixel)
+    fig = NewImage.createRGBImage("Combined Figure", plan.width, plan.height, 1, NewImage.FILL_BLACK)
+    fig_ip = fig.getProcessor()
+
+    for x, y, w, h in tile_grid(width, height, tile):
+        x0 = max(0, x - overlap)
+        y0 = max(0, y - overlap)
+        rect = (x0, y0, min(width, x + w + overlap) - x0, min(height, y + h + overlap) - y0)
+
+        #--------- Top row - single slice
+        gray = []
+        merge_in = []
+        for c, plane in enumerate(slice_planes):
+            t = _blurred_tile(plane, rect, sigma)
+            lo, hi = slice_ranges[c]
+            # a flat channel maps to black
+            gray.append(_interior(to_byte(t, lo, max(hi, lo + 1)), x - x0, y - y0, w, h))
+            # merged panel: normalized channels as they are, otherwise display range 0-255
+            merge_in.append(gray[-1] if params['normalize'] else _interior(to_byte(t, 0, 255), x - x0, y - y0, w, h))
+        panels = [gray[2].convertToRGB(), gray[0].convertToRGB(), gray[1].convertToRGB(),
+                  _merged_rgb(merge_in[0], merge_in[1])]
+        for (px, py), panel in zip(top, panels):
+            fig_ip.insert(panel, px + x, py + y)
+
+        #--------- Bottom rows - z projections
+        for positions, stat in zip(rows, stats):
+            gray_z = []
+            merge_z = []
+            for c, plane in enumerate(projections[stat]):
+                t = _blurred_tile(plane, rect, sigma)
+                lo, hi = proj_ranges[stat][c]
+                gray_z.append(_interior(to_byte(t, lo, max(hi, lo + 1)), x - x0, y - y0, w, h))
+                merge_z.append(_interior(to_byte(t, 0, 255), x - x0, y - y0, w, h))
+            panels_z = [gray_z[0].convertToRGB(), gray_z[1].convertToRGB(), _merged_rgb(merge_z[0], merge_z[1])]
+            for (px, py), panel in zip(positions, panels_z):
+                fig_ip.insert(panel, px + x, py + y)
+
+    plan.draw_labels(fig_ip)
+    fig.updateAndDraw()
+    return fig
+
+
+def build_figures_tiled(path, params, dims, budget_mb=512, timer=NO_TIMER, workspace=NO_WORKSPACE):
+    """Combined figure of a file too large to load, using at most about budget_mb for the stack tiles
+
+    workspace tracks the stack tiles (freed after each tile), the panel planes and the figure.
+    """
+    params = dict(DEFAULT_PARAMS, **dict((k, v) for k, v in params.items() if v is not None))
+    if LAYOUTS.get(params['layout']) != ["combined"]:
+        raise ValueError("Tiled mode renders the combined figure only (layout: {})".format(params['layout']))
+    if min(dims['channels'], FIGURE_CHANNELS) < 3:
+        raise ValueError("Image has {} channels, but 3 channels are required.".format(dims['channels']))
+    check_tiled_figure(params, dims, budget_mb * MB)
+    slice_planes, projections, slice_ranges = project_tiled(path, params, dims, budget_mb * MB, timer, workspace)
+    # blur and LUT mapping are interleaved per tile, timed together
+    with timer.stage("compose"):
+        fig = workspace.track(render_tiled(slice_planes, projections, params, slice_ranges))
+    workspace.release([slice_planes, projections])
+    return {"combined": fig}
@@ -0,0 +1,143 @@
+"""
+Per-file workspace: the images built for one figure, freed together when it is done
+
+The pipeline registers what it allocates for a file with workspace.track():
+the opened or loaded ImagePlus, cropped planes and projections, 8-bit
+copies, the figure canvas and the figures. close() frees all of it at the
+end of the file: ImagePlus are closed and flushed (their pixel arrays are
+dropped even if a reference to the ImagePlus lingers), processors lose
+their snapshot and the workspace's reference. Images the workspace did not
+allocate (shared caches, other windows) are never touched, unlike
+IJ.run("Close All").
+
+Every tracked object counts its pixel bytes: peak_bytes is the most tracked
+at once (release() frees objects earlier and lowers it). With leak_check,
+close() keeps weak references to the pixel arrays it freed and runs one GC;
+arrays still reachable after it are held outside the workspace, i.e. leaked.
+That is a full GC per file, so it is off by default ("leak_check" in the
+manifest). Both go to the run report as peak_mb and leaked_mb.
+"""
+
+from ij import ImagePlus
+from java.lang import System
+from java.lang.ref import WeakReference
+from java.util import IdentityHashMap
+import threading
+
+from ifigure_metrics import NO_TIMER, MB
+
+BYTES_PER_PIXEL = {8: 1, 16: 2, 24: 4, 32: 4}
+
+
+def image_bytes(obj):
+    """Pixel bytes of an ImagePlus (all planes) or an ImageProcessor"""
+    planes = obj.getStackSize() if isinstance(obj, ImagePlus) else 1
+    return obj.getWidth() * obj.getHeight() * planes * BYTES_PER_PIXEL.get(obj.getBitDepth(), 4)
+
+
+def _pixel_arrays(obj):
+    if isinstance(obj, ImagePlus):
+        if obj.getStackSize() > 1:
+            return [a for a in obj.getStack().getImageArray()[:obj.getStackSize()] if a is not None]
+        obj = obj.getProcessor()
+        if obj is None:
+            return []
+    pixels = obj.getPixels()
+    return [pixels] if pixels is not None else []
+
+
+def _items(obj):
+    """Images in obj: an image, or lists/tuples/dicts of them (nested), None skipped"""
+    if obj is None:
+        return []
+    if isinstance(obj, dict):
+        obj = list(obj.values())
+    if isinstance(obj, (list, tuple)):
+        items = []
+        for item in obj:
+            items.extend(_items(item))
+        return items
+    return [obj]
+
+
+class Workspace(object):
+    """Images allocated for one file, freed together by close() (thread-safe)"""
+
+    def __init__(self, leak_check=False):
+        self.leak_check = leak_check
+        self.lock = threading.Lock()
+        # image -> bytes, by identity (two processors may be equal)
+        self.objects = IdentityHashMap()
+        self.live_bytes = 0
+        self.peak_bytes = 0
+        self.leaked_bytes = None
+        # (weak reference to a freed pixel array, bytes), for leak_check
+        self.freed = []
+
+    def track(self, obj):
+        """Register images the pipeline allocated (see _items), returns obj"""
+        for item in _items(obj):
+            with self.lock:
+                if self.objects.containsKey(item):
+                    continue
+                size = image_bytes(item)
+                self.objects.put(item, size)
+                self.live_bytes += size
+                self.peak_bytes = max(self.peak_bytes, self.live_bytes)
+        return obj
+
+    def keep(self, obj):
+        """Hand images out of the workspace (e.g. a figure the background writer closes)"""
+        for item in _items(obj):
+            with self.lock:
+                size = self.objects.remove(item)
+                if size is not None:
+                    self.live_bytes -= size
+
+    def release(self, obj):
+        """Free tracked images before the end of the file, untracked ones are left alone"""
+        for item in _items(obj):
+            with self.lock:
+                size = self.objects.remove(item)
+                if size is None:
+                    continue
+                self.live_bytes -= size
+            if self.leak_check:
+                arrays = _pixel_arrays(item)
+                self.freed.extend((WeakReference(a), size // len(arrays)) for a in arrays)
+            if isinstance(item, ImagePlus):
+                item.changes = False
+                item.close()
+                item.flush()
+            else:
+                item.setSnapshotPixels(None)
+
+    def close(self, timer=NO_TIMER):
+        """Free everything still tracked, note peak_mb (and leaked_mb) in the timer"""
+        with self.lock:
+            items = list(self.objects.keySet())
+        self.release(items)
+        del items
+        timer.note("peak_mb", round(self.peak_bytes / float(MB), 1))
+        if self.leak_check:
+            System.gc()
+            self.leaked_bytes = sum(size for ref, size in self.freed if ref.get() is not None)
+            self.freed = []
+            timer.note("leaked_mb", round(self.leaked_bytes / float(MB), 1))
+        return self.peak_bytes, self.leaked_bytes
+
+
+class _NoWorkspace(object):
+    """Workspace that tracks nothing, the default when a caller frees its own images"""
+
+    def track(self, obj):
+        return obj
+
+    def keep(self, obj):
+        pass
+
+    def release(self, obj):
+        pass
+
+
+NO_WORKSPACE = _NoWorkspace()
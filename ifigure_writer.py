@@ -0,0 +1,132 @@
+"""
+Figure output: JPEG with a chosen quality, lossless PNG and compressed TIFF
+
+save_figure(imp, base_path, formats, jpeg_quality) writes one render in
+several formats. FigureWriter runs it on a background thread behind a
+bounded queue: write() returns at once unless `capacity` figures are already
+waiting, so the next file is processed while the previous one is encoded
+and written, and finished figures can't pile up in the heap.
+"""
+
+from ij import IJ
+from ij.io import FileSaver
+from ij.plugin import JpegWriter
+from javax.imageio import ImageIO, IIOImage, ImageWriteParam
+from java.io import File
+from java.util.concurrent import Callable, Executors, ExecutionException, Semaphore, TimeUnit
+
+from ifigure_metrics import NO_TIMER
+
+# format name -> file extension
+FORMATS = {
+    'jpeg': ".jpeg",
+    'png': ".png",
+    'tiff': ".tif",
+}
+DEFAULT_FORMATS = ["jpeg"]
+# same as File > Save As > Jpeg...
+DEFAULT_JPEG_QUALITY = 85
+TIFF_COMPRESSION = "Deflate"
+
+
+def output_paths(base_path, formats):
+    """Output file of every format, base_path has no extension"""
+    return [base_path + FORMATS[f] for f in formats]
+
+
+def check_formats(formats):
+    for f in formats:
+        if f not in FORMATS:
+            raise ValueError("Unknown output format: {} (use {})".format(f, ", ".join(sorted(FORMATS))))
+
+
+def save_tiff(imp, path):
+    """Deflate-compressed TIFF through ImageIO, uncompressed FileSaver TIFF if the JVM has no TIFF writer"""
+    writers = ImageIO.getImageWritersByFormatName("tiff")
+    if not writers.hasNext():
+        return FileSaver(imp).saveAsTiff(path)
+    writer = writers.next()
+    param = writer.getDefaultWriteParam()
+    param.setCompressionMode(ImageWriteParam.MODE_EXPLICIT)
+    param.setCompressionType(TIFF_COMPRESSION)
+    out_file = File(path)
+    if out_file.exists():
+        out_file.delete()
+    out = ImageIO.createImageOutputStream(out_file)
+    try:
+        writer.setOutput(out)
+        writer.write(None, IIOImage(imp.getBufferedImage(), None, None), param)
+    finally:
+        out.close()
+        writer.dispose()
+    return True
+
+
+def save_figure(imp, base_path, formats=DEFAULT_FORMATS, jpeg_quality=DEFAULT_JPEG_QUALITY):
+    """Write imp in every format, returns the written paths (IOError on the first failure)"""
+    check_formats(formats)
+    paths = output_paths(base_path, formats)
+    for fmt, path in zip(formats, paths):
+        if fmt == "jpeg":
+            # quality per call, FileSaver.setJpegQuality would change it for every thread
+            error = JpegWriter.save(imp, path, int(jpeg_quality))
+            ok = not error
+        elif fmt == "png":
+            ok = FileSaver(imp).saveAsPng(path)
+        else:
+            ok = save_tiff(imp, path)
+        if not ok:
+            raise IOError("could not save {}".format(path))
+    return paths
+
+
+class _WriteJob(Callable):
+    def __init__(self, writer, imp, base_path, timer):
+        self.writer = writer
+        self.imp = imp
+        self.base_path = base_path
+        self.timer = timer
+
+    def call(self):
+        try:
+            with self.timer.stage("save"):
+                paths = save_figure(self.imp, self.base_path, self.writer.formats, self.writer.jpeg_quality)
+            for path in paths:
+                IJ.log("Saved: {}".format(path))
+            return paths
+        except IOError as e:
+            IJ.log("ERROR: {}".format(e))
+            raise
+        finally:
+            self.imp.close()
+            self.writer.slots.release()
+
+
+class FigureWriter(object):
+    """Background encoding and writing of figures, in submission order, at most capacity waiting"""
+
+    def __init__(self, formats=DEFAULT_FORMATS, jpeg_quality=DEFAULT_JPEG_QUALITY, capacity=2):
+        check_formats(formats)
+        self.formats = list(formats)
+        self.jpeg_quality = jpeg_quality
+        self.slots = Semaphore(capacity)
+        self.executor = Executors.newSingleThreadExecutor()
+        self.futures = []
+
+    def write(self, imp, base_path, timer=NO_TIMER):
+        """Queue imp (closed once written), returns the output paths; blocks while the queue is full"""
+        self.slots.acquire()
+        self.futures.append((timer, self.executor.submit(_WriteJob(self, imp, base_path, timer))))
+        return output_paths(base_path, self.formats)
+
+    def shutdown(self):
+        """Wait for all pending writes, returns the timers passed to write() of the failed figures"""
+        self.executor.shutdown()
+        self.executor.awaitTermination(1, TimeUnit.DAYS)
+        failed = []
+        for timer, future in self.futures:
+            try:
+                future.get()
+            except ExecutionException:
+                failed.append(timer)
+        return failed
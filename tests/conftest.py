@@ -0,0 +1,14 @@
+"""
+pytest setup: the modules under test live in the repository root, next to the Fiji scripts
+
+Only the plain-Python modules are tested here (ifigure_numpy, batch_manifest,
+batch_state, batch_scan, batch_queue); everything importing ij runs in Fiji,
+see fiji_sd_check.py.
+"""
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
@@ -0,0 +1,60 @@
+"""
+Check of the fused SD projection (ifigure_engine.py) against ZProjector, in Fiji
+
+    ImageJ --headless --jython tests/fiji_sd_check.py
+
+The fused pass accumulates in float32; on bright 16-bit stacks a plain sum
+of squares cancels, so the SD is compared with ZProjector.SD_METHOD (double
+sums) on high-offset stacks. Exits with status 1 when any difference exceeds
+SD_TOLERANCE (the pytest suite in this folder runs without Fiji and can't
+cover it).
+"""
+
+from ij import IJ, ImagePlus, ImageStack
+from ij.plugin import ZProjector
+from ij.process import ShortProcessor
+from java.lang import System
+import os
+import sys
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if repo_dir not in sys.path:
+    sys.path.append(repo_dir)
+
+from ifigure_engine import fused_slice_and_project
+
+# largest accepted SD difference from ZProjector (grey levels)
+SD_TOLERANCE = 0.01
+# (offset, noise, planes) of the 16-bit stacks
+CASES = [(50000, 10.0, 40), (50000, 10.0, 100), (60000, 2.0, 100), (2000, 800.0, 40)]
+
+
+def sd_error(offset, noise, slices, size=96):
+    """Max difference of the fused SD projection from ZProjector's on a stack at offset +- noise"""
+    stack = ImageStack(size, size)
+    for z in range(slices):
+        ip = ShortProcessor(size, size)
+        ip.add(offset)
+        ip.noise(noise)
+        stack.addSlice(ip)
+    imp = ImagePlus("sd check", stack)
+    imp.setDimensions(1, slices, 1)
+    fused = fused_slice_and_project(imp, None, 1, slices, None, ("sd",))[1]["sd"][0]
+    reference = ZProjector.run(imp, "sd").getProcessor()
+    return max(abs(fused.getf(i) - reference.getf(i)) for i in range(size * size))
+
+
+def main():
+    failed = 0
+    for offset, noise, slices in CASES:
+        error = sd_error(offset, noise, slices)
+        ok = error <= SD_TOLERANCE
+        failed += not ok
+        IJ.log("SD {} +- {}, {} planes: max error {:.5f} {}".format(offset, noise, slices, error,
+                                                                    "ok" if ok else "FAILED"))
+    IJ.log("{} of {} SD checks failed (tolerance {})".format(failed, len(CASES), SD_TOLERANCE))
+    return failed
+
+
+# the exit status is what CI looks at, headless Fiji would otherwise exit 0
+System.exit(1 if main() else 0)
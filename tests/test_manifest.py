@@ -0,0 +1,94 @@
+import json
+
+import pytest
+
+from batch_manifest import load_manifest, normalize_params, DEFAULT_PARAMS, SUPPORTED_EXTENSIONS
+
+
+def write(tmp_path, name, text):
+    path = tmp_path / name
+    path.write_text(text)
+    return str(path)
+
+
+def json_manifest(tmp_path, data):
+    return load_manifest(write(tmp_path, "manifest.json", json.dumps(data)))
+
+
+def test_json_folders_and_defaults(tmp_path):
+    m = json_manifest(tmp_path, {"extensions": [".CZI", "nd2"]})
+    assert m.input_dir == str(tmp_path)
+    assert m.output_dir == str(tmp_path / "figures")
+    assert m.extensions == ["czi", "nd2"]
+    params = m.params_for("a.czi")
+    assert params == DEFAULT_PARAMS
+    # a copy, not the shared defaults
+    params['panel_labels'][0] = "changed"
+    assert m.params_for("a.czi")['panel_labels'][0] == "Cyan"
+
+
+def test_params_for_precedence(tmp_path):
+    m = json_manifest(tmp_path, {
+        "defaults": {"blur_sigma": 0.5, "zslice": 3, "projections": ["max", "sd"]},
+        "rules": [
+            {"pattern": "*_control_*", "blur_sigma": 1.0, "z_start": 2},
+            {"pattern": "2025-12-15/*", "blur_sigma": 2.0},
+        ],
+        "files": {"2025-12-15/cell_control_1.czi": {"zslice": 12}, "other.czi": {"zslice": 7}},
+    })
+    # defaults -> rules in file order -> exact entry
+    p = m.params_for("2025-12-15/cell_control_1.czi")
+    assert (p['blur_sigma'], p['zslice'], p['z_start'], p['projections']) == (2.0, 12, 2, ["max", "sd"])
+    # rules match the bare file name too, exact entries the file name when the path has none
+    p = m.params_for("elsewhere/cell_control_2.czi")
+    assert (p['blur_sigma'], p['zslice'], p['z_start']) == (1.0, 3, 2)
+    assert m.params_for("sub/other.czi")['zslice'] == 7
+    p = m.params_for("plain.czi")
+    assert (p['blur_sigma'], p['zslice'], p['z_start']) == (0.5, 3, None)
+
+
+def test_csv_rows(tmp_path):
+    m = load_manifest(write(tmp_path, "manifest.csv", "\n".join([
+        "file,blur_sigma,zslice,label_ch2,projections,normalize,roi,series",
+        "default,0.5,,,max|SD,yes,,",
+        "*.tif,1.0,,Green,,,,",
+        "a.tif,,4,,,,\"10,20,30,40\",1|3",
+    ]) + "\n"))
+    p = m.params_for("a.tif")
+    assert p['blur_sigma'] == 1.0
+    assert p['zslice'] == 4
+    assert p['panel_labels'] == ["Cyan", "Green", "Red", "Merged"]
+    assert p['projections'] == ["max", "sd"]
+    assert p['normalize'] is True
+    assert p['roi'] == [10, 20, 30, 40]
+    assert p['series'] == [1, 3]
+    assert m.output_dir == str(tmp_path / "figures")
+
+
+def test_csv_extensions_from_entries_and_patterns(tmp_path):
+    m = load_manifest(write(tmp_path, "manifest.csv",
+                            "file,zslice\ndefault,3\n*.tif,4\nsample_*/*.czi,5\na.nd2,6\n"))
+    assert m.extensions == ["czi", "nd2", "tif"]
+    # a pattern in a subfolder implies the recursive scan
+    assert m.recursive
+    assert m.params_for("sample_1/x.czi")['zslice'] == 5
+
+    # a pattern that leaves the extension open matches every format
+    m = load_manifest(write(tmp_path, "open.csv", "file,zslice\nsample_*,4\na.nd2,6\n"))
+    assert m.extensions == sorted(SUPPORTED_EXTENSIONS)
+    assert not m.recursive
+
+
+def test_normalize_params_errors():
+    with pytest.raises(ValueError):
+        normalize_params({"blurr_sigma": "1"})
+    with pytest.raises(ValueError):
+        normalize_params({"roi": "1,2,3"})
+    assert normalize_params({"zslice": "", "blur_sigma": None}) == {}
+
+
+def test_invalid_manifests(tmp_path):
+    with pytest.raises(IOError):
+        load_manifest(str(tmp_path / "missing.json"))
+    with pytest.raises(ValueError):
+        json_manifest(tmp_path, {"fingerprint": "md5"})
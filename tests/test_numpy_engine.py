@@ -0,0 +1,119 @@
+import math
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import ifigure_numpy as engine
+
+# (C, Z, Y, X) = (1, 4, 1, 2): pixel 0 is 1, 3, 5, 7 and pixel 1 is 2, 4, 8, 2 over z
+PLANES = [[1, 2], [3, 4], [5, 8], [7, 2]]
+
+
+def small_stack(offset=0):
+    return (np.array(PLANES, dtype=np.uint16) + offset).reshape(1, 4, 1, 2)
+
+
+@pytest.mark.parametrize("stat, expected", [
+    ("max", [7, 8]),
+    ("sum", [16, 16]),
+    ("mean", [4, 4]),
+    ("median", [4, 3]),
+    ("sd", [math.sqrt(20 / 3.0), math.sqrt(8)]),
+])
+def test_projection_statistics(stat, expected):
+    proj = engine.project(small_stack(), 1, 4, stat)
+    assert proj.shape == (1, 1, 2)
+    assert proj.ravel() == pytest.approx(expected, abs=1e-5)
+
+
+def test_projection_types_and_range():
+    stack = small_stack()
+    assert engine.project(stack, 1, 4, "max").dtype == np.uint16
+    assert engine.project(stack, 1, 4, "mean").dtype == np.float32
+    # z_start..z_end are 1-based and inclusive
+    assert engine.project(stack, 2, 3, "max").ravel().tolist() == [5, 8]
+    assert engine.project(stack, 3, 3, "sd").ravel().tolist() == [0, 0]
+
+
+def test_sd_of_a_high_offset_16_bit_stack():
+    # the SD does not depend on the offset; float32 sums of squares would cancel here
+    sd = engine.project(small_stack(offset=60000), 1, 4, "sd")
+    assert sd.ravel() == pytest.approx([math.sqrt(20 / 3.0), math.sqrt(8)], abs=1e-4)
+
+    rng = np.random.RandomState(1)
+    stack = (50000 + rng.randint(-10, 11, size=(1, 100, 8, 8))).astype(np.uint16)
+    deviations = stack.astype(np.float64) - 50000
+    expected = np.sqrt(((deviations - deviations.mean(axis=1, keepdims=True)) ** 2).sum(axis=1) / 99)
+    assert np.abs(engine.project(stack, 1, 100, "sd") - expected).max() < 1e-3
+
+
+def test_unknown_projection():
+    with pytest.raises(ValueError):
+        engine.project(small_stack(), 1, 4, "mode")
+
+
+def test_histogram_bounds_percentiles():
+    img = np.arange(100, dtype=np.uint16).reshape(10, 10)
+    assert engine.histogram_bounds(img) == (0, 99)
+    # 10 % of the pixels are below 10, 10 % above 89
+    assert engine.histogram_bounds(img, 10.0, 90.0) == (10, 89)
+    flat = np.full((4, 4), 7, dtype=np.uint16)
+    assert engine.histogram_bounds(flat, 1.0, 99.0) == (7, 7)
+
+
+def test_normalize_channel_stretches_the_bounds():
+    img = np.arange(100, dtype=np.uint16).reshape(10, 10)
+    out = engine.normalize_channel(img, 10.0, 90.0)
+    assert out.dtype == np.uint8
+    # ShortProcessor -> ByteProcessor scaling: 256 / (hi - lo + 1)
+    assert out.ravel()[[0, 10, 50, 89, 90, 99]].tolist() == [0, 0, 128, 253, 255, 255]
+    assert not engine.normalize_channel(np.full((4, 4), 7, dtype=np.uint16)).any()
+
+
+@pytest.mark.parametrize("sigma", [10.0, 30.0])
+def test_fft_blur_matches_the_direct_blur(sigma):
+    kernel = engine.gaussian_kernel(sigma, 0.0002, 400)
+    assert len(kernel) - 1 > engine.FFT_KERNEL_RADIUS
+    rng = np.random.RandomState(2)
+    a = rng.uniform(0, 4000, size=(3, 50, 400))
+    assert np.abs(engine._blur_last_axis_fft(a, kernel) - engine._blur_last_axis(a, kernel)).max() < 1e-6
+
+
+def test_gaussian_blur_same_result_either_way(monkeypatch):
+    rng = np.random.RandomState(3)
+    img = rng.randint(0, 4000, size=(2, 120, 150)).astype(np.uint16)
+    with_fft = engine.gaussian_blur(img, 12.0)
+    monkeypatch.setattr(engine, "FFT_KERNEL_RADIUS", 10 ** 6)
+    direct = engine.gaussian_blur(img, 12.0)
+    assert with_fft.dtype == np.uint16
+    # both round to the integer type, float noise may flip a .5
+    assert np.abs(with_fft.astype(np.int32) - direct).max() <= 1
+
+
+def test_gaussian_kernel_is_normalized():
+    kernel = engine.gaussian_kernel(2.0, 0.002, 100)
+    assert kernel[0] + 2 * kernel[1:].sum() == pytest.approx(1.0)
+    assert list(kernel) == sorted(kernel, reverse=True)
+
+
+def test_compare_figures_looks_at_the_panels_only():
+    rng = np.random.RandomState(4)
+    stack = rng.randint(0, 4000, size=(3, 5, 40, 50)).astype(np.uint16)
+    fig = engine.build_figure(stack, {'blur_sigma': 1.0, 'projections': ["max", "sd"]})
+    assert engine.compare_figures(fig, fig.copy(), n_rows=2) == (0, 0.0)
+
+    changed = fig.copy()
+    # top left corner: padding and labels, outside every panel
+    changed[:10, :10] = 255
+    assert engine.compare_figures(fig, changed, n_rows=2) == (0, 0.0)
+    # first top row panel starts at (PADDING, PADDING + ROW_LABEL_SPACE)
+    y, x = engine.PADDING + engine.ROW_LABEL_SPACE, engine.PADDING
+    changed[y:y + 4, x:x + 5] = fig[y:y + 4, x:x + 5] ^ 0x80
+    max_diff, fraction = engine.compare_figures(fig, changed, n_rows=2)
+    assert max_diff == 128
+    # 20 of the pixels of 4 top + 2 x 3 bottom panels of 50 x 40
+    assert fraction == pytest.approx(20.0 / (10 * 50 * 40))
+
+    with pytest.raises(ValueError):
+        engine.compare_figures(fig, fig[:-1])
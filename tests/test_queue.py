@@ -0,0 +1,75 @@
+import os
+import time
+
+from batch_queue import WorkQueue, job_id
+from batch_state import DONE, FAILED
+
+
+def queue(tmp_path, worker, **kwargs):
+    return WorkQueue(str(tmp_path / "queue"), worker, **kwargs)
+
+
+def age_claim(q, key, seconds):
+    path = os.path.join(q.queue_dir, "claims", job_id(key) + ".json")
+    old = time.time() - seconds
+    os.utime(path, (old, old))
+
+
+def test_every_file_is_claimed_once(tmp_path):
+    a, b = queue(tmp_path, "a"), queue(tmp_path, "b")
+    assert a.add("x.czi") and a.add("y.czi")
+    assert not b.add("x.czi")
+    claimed = [a.claim(), b.claim()]
+    assert sorted(claimed) == ["x.czi", "y.czi"]
+    assert a.claim() is None and b.claim() is None
+
+    a.record(claimed[0], None, None, DONE)
+    a.release(claimed[0])
+    assert a.result(claimed[0])['status'] == DONE
+    assert a.open_jobs() == 1
+    # finished files are not claimed again
+    assert a.claim() is None
+
+
+def test_stale_claim_is_taken_back(tmp_path):
+    a, b = queue(tmp_path, "a", stale_after=60), queue(tmp_path, "b", stale_after=60)
+    a.add("x.czi")
+    assert a.claim() == "x.czi"
+    assert b.requeue_stale() == []
+    # no heartbeat for longer than stale_after: the worker is considered lost
+    age_claim(a, "x.czi", 120)
+    assert b.requeue_stale() == ["x.czi"]
+    assert b.attempts(job_id("x.czi")) == 1
+    assert b.claim() == "x.czi"
+    # the lost worker's late heartbeat drops the claim instead of renewing it
+    a._beat()
+    assert a.held == {}
+    b.release("x.czi")
+
+
+def test_heartbeat_keeps_the_claim(tmp_path):
+    a, b = queue(tmp_path, "a", stale_after=0.4), queue(tmp_path, "b", stale_after=0.4)
+    a.add("x.czi")
+    assert a.claim() == "x.czi"
+    a.start_heartbeat()
+    try:
+        time.sleep(1.0)
+        assert b.requeue_stale() == []
+    finally:
+        a.stop_heartbeat()
+    # without the heartbeat the claim expires
+    age_claim(a, "x.czi", 5)
+    assert b.requeue_stale() == ["x.czi"]
+
+
+def test_failed_after_max_attempts(tmp_path):
+    a, b = queue(tmp_path, "a", max_attempts=2), queue(tmp_path, "b", max_attempts=2)
+    a.add("x.czi")
+    for attempt in range(2):
+        assert a.claim() == "x.czi"
+        age_claim(a, "x.czi", 1000)
+        assert b.requeue_stale() == ["x.czi"]
+    result = b.result("x.czi")
+    assert result['status'] == FAILED
+    assert "lost 2 times" in result['error']
+    assert a.claim() is None
@@ -0,0 +1,27 @@
+import os
+
+from batch_scan import find_files, relative_key, mirror_dir
+
+
+def touch(path):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    open(path, "w").close()
+
+
+def test_find_files(tmp_path):
+    root = str(tmp_path)
+    for name in ["b.czi", "a.CZI", "c.tif", ".hidden.czi", "day1/s1/x.czi", "figures/old.czi", ".cache/y.czi"]:
+        touch(os.path.join(root, name))
+    flat = find_files(root, ["czi"])
+    assert [relative_key(p, root) for p in flat] == ["a.CZI", "b.czi"]
+    deep = find_files(root, [".czi", "tif"], recursive=True, exclude=[os.path.join(root, "figures")])
+    assert [relative_key(p, root) for p in deep] == ["a.CZI", "b.czi", "c.tif", "day1/s1/x.czi"]
+
+
+def test_mirror_dir(tmp_path):
+    root, out = str(tmp_path / "in"), str(tmp_path / "out")
+    target = mirror_dir(os.path.join(root, "day1", "s1", "x.czi"), root, out)
+    assert target == os.path.join(out, "day1", "s1")
+    assert os.path.isdir(target)
+    assert mirror_dir(os.path.join(root, "x.czi"), root, out) == out
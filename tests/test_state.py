@@ -0,0 +1,58 @@
+import json
+import os
+
+from batch_state import BatchState, STATE_FILE, DONE, FAILED, write_json
+
+
+def input_file(tmp_path, name="a.czi", data=b"pixels"):
+    path = tmp_path / name
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_record_and_reload(tmp_path):
+    path = input_file(tmp_path)
+    out = tmp_path / "a.jpeg"
+    out.write_bytes(b"jpeg")
+    state = BatchState(str(tmp_path))
+    state.record("a.czi", path, {'zslice': 3}, DONE, [str(out)])
+    state.record("b.czi", path, {'zslice': 3}, FAILED, error="boom")
+
+    again = BatchState(str(tmp_path))
+    assert again.is_up_to_date("a.czi", path, {'zslice': 3})
+    assert not again.is_up_to_date("a.czi", path, {'zslice': 4})
+    assert again.failed() == ["b.czi"]
+    assert not os.path.exists(again.path + ".tmp")
+
+    # a missing output or a changed file is processed again
+    out.unlink()
+    assert not again.is_up_to_date("a.czi", path, {'zslice': 3})
+
+
+def test_recovery_from_the_temp_file(tmp_path):
+    path = input_file(tmp_path)
+    BatchState(str(tmp_path)).record("a.czi", path, {}, DONE)
+    state_path = str(tmp_path / STATE_FILE)
+    # killed on Windows between removing the old state and renaming the new one
+    os.rename(state_path, state_path + ".tmp")
+    assert BatchState(str(tmp_path)).status("a.czi") == DONE
+
+
+def test_half_written_temp_file_is_ignored(tmp_path):
+    path = input_file(tmp_path)
+    BatchState(str(tmp_path)).record("a.czi", path, {}, DONE)
+    state_path = str(tmp_path / STATE_FILE)
+    with open(state_path + ".tmp", "w") as f:
+        f.write('{"files": {"a.cz')
+    assert BatchState(str(tmp_path)).status("a.czi") == DONE
+    os.remove(state_path)
+    assert BatchState(str(tmp_path)).entries == {}
+
+
+def test_write_json_replaces_the_file(tmp_path):
+    target = str(tmp_path / "x.json")
+    write_json(target, {'a': 1})
+    write_json(target, {'a': 2})
+    with open(target) as f:
+        assert json.load(f) == {'a': 2}
+    assert os.listdir(str(tmp_path)) == ["x.json"]